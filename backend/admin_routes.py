@@ -7,13 +7,14 @@ from datetime import datetime, timedelta
 from typing import Optional
 from uuid import UUID
 
+import aiofiles
 from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
 from fastapi.responses import FileResponse
 from sqlalchemy.orm import Session, joinedload
 from sqlalchemy import func
 
 from database import get_db
-from auth import get_current_admin_user, get_effective_permissions, get_password_hash
+from auth import get_current_admin_user, get_effective_permissions, get_password_hash, invalidate_authed_user
 from db_models import User, Role, RolePermission, UserPermission, CreditTransaction, SystemSetting, APIKey
 from credits import (
     add_credits, get_user_transactions, PERMISSION_CODES,
@@ -31,8 +32,10 @@ from models import (
 )
 from template_service import (
     get_export_templates, save_export_templates, delete_template,
-    TEMPLATE_PARAM_HELP, generate_template_id
+    get_template_param_help, generate_template_id
 )
+from thesis_routes import invalidate_lookup_cache
+from attachment_processor import UPLOAD_CHUNK_SIZE
 
 router = APIRouter(prefix="/admin", tags=["Administration"])
 
@@ -140,6 +143,7 @@ async def update_user(
     user.updated_at = datetime.utcnow()
     db.commit()
     db.refresh(user)
+    invalidate_authed_user(user.id)
 
     return build_admin_user_response(user, db)
 
@@ -167,6 +171,7 @@ async def change_user_role(
     user.updated_at = datetime.utcnow()
     db.commit()
     db.refresh(user)
+    invalidate_authed_user(user.id)
 
     return build_admin_user_response(user, db)
 
@@ -603,6 +608,19 @@ async def update_eur_per_credit(
     return {"eur_per_credit": value}
 
 
+# ============================================================================
+# CACHE LOOKUP
+# ============================================================================
+
+@router.post("/lookup/invalidate-cache")
+async def invalidate_lookup(
+    admin_user: User = Depends(get_current_admin_user),
+):
+    """Svuota la cache dei dati di lookup dopo una modifica alle tabelle."""
+    invalidate_lookup_cache()
+    return {"message": "Cache lookup invalidata"}
+
+
 # ============================================================================
 # TEMPLATE ESPORTAZIONE
 # ============================================================================
@@ -616,7 +634,7 @@ async def get_templates(
     data = get_export_templates(db)
     return ExportTemplateListResponse(
         templates=data.get("templates", []),
-        help=TEMPLATE_PARAM_HELP
+        help=get_template_param_help()
     )
 
 
@@ -632,7 +650,7 @@ async def update_templates(
     result = save_export_templates(data, admin_user.id, db)
     return ExportTemplateListResponse(
         templates=result.get("templates", []),
-        help=TEMPLATE_PARAM_HELP
+        help=get_template_param_help()
     )
 
 
@@ -646,7 +664,7 @@ async def remove_template(
     result = delete_template(template_id, admin_user.id, db)
     return ExportTemplateListResponse(
         templates=result.get("templates", []),
-        help=TEMPLATE_PARAM_HELP
+        help=get_template_param_help()
     )
 
 
@@ -655,7 +673,7 @@ async def get_template_help(
     admin_user: User = Depends(get_current_admin_user),
 ):
     """Restituisce le descrizioni di tutti i parametri dei template per i tooltip."""
-    return TEMPLATE_PARAM_HELP
+    return get_template_param_help()
 
 
 @router.post("/templates/background-upload")
@@ -675,8 +693,8 @@ async def upload_template_background(
         )
 
     # Max 5MB
-    contents = await file.read()
-    if len(contents) > 5 * 1024 * 1024:
+    max_size = 5 * 1024 * 1024
+    if file.size is not None and file.size > max_size:
         raise HTTPException(status_code=400, detail="File troppo grande (max 5MB).")
 
     bg_dir = config.UPLOAD_DIR / "template_backgrounds"
@@ -686,8 +704,18 @@ async def upload_template_background(
     filename = f"bg_{_uuid.uuid4().hex[:12]}.{ext}"
     file_path = bg_dir / filename
 
-    with open(file_path, "wb") as f:
-        f.write(contents)
+    # Copia a blocchi: il file non viene mai caricato interamente in memoria
+    file_size = 0
+    async with aiofiles.open(file_path, "wb") as f:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            file_size += len(chunk)
+            if file_size > max_size:
+                break
+            await f.write(chunk)
+
+    if file_size > max_size:
+        file_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=400, detail="File troppo grande (max 5MB).")
 
     return {"filename": filename, "url": f"/admin/templates/backgrounds/{filename}"}
 
@@ -6,10 +6,12 @@ con interfaccia comune per la generazione di contenuti.
 """
 
 import os
+import functools
 import json
+import math
 import re
 from abc import ABC, abstractmethod
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from dotenv import load_dotenv, find_dotenv
 from ai_exceptions import InsufficientCreditsError, check_openai_error, check_claude_error
 
@@ -21,14 +23,42 @@ ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 DEFAULT_OPENAI_MODEL = os.getenv("OPENAI_MODEL_ID", "o3")
 DEFAULT_CLAUDE_MODEL = os.getenv("THESIS_CLAUDE_MODEL", "claude-opus-4-6")
 MAX_TOKENS = int(os.getenv("OPENAI_MAX_TOKENS", "16000"))
+# Sotto questa soglia di parole per sezione, le sezioni di un capitolo
+# vengono generate con un'unica chiamata (0 = sempre una chiamata per sezione)
+SECTION_BATCH_MAX_WORDS = int(os.getenv("THESIS_SECTION_BATCH_MAX_WORDS", "2000"))
+# Stima dei token di output per parola italiana e margine di sicurezza usati
+# per dimensionare max_tokens dei contenuti (un output troncato costringe a
+# chiedere una continuazione)
+TOKENS_PER_WORD = float(os.getenv("THESIS_TOKENS_PER_WORD", "2.5"))
+CONTENT_TOKENS_MARGIN = float(os.getenv("THESIS_CONTENT_TOKENS_MARGIN", "1.3"))
+# Token riservati al ragionamento dei modelli OpenAI o-series/gpt-5: sono
+# conteggiati in max_completion_tokens insieme al testo prodotto
+OPENAI_REASONING_TOKENS = int(os.getenv("OPENAI_REASONING_TOKENS", "8000"))
 
 
 class BaseAIClient(ABC):
     """Interfaccia base per i client AI."""
 
+    # True se il provider supporta lo structured output con JSON Schema
+    # (generate_text accetta allora il parametro response_format)
+    supports_json_schema = False
+
+    def content_max_tokens(self, total_words: int) -> int:
+        """
+        max_tokens per un contenuto di total_words parole: stima per parola
+        con margine, cosi' la prima risposta non viene troncata.
+        """
+        estimated_tokens = math.ceil(total_words * TOKENS_PER_WORD * CONTENT_TOKENS_MARGIN)
+        return max(estimated_tokens, MAX_TOKENS)
+
     @abstractmethod
-    def generate_text(self, prompt: str, max_tokens: Optional[int] = None) -> str:
-        """Genera testo dal prompt."""
+    def generate_text(self, prompt: str, max_tokens: Optional[int] = None, system: Optional[str] = None) -> str:
+        """
+        Genera testo dal prompt.
+
+        system e' un eventuale system prompt statico: viene inviato prima del
+        prompt utente cosi' che il provider possa riusarne la cache.
+        """
         pass
 
     def _clean_json_text(self, text: str) -> str:
@@ -138,7 +168,15 @@ class BaseAIClient(ABC):
 
         return None
 
-    def generate_json(self, prompt: str, max_tokens: Optional[int] = None, retries: int = 2) -> Dict[str, Any]:
+    def generate_json(
+        self,
+        prompt: str,
+        max_tokens: Optional[int] = None,
+        retries: int = 2,
+        system: Optional[str] = None,
+        schema: Optional[Dict[str, Any]] = None,
+        schema_name: str = "response"
+    ) -> Dict[str, Any]:
         """
         Genera una risposta JSON dal modello con meccanismo di retry e repair.
 
@@ -146,6 +184,10 @@ class BaseAIClient(ABC):
             prompt: Il prompt che richiede output JSON
             max_tokens: Numero massimo di token
             retries: Numero di tentativi in caso di JSON malformato
+            system: System prompt statico opzionale
+            schema: JSON Schema della risposta, usato come structured output
+                se il provider lo supporta (supports_json_schema)
+            schema_name: Nome dello schema richiesto dal provider
 
         Returns:
             Dizionario Python parsato dal JSON generato
@@ -158,7 +200,16 @@ class BaseAIClient(ABC):
             if attempt > 0:
                 logger.warning(f"Tentativo {attempt + 1}/{retries + 1} per generazione JSON")
 
-            response_text = self.generate_text(prompt, max_tokens)
+            if schema is not None and self.supports_json_schema:
+                response_text = self.generate_text(
+                    prompt, max_tokens, system=system,
+                    response_format={
+                        "type": "json_schema",
+                        "json_schema": {"name": schema_name, "schema": schema, "strict": True},
+                    }
+                )
+            else:
+                response_text = self.generate_text(prompt, max_tokens, system=system)
             cleaned_text = self._clean_json_text(response_text)
 
             # Tentativo 1: parse diretto
@@ -184,9 +235,12 @@ class BaseAIClient(ABC):
         attachments_context: str = ""
     ) -> Dict[str, Any]:
         """Genera i titoli dei capitoli per una tesi."""
-        from thesis_prompts import build_chapters_prompt
-        prompt = build_chapters_prompt(thesis_data, attachments_context)
-        return self.generate_json(prompt)
+        from thesis_prompts import build_chapters_prompt, CHAPTERS_SCHEMA
+        structured = self.supports_json_schema
+        prompt = build_chapters_prompt(thesis_data, attachments_context, structured_output=structured)
+        return self.generate_json(
+            prompt, schema=CHAPTERS_SCHEMA if structured else None, schema_name="chapters"
+        )
 
     def generate_sections(
         self,
@@ -195,17 +249,21 @@ class BaseAIClient(ABC):
         attachments_context: str = ""
     ) -> Dict[str, Any]:
         """Genera i titoli delle sezioni per ogni capitolo."""
-        from thesis_prompts import build_sections_prompt
-        prompt = build_sections_prompt(thesis_data, chapters, attachments_context)
+        from thesis_prompts import build_sections_prompt, SECTIONS_SCHEMA
+        structured = self.supports_json_schema
+        prompt = build_sections_prompt(thesis_data, chapters, attachments_context, structured_output=structured)
         # Stima token necessari: più capitoli e sezioni = più token
         sections_per_chapter = thesis_data.get('sections_per_chapter', 3)
         num_chapters = len(chapters)
         # ~200 token per sezione (titolo + key_points) + overhead JSON
         estimated_tokens = num_chapters * sections_per_chapter * 200 + 1000
         max_tokens = max(estimated_tokens, MAX_TOKENS)
-        return self.generate_json(prompt, max_tokens=max_tokens)
+        return self.generate_json(
+            prompt, max_tokens=max_tokens,
+            schema=SECTIONS_SCHEMA if structured else None, schema_name="sections"
+        )
 
-    def generate_section_content(
+    def build_section_content_request(
         self,
         thesis_data: Dict[str, Any],
         chapter: Dict[str, Any],
@@ -213,9 +271,15 @@ class BaseAIClient(ABC):
         previous_sections_summary: str = "",
         attachments_context: str = "",
         author_style_context: str = ""
-    ) -> str:
-        """Genera il contenuto di una singola sezione."""
-        from thesis_prompts import build_section_content_prompt
+    ) -> Dict[str, Any]:
+        """
+        Prepara la richiesta per il contenuto di una sezione.
+
+        Returns:
+            Dizionario con prompt, system e max_tokens (usato sia dalla
+            chiamata diretta sia dalla Batch API)
+        """
+        from thesis_prompts import build_section_content_prompt, get_section_content_system_prompt
 
         prompt = build_section_content_prompt(
             thesis_data=thesis_data,
@@ -226,13 +290,77 @@ class BaseAIClient(ABC):
             author_style_context=author_style_context
         )
 
+        # Istruzioni fisse come system prompt: uguali per tutte le sezioni
+        system = get_section_content_system_prompt(thesis_data.get('citation_style', 'footnotes'))
+
         # Calcola max_tokens in base alle parole richieste
-        # ~2.5 token per parola italiana + margine
-        words_per_section = thesis_data.get('words_per_section', 5000)
-        estimated_tokens = int(words_per_section * 2.5) + 2000
-        max_tokens = max(estimated_tokens, MAX_TOKENS)
+        max_tokens = self.content_max_tokens(thesis_data.get('words_per_section', 5000))
+
+        return {"prompt": prompt, "system": system, "max_tokens": max_tokens}
+
+    def generate_section_content(
+        self,
+        thesis_data: Dict[str, Any],
+        chapter: Dict[str, Any],
+        section: Dict[str, Any],
+        previous_sections_summary: str = "",
+        attachments_context: str = "",
+        author_style_context: str = ""
+    ) -> str:
+        """Genera il contenuto di una singola sezione."""
+        request = self.build_section_content_request(
+            thesis_data, chapter, section,
+            previous_sections_summary=previous_sections_summary,
+            attachments_context=attachments_context,
+            author_style_context=author_style_context
+        )
+        return self.generate_text(**request)
+
+    def generate_sections_content_batch(
+        self,
+        thesis_data: Dict[str, Any],
+        chapter: Dict[str, Any],
+        sections: List[Dict[str, Any]],
+        previous_sections_summary: str = "",
+        attachments_context: str = "",
+        author_style_context: str = ""
+    ) -> List[str]:
+        """
+        Genera in una sola chiamata il contenuto di tutte le sezioni di un capitolo.
+
+        Returns:
+            Lista dei contenuti, nello stesso ordine di sections
+
+        Raises:
+            ValueError: Se la risposta non contiene una sezione per ogni richiesta
+        """
+        from thesis_prompts import build_section_content_batch_prompt, get_section_content_system_prompt
+
+        prompt = build_section_content_batch_prompt(
+            thesis_data=thesis_data,
+            chapter=chapter,
+            sections=sections,
+            previous_sections_summary=previous_sections_summary,
+            attachments_context=attachments_context,
+            author_style_context=author_style_context
+        )
+        system = get_section_content_system_prompt(thesis_data.get('citation_style', 'footnotes'))
 
-        return self.generate_text(prompt, max_tokens=max_tokens)
+        # Stessa stima della singola sezione, moltiplicata per il numero di sezioni
+        words_per_section = thesis_data.get('words_per_section', 5000)
+        max_tokens = self.content_max_tokens(len(sections) * words_per_section)
+
+        result = self.generate_json(prompt, max_tokens=max_tokens, system=system)
+        contents = [
+            (item.get("content") or "").strip()
+            for item in result.get("sections", [])
+            if isinstance(item, dict)
+        ]
+        if len(contents) != len(sections) or not all(contents):
+            raise ValueError(
+                f"Risposta batch incompleta: {len(contents)} sezioni su {len(sections)} richieste"
+            )
+        return contents
 
 
 class OpenAIClient(BaseAIClient):
@@ -240,6 +368,8 @@ class OpenAIClient(BaseAIClient):
     Client per OpenAI con supporto per modelli di reasoning (o1, o3).
     """
 
+    supports_json_schema = True
+
     def __init__(self, model_id: Optional[str] = None, api_key: Optional[str] = None):
         self.api_key = api_key or OPENAI_API_KEY
         if not self.api_key:
@@ -254,13 +384,35 @@ class OpenAIClient(BaseAIClient):
         self.max_tokens = MAX_TOKENS
         self.provider = "openai"
 
-    def generate_text(self, prompt: str, max_tokens: Optional[int] = None) -> str:
+    def content_max_tokens(self, total_words: int) -> int:
+        """Come BaseAIClient, piu' la quota di ragionamento per i modelli di reasoning."""
+        max_tokens = super().content_max_tokens(total_words)
+        if self.model_id.startswith(("o1", "o3", "o4", "gpt-5")):
+            max_tokens += OPENAI_REASONING_TOKENS
+        return max_tokens
+
+    def generate_text(
+        self,
+        prompt: str,
+        max_tokens: Optional[int] = None,
+        system: Optional[str] = None,
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> str:
+        # OpenAI applica automaticamente il prompt caching al prefisso comune:
+        # il system prompt statico va quindi per primo
+        messages = [{"role": "user", "content": prompt}]
+        if system:
+            messages.insert(0, {"role": "system", "content": system})
+        kwargs = {}
+        if response_format:
+            kwargs["response_format"] = response_format
         try:
             response = self.client.chat.completions.create(
                 model=self.model_id,
-                messages=[{"role": "user", "content": prompt}],
+                messages=messages,
                 max_completion_tokens=max_tokens or self.max_tokens,
-                timeout=300.0
+                timeout=300.0,
+                **kwargs
             )
             return response.choices[0].message.content
         except InsufficientCreditsError:
@@ -289,13 +441,20 @@ class ClaudeClient(BaseAIClient):
         self.max_tokens = MAX_TOKENS
         self.provider = "claude"
 
-    def generate_text(self, prompt: str, max_tokens: Optional[int] = None) -> str:
+    def generate_text(self, prompt: str, max_tokens: Optional[int] = None, system: Optional[str] = None) -> str:
+        kwargs = {}
+        if system:
+            # Blocco statico marcato per il prompt caching di Anthropic
+            kwargs["system"] = [
+                {"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}
+            ]
         try:
             message = self.client.messages.create(
                 model=self.model_id,
                 max_tokens=max_tokens or self.max_tokens,
                 messages=[{"role": "user", "content": prompt}],
-                timeout=300.0
+                timeout=300.0,
+                **kwargs
             )
             return message.content[0].text
         except InsufficientCreditsError:
@@ -305,9 +464,116 @@ class ClaudeClient(BaseAIClient):
             raise RuntimeError(f"Errore nella generazione Claude: {str(e)}")
 
 
-# Singleton instances
-_openai_client: Optional[OpenAIClient] = None
-_claude_client: Optional[ClaudeClient] = None
+# ============================================================================
+# BATCH API (generazione non interattiva)
+# ============================================================================
+
+class BatchGenerateClient:
+    """
+    Invio di molte richieste di testo come un unico job della Batch API del
+    provider (OpenAI Batch o Anthropic Message Batches): costo dimezzato e
+    limiti di rate separati, con risultati disponibili entro 24 ore.
+
+    Ogni richiesta e' un dizionario con custom_id, prompt, system e max_tokens.
+    I custom_id devono rispettare ^[a-zA-Z0-9_-]{1,64}$ (vincolo Anthropic).
+    """
+
+    def __init__(self, client: BaseAIClient):
+        self.client = client
+
+    def submit(self, requests: List[Dict[str, Any]]) -> str:
+        """Invia le richieste e restituisce l'id del batch."""
+        try:
+            if self.client.provider == "claude":
+                batch = self.client.client.messages.batches.create(requests=[
+                    {
+                        "custom_id": r["custom_id"],
+                        "params": {
+                            "model": self.client.model_id,
+                            "max_tokens": r.get("max_tokens") or self.client.max_tokens,
+                            "messages": [{"role": "user", "content": r["prompt"]}],
+                            **({"system": r["system"]} if r.get("system") else {})
+                        }
+                    }
+                    for r in requests
+                ])
+                return batch.id
+
+            lines = []
+            for r in requests:
+                messages = [{"role": "user", "content": r["prompt"]}]
+                if r.get("system"):
+                    messages.insert(0, {"role": "system", "content": r["system"]})
+                lines.append(json.dumps({
+                    "custom_id": r["custom_id"],
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": self.client.model_id,
+                        "messages": messages,
+                        "max_completion_tokens": r.get("max_tokens") or self.client.max_tokens
+                    }
+                }, ensure_ascii=False))
+            input_file = self.client.client.files.create(
+                file=("batch.jsonl", "\n".join(lines).encode("utf-8")),
+                purpose="batch"
+            )
+            batch = self.client.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+            return batch.id
+        except InsufficientCreditsError:
+            raise
+        except Exception as e:
+            if self.client.provider == "claude":
+                check_claude_error(e)
+            else:
+                check_openai_error(e)
+            raise RuntimeError(f"Errore nell'invio del batch: {str(e)}")
+
+    def poll(self, batch_id: str) -> bool:
+        """True quando il batch e' concluso (completato, fallito, scaduto o annullato)."""
+        if self.client.provider == "claude":
+            batch = self.client.client.messages.batches.retrieve(batch_id)
+            return batch.processing_status == "ended"
+
+        batch = self.client.client.batches.retrieve(batch_id)
+        return batch.status in ("completed", "failed", "expired", "cancelled")
+
+    def fetch_results(self, batch_id: str) -> Dict[str, str]:
+        """
+        Testi generati per custom_id. Le richieste fallite non compaiono nel
+        risultato: il chiamante le rigenera con la chiamata diretta.
+        """
+        results = {}
+        if self.client.provider == "claude":
+            for entry in self.client.client.messages.batches.results(batch_id):
+                if entry.result.type == "succeeded":
+                    results[entry.custom_id] = entry.result.message.content[0].text
+            return results
+
+        batch = self.client.client.batches.retrieve(batch_id)
+        if not batch.output_file_id:
+            return results
+        content = self.client.client.files.content(batch.output_file_id).text
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get("response") or {}
+            if response.get("status_code") == 200:
+                results[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        return results
+
+
+@functools.lru_cache(maxsize=None)
+def _get_provider_client(provider: str) -> BaseAIClient:
+    """Crea il client di un provider una sola volta per processo (connessioni HTTP riusate)."""
+    if provider == "claude":
+        return ClaudeClient()
+    return OpenAIClient()
 
 
 def get_ai_client(provider: str = "openai") -> BaseAIClient:
@@ -320,17 +586,8 @@ def get_ai_client(provider: str = "openai") -> BaseAIClient:
     Returns:
         Istanza del client AI appropriato
     """
-    global _openai_client, _claude_client
-
-    if provider == "claude":
-        if _claude_client is None:
-            _claude_client = ClaudeClient()
-        return _claude_client
-    else:
-        # Default: OpenAI
-        if _openai_client is None:
-            _openai_client = OpenAIClient()
-        return _openai_client
+    # Default: OpenAI (qualsiasi provider sconosciuto condivide la stessa istanza)
+    return _get_provider_client("claude" if provider == "claude" else "openai")
 
 
 def get_openai_client() -> OpenAIClient:
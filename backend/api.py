@@ -34,7 +34,8 @@ from claude_client import lettura_pdf
 from helper_calcifer import calcifer, get_contextual_tip
 from auth import get_current_user, get_current_active_user, require_permission
 from auth_routes import router as auth_router
-from thesis_routes import router as thesis_router
+from thesis_routes import router as thesis_router, warm_lookup_cache, resume_thesis_jobs
+from attachment_processor import start_extraction_pool, shutdown_extraction_pool
 from admin_routes import router as admin_router
 from image_enhance_routes import router as image_enhance_router
 from carousel_routes import router as carousel_router
@@ -47,6 +48,7 @@ from ai_exceptions import InsufficientCreditsError
 from credits import estimate_credits, deduct_credits, is_admin_user
 import config
 from pydantic import BaseModel
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
 # Valida configurazione all'avvio
@@ -130,6 +132,21 @@ async def cleanup_old_data():
             await asyncio.sleep(60)
 
 
+async def recover_thesis_jobs():
+    """Task in background che rimette in coda i job di generazione tesi in sospeso."""
+    while True:
+        try:
+            resumed = await asyncio.to_thread(resume_thesis_jobs)
+            if resumed > 0:
+                print(f"Rimessi in coda {resumed} job di generazione tesi")
+
+            await asyncio.sleep(config.THESIS_JOB_SWEEP_SECONDS)
+
+        except Exception as e:
+            print(f"Errore nel recupero job tesi: {e}")
+            await asyncio.sleep(60)
+
+
 @app.on_event("startup")
 async def startup_event():
     """Esegue task all'avvio dell'applicazione."""
@@ -140,13 +157,33 @@ async def startup_event():
     except Exception as e:
         print(f"Avviso: impossibile inizializzare il database: {e}")
 
+    # Pre-carica la cache dei lookup (payload JSON + ETag)
+    try:
+        await asyncio.to_thread(warm_lookup_cache)
+        print("Cache lookup pronta")
+    except Exception as e:
+        print(f"Avviso: impossibile pre-caricare i lookup: {e}")
+
+    # Pool di processi per l'estrazione testo degli allegati, creato subito
+    # (con forkserver, prima che i pool di thread siano attivi)
+    start_extraction_pool()
+
     # Avvia task di cleanup in background
     asyncio.create_task(cleanup_old_data())
+
+    # Riprende i job di generazione tesi interrotti (es. riavvio del server)
+    asyncio.create_task(recover_thesis_jobs())
     print(f"StyleForge API v{config.API_VERSION} avviata")
     print(f"Sessioni attive: {session_manager.get_session_count()}")
     print(f"Job attivi: {job_manager.get_active_jobs_count()}")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Rilascia le risorse allo spegnimento dell'applicazione."""
+    shutdown_extraction_pool()
+
+
 # ============================================================================
 # HEALTH CHECK
 # ============================================================================
@@ -1088,10 +1125,12 @@ async def estimate_api_cost(
             try:
                 from db_models import ThesisAttachment
                 db = next(get_db())
-                attachments = db.query(ThesisAttachment).filter(
+                # Solo la lunghezza dei testi, calcolata dal DB
+                total_chars = db.query(
+                    func.coalesce(func.sum(func.char_length(ThesisAttachment.extracted_text)), 0)
+                ).filter(
                     ThesisAttachment.thesis_id == request.thesis_id
-                ).all()
-                total_chars = sum(len(a.extracted_text or '') for a in attachments)
+                ).scalar()
                 total_chars = min(total_chars, config.THESIS_MAX_CONTEXT_CHARS)
                 attachments_tokens = int(total_chars * 0.4)
                 db.close()
@@ -6,10 +6,15 @@ Questo modulo gestisce l'estrazione del testo da vari formati di file
 """
 
 import os
+import uuid
+import asyncio
+import multiprocessing
+import aiofiles
 import fitz  # PyMuPDF
 from pathlib import Path
 from typing import Optional, List
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 import mimetypes
 
 # Importazione condizionale per python-docx
@@ -26,6 +31,7 @@ import config
 ALLOWED_EXTENSIONS = {'.pdf', '.docx', '.txt'}
 MAX_FILE_SIZE = config.THESIS_MAX_UPLOAD_SIZE  # 50MB default
 MAX_CONTEXT_CHARS = config.THESIS_MAX_CONTEXT_CHARS  # 50000 caratteri default
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1MB per blocco in scrittura
 
 
 def validate_file(filename: str, file_size: int) -> tuple[bool, str]:
@@ -165,7 +171,8 @@ def extract_text(file_path: Path) -> str:
 
 def process_attachment(
     file_path: Path,
-    original_filename: str
+    original_filename: str,
+    file_size: Optional[int] = None
 ) -> dict:
     """
     Processa un allegato e ne estrae il testo.
@@ -173,11 +180,13 @@ def process_attachment(
     Args:
         file_path: Percorso del file salvato
         original_filename: Nome originale del file
+        file_size: Dimensione gia' nota (altrimenti letta dal filesystem)
 
     Returns:
         Dizionario con i metadati dell'allegato e il testo estratto
     """
-    file_size = file_path.stat().st_size
+    if file_size is None:
+        file_size = file_path.stat().st_size
 
     # Valida
     is_valid, error = validate_file(original_filename, file_size)
@@ -198,9 +207,66 @@ def process_attachment(
     }
 
 
+# Pool di processi per l'estrazione testo: il parsing di PDF/DOCX e' CPU-bound
+# e, eseguito nell'event loop, bloccherebbe tutte le altre richieste.
+# I processi non vengono creati con fork: il server ha gia' altri thread
+# attivi (pool dei job, export in asyncio.to_thread) e un fork mentre uno di
+# questi tiene un lock puo' bloccare il processo figlio. Con forkserver (spawn
+# dove non disponibile) i worker partono da un processo pulito.
+_extraction_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _extraction_mp_context():
+    """Contesto multiprocessing senza fork per i worker di estrazione."""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def start_extraction_pool() -> ProcessPoolExecutor:
+    """Crea il pool di processi per l'estrazione (all'avvio dell'applicazione)."""
+    global _extraction_pool
+    if _extraction_pool is None:
+        _extraction_pool = ProcessPoolExecutor(
+            max_workers=config.THESIS_EXTRACTION_WORKERS,
+            mp_context=_extraction_mp_context()
+        )
+    return _extraction_pool
+
+
+def shutdown_extraction_pool() -> None:
+    """Chiude il pool di processi per l'estrazione (allo spegnimento)."""
+    global _extraction_pool
+    if _extraction_pool is not None:
+        _extraction_pool.shutdown(wait=False, cancel_futures=True)
+        _extraction_pool = None
+
+
+def _get_extraction_pool() -> ProcessPoolExecutor:
+    """Pool di processi per l'estrazione (creato qui solo se l'avvio non l'ha fatto)."""
+    return _extraction_pool or start_extraction_pool()
+
+
+async def process_attachment_async(
+    file_path: Path,
+    original_filename: str,
+    file_size: Optional[int] = None
+) -> dict:
+    """Esegue process_attachment in un processo separato, fuori dall'event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _get_extraction_pool(), process_attachment, file_path, original_filename, file_size
+    )
+
+
+def chars_per_attachment(count: int, max_chars: int = MAX_CONTEXT_CHARS) -> int:
+    """Caratteri di testo che ogni allegato puo' occupare nel contesto."""
+    return max_chars // count if count else max_chars
+
+
 def build_attachments_context(
     attachments: List[dict],
-    max_chars: int = MAX_CONTEXT_CHARS
+    max_chars: int = MAX_CONTEXT_CHARS,
+    max_chars_per_doc: Optional[int] = None
 ) -> str:
     """
     Costruisce il contesto dagli allegati per i prompt AI.
@@ -211,6 +277,8 @@ def build_attachments_context(
     Args:
         attachments: Lista di allegati con 'original_filename' e 'extracted_text'
         max_chars: Numero massimo di caratteri totali
+        max_chars_per_doc: Limite per allegato (default: max_chars diviso
+            per il numero di allegati, vedi chars_per_attachment)
 
     Returns:
         Stringa con il contesto formattato
@@ -220,7 +288,8 @@ def build_attachments_context(
 
     context_parts = []
     total_chars = 0
-    chars_per_attachment = max_chars // len(attachments)
+    if max_chars_per_doc is None:
+        max_chars_per_doc = chars_per_attachment(len(attachments), max_chars)
 
     for att in attachments:
         if not att.get('extracted_text'):
@@ -230,21 +299,21 @@ def build_attachments_context(
         filename = att.get('original_filename', 'Allegato')
 
         # Limita il testo di ogni allegato (tronca al confine di frase più vicino)
-        if len(text) > chars_per_attachment:
+        if len(text) > max_chars_per_doc:
             # Cerca l'ultimo punto, esclamativo o interrogativo prima del limite
-            truncated = text[:chars_per_attachment]
+            truncated = text[:max_chars_per_doc]
             last_sentence_end = max(
                 truncated.rfind('. '),
                 truncated.rfind('.\n'),
                 truncated.rfind('! '),
                 truncated.rfind('? ')
             )
-            if last_sentence_end > chars_per_attachment * 0.5:
+            if last_sentence_end > max_chars_per_doc * 0.5:
                 text = truncated[:last_sentence_end + 1] + "\n[...testo troncato...]"
             else:
                 # Fallback: tronca all'ultimo spazio
                 last_space = truncated.rfind(' ')
-                if last_space > chars_per_attachment * 0.8:
+                if last_space > max_chars_per_doc * 0.8:
                     text = truncated[:last_space] + "\n[...testo troncato...]"
                 else:
                     text = truncated + "\n[...testo troncato...]"
@@ -263,38 +332,59 @@ def build_attachments_context(
     return "\n".join(context_parts)
 
 
-def save_uploaded_file(
-    file_content: bytes,
+async def save_uploaded_file(
+    upload,
     original_filename: str,
     thesis_id: str
-) -> Path:
+) -> tuple[Path, int]:
     """
     Salva un file uploadato nella directory appropriata.
 
+    Il contenuto viene copiato a blocchi di UPLOAD_CHUNK_SIZE: la memoria
+    usata non dipende dalla dimensione del file e l'upload si interrompe
+    appena supera MAX_FILE_SIZE.
+
     Args:
-        file_content: Contenuto binario del file
+        upload: File uploadato (UploadFile o oggetto con read() asincrono)
         original_filename: Nome originale del file
         thesis_id: ID della tesi
 
     Returns:
-        Path del file salvato
+        Tupla (path del file salvato, dimensione in bytes)
     """
+    # Dimensione gia' nota dal parser multipart: rifiuta senza scrivere nulla
+    declared_size = getattr(upload, "size", None)
+    if declared_size is not None and declared_size > MAX_FILE_SIZE:
+        max_mb = MAX_FILE_SIZE / (1024 * 1024)
+        raise ValueError(f"File troppo grande. Dimensione massima: {max_mb:.0f}MB")
+
     # Crea directory per la tesi
     thesis_dir = config.THESIS_UPLOADS_DIR / thesis_id
     thesis_dir.mkdir(parents=True, exist_ok=True)
 
-    # Genera nome file unico
+    # Genera nome file unico (il suffisso evita collisioni tra file con lo
+    # stesso nome salvati in parallelo nello stesso secondo)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     safe_filename = "".join(c for c in original_filename if c.isalnum() or c in '._-')
-    filename = f"{timestamp}_{safe_filename}"
+    filename = f"{timestamp}_{uuid.uuid4().hex[:8]}_{safe_filename}"
 
     file_path = thesis_dir / filename
 
     # Salva il file
-    with open(file_path, 'wb') as f:
-        f.write(file_content)
+    file_size = 0
+    async with aiofiles.open(file_path, 'wb') as f:
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            file_size += len(chunk)
+            if file_size > MAX_FILE_SIZE:
+                break
+            await f.write(chunk)
+
+    if file_size > MAX_FILE_SIZE:
+        delete_attachment_file(str(file_path))
+        max_mb = MAX_FILE_SIZE / (1024 * 1024)
+        raise ValueError(f"File troppo grande. Dimensione massima: {max_mb:.0f}MB")
 
-    return file_path
+    return file_path, file_size
 
 
 def delete_attachment_file(file_path: str) -> bool:
@@ -3,6 +3,9 @@ Sistema di autenticazione JWT per StyleForge.
 """
 
 import os
+import threading
+import time
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from typing import Optional
 from uuid import UUID
@@ -12,9 +15,10 @@ from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel, EmailStr
+from sqlalchemy import select
 from sqlalchemy.orm import Session, joinedload
 
-from database import get_db
+from database import SessionLocal, get_db
 from db_models import User, RefreshToken, Role, RolePermission, UserPermission
 from dotenv import load_dotenv
 
@@ -25,6 +29,8 @@ SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-super-secret-key-change-in-produc
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
 REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "7"))
+# Durata (secondi) della cache in-process dello stato utente usata da get_current_authed_user
+AUTH_USER_CACHE_TTL = int(os.getenv("AUTH_USER_CACHE_TTL", "60"))
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -472,6 +478,93 @@ async def get_current_admin_user(
     return current_user
 
 
+# ============================================================================
+# UTENTE AUTENTICATO LEGGERO (CACHE IN-PROCESS)
+# ============================================================================
+
+@dataclass(frozen=True)
+class AuthedUser:
+    """Dati minimi dell'utente autenticato, per le route che usano solo l'id."""
+    id: UUID
+    is_active: bool
+    is_admin: bool
+    role_id: Optional[int] = None
+
+
+# {user_id: (AuthedUser, scadenza time.monotonic())}
+_authed_user_cache: dict = {}
+_authed_user_cache_lock = threading.Lock()
+
+
+def invalidate_authed_user(user_id) -> None:
+    """Rimuove un utente dalla cache (da chiamare quando cambiano stato o ruolo)."""
+    with _authed_user_cache_lock:
+        _authed_user_cache.pop(UUID(str(user_id)), None)
+
+
+def _load_authed_user(user_id: UUID) -> Optional[AuthedUser]:
+    """Legge dal DB solo le colonne necessarie all'autorizzazione."""
+    db = SessionLocal()
+    try:
+        row = db.execute(
+            select(User.id, User.is_active, User.is_admin, User.role_id)
+            .where(User.id == user_id)
+        ).first()
+    finally:
+        db.close()
+    return AuthedUser(*row) if row else None
+
+
+async def get_current_authed_user(
+    token: str = Depends(oauth2_scheme)
+) -> AuthedUser:
+    """
+    Dependency leggera per le route che necessitano solo dell'id utente.
+
+    Lo stato dell'utente viene riletto dal DB al massimo ogni AUTH_USER_CACHE_TTL
+    secondi: una disabilitazione diventa effettiva entro quel limite (subito se
+    passa da invalidate_authed_user). Le route che modificano l'utente (crediti,
+    profilo) devono continuare a usare get_current_active_user.
+    """
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Credenziali non valide",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+    token_data = decode_token(token)
+    if token_data is None or token_data.user_id is None:
+        raise credentials_exception
+
+    try:
+        user_id = UUID(token_data.user_id)
+    except ValueError:
+        raise credentials_exception
+
+    now = time.monotonic()
+    with _authed_user_cache_lock:
+        cached = _authed_user_cache.get(user_id)
+
+    if cached is not None and cached[1] > now:
+        user = cached[0]
+    else:
+        user = _load_authed_user(user_id)
+        if user is None:
+            with _authed_user_cache_lock:
+                _authed_user_cache.pop(user_id, None)
+            raise credentials_exception
+        with _authed_user_cache_lock:
+            _authed_user_cache[user_id] = (user, now + AUTH_USER_CACHE_TTL)
+
+    if not user.is_active:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Utente disabilitato"
+        )
+
+    return user
+
+
 # ============================================================================
 # OPTIONAL AUTH DEPENDENCY
 # ============================================================================
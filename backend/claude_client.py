@@ -11,6 +11,7 @@ nella conversazione per simulare un comportamento simile.
 
 import os
 import re
+import functools
 import random
 import fitz
 from datetime import datetime
@@ -27,6 +28,15 @@ MAX_TOKENS_TEST = 8192
 
 API_KEY = os.getenv("ANTHROPIC_API_KEY")
 
+
+@functools.lru_cache(maxsize=1)
+def get_anthropic_client() -> Anthropic:
+    """
+    Client Anthropic condiviso da tutte le sessioni (thread-safe): ogni sessione
+    mantiene la propria conversazione ma riusa lo stesso pool di connessioni.
+    """
+    return Anthropic(api_key=API_KEY)
+
 def lettura_pdf(file_path: str, max_pagine: int = 50) -> str:
     doc = fitz.open(file_path)
     testo = ""
@@ -49,7 +59,7 @@ class ClaudeClient:
         Inizializza il client Claude.
         """
 
-        self.client = Anthropic(api_key=API_KEY)
+        self.client = get_anthropic_client()
         self.conversation_history: list[dict] = []
         self.system_prompt: str = """
             Sei un redattore. Riceverai fonti in allegato. 
@@ -60,6 +60,47 @@ THESIS_ALLOWED_EXTENSIONS = {".pdf", ".docx", ".txt"}
 THESIS_MAX_UPLOAD_SIZE = int(os.getenv("THESIS_MAX_UPLOAD_SIZE", "50")) * 1024 * 1024  # 50MB
 THESIS_MAX_ATTACHMENTS = int(os.getenv("THESIS_MAX_ATTACHMENTS", "10"))
 THESIS_MAX_CONTEXT_CHARS = int(os.getenv("THESIS_MAX_CONTEXT_CHARS", "50000"))
+# Processi dedicati all'estrazione del testo dagli allegati (PDF/DOCX)
+THESIS_EXTRACTION_WORKERS = int(os.getenv("THESIS_EXTRACTION_WORKERS", "2"))
+# Chiamate AI indipendenti eseguite in parallelo durante la generazione tesi
+THESIS_LLM_CONCURRENCY = int(os.getenv("THESIS_LLM_CONCURRENCY", "5"))
+# Continuazione delle sezioni troppo corte: soglia (frazione del target di
+# parole) sotto cui si chiede di continuare e numero massimo di richieste extra
+THESIS_MIN_WORDS_RATIO = float(os.getenv("THESIS_MIN_WORDS_RATIO", "0.7"))
+THESIS_MAX_CONTINUATIONS = int(os.getenv("THESIS_MAX_CONTINUATIONS", "2"))
+# Durata (secondi) della cache in memoria delle tabelle di lookup
+THESIS_LOOKUP_CACHE_TTL = int(os.getenv("THESIS_LOOKUP_CACHE_TTL", "600"))
+# Coda dei job di generazione tesi (thesis_generation_jobs): thread dedicati,
+# minuti senza heartbeat oltre i quali un job 'processing' e' considerato
+# orfano e intervallo (secondi) del controllo periodico
+THESIS_TASK_WORKERS = int(os.getenv("THESIS_TASK_WORKERS", "4"))
+# Thread per provider AI (ognuno ha il proprio pool; default THESIS_TASK_WORKERS)
+THESIS_TASK_WORKERS_OPENAI = int(os.getenv("THESIS_TASK_WORKERS_OPENAI", str(THESIS_TASK_WORKERS)))
+THESIS_TASK_WORKERS_CLAUDE = int(os.getenv("THESIS_TASK_WORKERS_CLAUDE", str(THESIS_TASK_WORKERS)))
+THESIS_JOB_STALE_MINUTES = int(os.getenv("THESIS_JOB_STALE_MINUTES", "30"))
+THESIS_JOB_SWEEP_SECONDS = int(os.getenv("THESIS_JOB_SWEEP_SECONDS", "300"))
+# Intervallo (secondi) con cui il worker rinnova il lease del job in corso e
+# numero massimo di prese in carico di un job (poi viene segnato come fallito)
+THESIS_JOB_HEARTBEAT_SECONDS = int(os.getenv("THESIS_JOB_HEARTBEAT_SECONDS", "60"))
+THESIS_JOB_MAX_ATTEMPTS = int(os.getenv("THESIS_JOB_MAX_ATTEMPTS", "3"))
+# Generazione contenuti via Batch API del provider (costo dimezzato, risposta
+# entro 24 ore): attivabile per le tesi senza urgenza di consegna. Intervallo
+# (secondi) di controllo dello stato e attesa massima (ore) prima di ripiegare
+# sulle chiamate dirette
+THESIS_CONTENT_BATCH_API = os.getenv("THESIS_CONTENT_BATCH_API", "false").lower() == "true"
+THESIS_BATCH_POLL_SECONDS = int(os.getenv("THESIS_BATCH_POLL_SECONDS", "60"))
+THESIS_BATCH_MAX_HOURS = int(os.getenv("THESIS_BATCH_MAX_HOURS", "24"))
+# Genera in parallelo le sezioni di tutti i capitoli (non solo di un capitolo
+# alla volta): piu' veloce, ma le sezioni non ricevono il riassunto dei
+# capitoli precedenti
+THESIS_CONTENT_PARALLEL_CHAPTERS = os.getenv("THESIS_CONTENT_PARALLEL_CHAPTERS", "false").lower() == "true"
+# Avanzamento della generazione contenuto scritto su DB ogni N sezioni o ogni
+# tot secondi (il primo limite raggiunto), invece che con un commit per sezione
+THESIS_PROGRESS_FLUSH_SECTIONS = int(os.getenv("THESIS_PROGRESS_FLUSH_SECTIONS", "5"))
+THESIS_PROGRESS_FLUSH_SECONDS = float(os.getenv("THESIS_PROGRESS_FLUSH_SECONDS", "10"))
+# Archivia una copia di ogni export in RESULTS_DIR (di default i file vengono
+# serializzati in memoria e inviati direttamente, senza passare dal disco)
+THESIS_PERSIST_EXPORTS = os.getenv("THESIS_PERSIST_EXPORTS", "false").lower() == "true"
 
 # Configurazione Prompt
 PROMPT_ADDESTRAMENTO_PATH = Path(os.getenv("PROMPT_ADDESTRAMENTO_PATH", "prompt_addestramento.txt"))
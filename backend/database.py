@@ -6,6 +6,7 @@ La connessione avviene tramite la connection string di Supabase.
 """
 
 import os
+import uuid
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -25,11 +26,10 @@ DATABASE_URL = os.getenv(
 
 # URL asincrono per asyncpg (Supabase)
 # Supabase supporta sia connessioni dirette che pooled
-# Per asyncpg, usa la porta 5432 (connessione diretta) invece di 6543 (pooler)
 ASYNC_DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://")
 
-# Se usi Supabase con pooler (porta 6543), potresti dover usare la connessione diretta per async
-# In tal caso, imposta DATABASE_URL_DIRECT nel .env per la connessione asincrona
+# Con il pooler (porta 6543) l'engine asincrono disattiva gli statement
+# preparati in cache (vedi _ASYNC_CONNECT_ARGS)
 
 # Engine sincrono (per Alembic e operazioni sincrone)
 # Usa NullPool per Supabase per evitare problemi con il connection pooling
@@ -37,24 +37,44 @@ ASYNC_DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg:/
 # Se usi connessione diretta (porta 5432), usa il pool locale.
 _use_supabase_pooler = ":6543/" in DATABASE_URL
 
+# Dimensionamento del pool locale (connessione diretta), uguale per i due engine.
+# LIFO: sotto carico basso si riusano sempre le stesse poche connessioni e le
+# altre scadono (pool_recycle) invece di restare tutte aperte a turno.
+_POOL_OPTIONS = {"poolclass": NullPool} if _use_supabase_pooler else {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", "10")),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "20")),
+    "pool_timeout": 30,
+    "pool_recycle": 1800,
+    "pool_use_lifo": True,
+}
+
 engine = create_engine(
     DATABASE_URL,
     echo=False,
     pool_pre_ping=True,
-    **({"poolclass": NullPool} if _use_supabase_pooler else {
-        "pool_size": 10,
-        "max_overflow": 20,
-        "pool_timeout": 30,
-        "pool_recycle": 1800,
-    })
+    # Cache delle query compilate (select() con parametri bound): le stesse
+    # query dei router non vengono ricompilate a ogni richiesta
+    query_cache_size=1200,
+    **_POOL_OPTIONS
 )
 
-# Engine asincrono (per FastAPI)
+# Con il transaction pooler (pgbouncer) ogni transazione puo' finire su una
+# connessione server diversa: gli statement preparati di asyncpg non esistono
+# li' o collidono per nome. Cache disattivate e nomi univoci per statement.
+_ASYNC_CONNECT_ARGS = {
+    "statement_cache_size": 0,
+    "prepared_statement_cache_size": 0,
+    "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__",
+} if _use_supabase_pooler else {}
+
+# Engine asincrono (per FastAPI): con connessione diretta usa anch'esso il
+# pool invece di aprire una connessione asyncpg nuova a ogni richiesta
 async_engine = create_async_engine(
     ASYNC_DATABASE_URL,
     echo=False,
     pool_pre_ping=True,
-    poolclass=NullPool
+    connect_args=_ASYNC_CONNECT_ARGS,
+    **_POOL_OPTIONS
 )
 
 # Session Factory sincrona
@@ -4,8 +4,8 @@ Modelli SQLAlchemy per il database.
 
 import uuid
 from datetime import datetime
-from sqlalchemy import Column, String, Integer, Boolean, DateTime, Text, ForeignKey, Enum as SQLEnum, BigInteger, DECIMAL, ARRAY
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, String, Integer, Boolean, DateTime, Text, ForeignKey, Enum as SQLEnum, BigInteger, DECIMAL, ARRAY, Index
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.dialects.postgresql import UUID, ENUM as PG_ENUM, JSONB
 from database import Base
 from models import JobStatus, JobType
@@ -536,7 +536,8 @@ class ThesisAttachment(Base):
     file_path = Column(Text, nullable=False)
     file_size = Column(BigInteger, nullable=True)
     mime_type = Column(String(100), nullable=True)
-    extracted_text = Column(Text, nullable=True)
+    # Testo completo (anche centinaia di KB): caricato solo se richiesto esplicitamente
+    extracted_text = deferred(Column(Text, nullable=True))
     created_at = Column(DateTime, default=datetime.utcnow)
 
     # Relazioni
@@ -568,12 +569,22 @@ class ThesisGenerationJob(Base):
     status = Column(String(50), default='pending')
     result = Column(Text, nullable=True)
     error = Column(Text, nullable=True)
+    # Lease del worker che esegue il job (vedi migrations/20)
+    lease_token = Column(UUID(as_uuid=True), nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
     created_at = Column(DateTime, default=datetime.utcnow)
     completed_at = Column(DateTime, nullable=True)
 
     # Relazioni
     thesis = relationship("Thesis", back_populates="generation_jobs")
 
+    # Lookup dell'ultimo job per (tesi, fase): vedi migrations/17
+    __table_args__ = (
+        Index('idx_thesis_generation_jobs_thesis_phase_created', 'thesis_id', 'phase', created_at.desc()),
+    )
+
     def __repr__(self):
         return f"<ThesisGenerationJob(id={self.id}, phase={self.phase}, status={self.status})>"
 
@@ -590,6 +601,35 @@ class ThesisGenerationJob(Base):
         }
 
 
+class ThesisContentChunk(Base):
+    """
+    Sezione di una tesi salvata durante la generazione del contenuto.
+
+    Le righe vengono scritte man mano che le sezioni sono pronte (lettura
+    parziale, ripresa del job dopo un crash) ed eliminate quando il testo
+    completo viene salvato in theses.generated_content.
+    """
+    __tablename__ = "thesis_content_chunks"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    thesis_id = Column(UUID(as_uuid=True), ForeignKey("theses.id", ondelete="CASCADE"), nullable=False)
+    position = Column(Integer, nullable=False)  # Ordine nel documento
+    chapter_index = Column(Integer, nullable=False)
+    section_index = Column(Integer, nullable=False)
+    content = Column(Text, nullable=False)  # Testo umanizzato
+    raw_content = deferred(Column(Text, nullable=True))  # Testo con citazioni [x] intatte
+    word_count = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('idx_thesis_content_chunks_thesis_position', 'thesis_id', 'position'),
+        Index('idx_thesis_content_chunks_thesis_section', 'thesis_id', 'chapter_index', 'section_index', unique=True),
+    )
+
+    def __repr__(self):
+        return f"<ThesisContentChunk(thesis_id={self.thesis_id}, position={self.position})>"
+
+
 # ============================================================================
 # COMPILATIO SCANS
 # ============================================================================
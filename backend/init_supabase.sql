@@ -385,7 +385,7 @@ CREATE TABLE IF NOT EXISTS theses (
     chapters_structure JSONB,
 
     -- Contenuto generato
-    generated_content TEXT,
+    generated_content TEXT COMPRESSION lz4,
 
     -- Stato e metadati
     status thesis_status DEFAULT 'draft',
@@ -424,10 +424,27 @@ CREATE TABLE IF NOT EXISTS thesis_generation_jobs (
     status VARCHAR(50) DEFAULT 'pending',
     result TEXT,
     error TEXT,
+    lease_token UUID,
+    heartbeat_at TIMESTAMP WITH TIME ZONE,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     completed_at TIMESTAMP WITH TIME ZONE
 );
 
+-- Sezioni salvate durante la generazione del contenuto (eliminate a fine generazione)
+CREATE TABLE IF NOT EXISTS thesis_content_chunks (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    thesis_id UUID NOT NULL REFERENCES theses(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    chapter_index INTEGER NOT NULL,
+    section_index INTEGER NOT NULL,
+    content TEXT COMPRESSION lz4 NOT NULL,
+    raw_content TEXT COMPRESSION lz4,
+    word_count INTEGER DEFAULT 0,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
 -- ============================================
 -- INDEXES per Thesis Tables
 -- ============================================
@@ -436,8 +453,14 @@ CREATE INDEX IF NOT EXISTS idx_theses_user_id ON theses(user_id);
 CREATE INDEX IF NOT EXISTS idx_theses_status ON theses(status);
 CREATE INDEX IF NOT EXISTS idx_theses_created_at ON theses(created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_thesis_attachments_thesis_id ON thesis_attachments(thesis_id);
+CREATE INDEX IF NOT EXISTS idx_theses_user_created ON theses(user_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_theses_user_status_created ON theses(user_id, status, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_thesis_attachments_thesis_created ON thesis_attachments(thesis_id, created_at);
 CREATE INDEX IF NOT EXISTS idx_thesis_generation_jobs_thesis_id ON thesis_generation_jobs(thesis_id);
 CREATE INDEX IF NOT EXISTS idx_thesis_generation_jobs_job_id ON thesis_generation_jobs(job_id);
+CREATE INDEX IF NOT EXISTS idx_thesis_generation_jobs_thesis_phase_created ON thesis_generation_jobs(thesis_id, phase, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_thesis_content_chunks_thesis_position ON thesis_content_chunks(thesis_id, position);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_thesis_content_chunks_thesis_section ON thesis_content_chunks(thesis_id, chapter_index, section_index);
 
 -- Trigger per theses.updated_at
 CREATE TRIGGER update_theses_updated_at
@@ -454,7 +477,7 @@ DO $$
 BEGIN
     RAISE NOTICE 'Schema creato con successo!';
     RAISE NOTICE 'Tabelle create: users, sessions, jobs, refresh_tokens';
-    RAISE NOTICE 'Tabelle thesis: theses, thesis_attachments, thesis_generation_jobs';
+    RAISE NOTICE 'Tabelle thesis: theses, thesis_attachments, thesis_generation_jobs, thesis_content_chunks';
     RAISE NOTICE 'Tabelle lookup: writing_styles, content_depth_levels, audience_knowledge_levels, audience_sizes, industries, target_audiences';
     RAISE NOTICE 'Enum types: job_status, job_type, thesis_status';
 END $$;
@@ -0,0 +1,21 @@
+-- ============================================================================
+-- 16: Indici composti per le query calde su tesi e allegati
+-- ============================================================================
+-- list_theses filtra per user_id (e opzionalmente status) e ordina per
+-- (created_at DESC, id DESC): con questi indici Postgres legge le righe gia'
+-- ordinate, senza nodo Sort. list_attachments filtra per thesis_id e ordina
+-- per created_at.
+--
+-- CONCURRENTLY non blocca le scritture ma non puo' girare dentro una
+-- transazione: eseguire gli statement uno alla volta (non in un blocco BEGIN).
+-- Verifica: EXPLAIN ANALYZE della query di list_theses deve mostrare un
+-- Index Scan su idx_theses_user_created senza Sort.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_theses_user_created
+    ON theses(user_id, created_at DESC, id DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_theses_user_status_created
+    ON theses(user_id, status, created_at DESC, id DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_thesis_attachments_thesis_created
+    ON thesis_attachments(thesis_id, created_at);
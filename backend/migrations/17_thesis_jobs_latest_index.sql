@@ -0,0 +1,12 @@
+-- ============================================================================
+-- 17: Indice composto per l'ultimo job di generazione per (tesi, fase)
+-- ============================================================================
+-- I task di generazione e gli handler di errore cercano l'ultimo job di una
+-- fase con WHERE thesis_id = ? AND phase = ? ORDER BY created_at DESC LIMIT 1:
+-- con questo indice Postgres legge direttamente la prima voce, senza Sort.
+--
+-- CONCURRENTLY non blocca le scritture ma non puo' girare dentro una
+-- transazione: eseguire lo statement da solo (non in un blocco BEGIN).
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_thesis_generation_jobs_thesis_phase_created
+    ON thesis_generation_jobs(thesis_id, phase, created_at DESC);
@@ -0,0 +1,22 @@
+-- ============================================================================
+-- 18: Sezioni della tesi salvate durante la generazione del contenuto
+-- ============================================================================
+-- generate_content_task scrive ogni sezione pronta in thesis_content_chunks
+-- (insieme all'avanzamento), invece di tenere tutto in memoria fino al salvato
+-- finale di theses.generated_content. Un job ripreso dopo un riavvio riusa le
+-- sezioni gia' scritte; le righe vengono eliminate a generazione completata.
+
+CREATE TABLE IF NOT EXISTS thesis_content_chunks (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    thesis_id UUID NOT NULL REFERENCES theses(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    chapter_index INTEGER NOT NULL,
+    section_index INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    raw_content TEXT,
+    word_count INTEGER DEFAULT 0,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_thesis_content_chunks_thesis_position
+    ON thesis_content_chunks(thesis_id, position);
@@ -0,0 +1,14 @@
+-- ============================================================================
+-- 19: Compressione lz4 per i testi generati delle tesi
+-- ============================================================================
+-- generated_content e i chunk di contenuto sono testo lungo e molto
+-- comprimibile. Postgres (14+) li comprime gia' in TOAST oltre i ~2 KB, ma con
+-- pglz: lz4 comprime e decomprime molto piu' in fretta a parita' di spazio,
+-- quindi export e letture del dettaglio pagano meno CPU e I/O.
+--
+-- SET COMPRESSION vale per i valori scritti da qui in poi (i valori esistenti
+-- restano pglz finche' non vengono riscritti) e non riscrive la tabella.
+
+ALTER TABLE theses ALTER COLUMN generated_content SET COMPRESSION lz4;
+ALTER TABLE thesis_content_chunks ALTER COLUMN content SET COMPRESSION lz4;
+ALTER TABLE thesis_content_chunks ALTER COLUMN raw_content SET COMPRESSION lz4;
@@ -0,0 +1,28 @@
+-- ============================================================================
+-- 20: Lease e tentativi dei job di generazione, sezioni univoche
+-- ============================================================================
+-- Un job 'processing' e' considerato orfano solo quando il worker che lo ha
+-- preso smette di rinnovare heartbeat_at (thread di heartbeat dedicato), non
+-- quando la tesi non avanza: una sezione lenta non fa piu' ripartire il job su
+-- un secondo worker. lease_token identifica il worker proprietario: chi l'ha
+-- perso non scrive piu' nulla. attempts conta le prese in carico; oltre
+-- max_attempts il job viene segnato come fallito invece di ripartire.
+--
+-- L'indice univoco su (tesi, capitolo, sezione) impedisce sezioni duplicate
+-- (prima di crearlo si tiene solo la riga piu' vecchia di ogni sezione).
+
+ALTER TABLE thesis_generation_jobs
+    ADD COLUMN IF NOT EXISTS lease_token UUID,
+    ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP WITH TIME ZONE,
+    ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS max_attempts INTEGER NOT NULL DEFAULT 3;
+
+DELETE FROM thesis_content_chunks a
+    USING thesis_content_chunks b
+    WHERE a.thesis_id = b.thesis_id
+      AND a.chapter_index = b.chapter_index
+      AND a.section_index = b.section_index
+      AND (a.created_at, a.id) > (b.created_at, b.id);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_thesis_content_chunks_thesis_section
+    ON thesis_content_chunks(thesis_id, chapter_index, section_index);
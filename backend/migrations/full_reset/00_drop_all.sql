@@ -15,6 +15,7 @@ END $$;
 DROP TABLE IF EXISTS credit_transactions CASCADE;
 DROP TABLE IF EXISTS user_permissions CASCADE;
 DROP TABLE IF EXISTS role_permissions CASCADE;
+DROP TABLE IF EXISTS thesis_content_chunks CASCADE;
 DROP TABLE IF EXISTS thesis_generation_jobs CASCADE;
 DROP TABLE IF EXISTS thesis_attachments CASCADE;
 DROP TABLE IF EXISTS theses CASCADE;
@@ -21,7 +21,7 @@ CREATE TABLE theses (
     ai_provider VARCHAR(20) DEFAULT 'openai',
     citation_style VARCHAR(20) DEFAULT 'footnotes',
     chapters_structure JSONB,
-    generated_content TEXT,
+    generated_content TEXT COMPRESSION lz4,
     status thesis_status DEFAULT 'draft',
     current_phase INTEGER DEFAULT 0,
     generation_progress INTEGER DEFAULT 0,
@@ -52,6 +52,23 @@ CREATE TABLE thesis_generation_jobs (
     status VARCHAR(50) DEFAULT 'pending',
     result TEXT,
     error TEXT,
+    lease_token UUID,
+    heartbeat_at TIMESTAMP WITH TIME ZONE,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     completed_at TIMESTAMP WITH TIME ZONE
 );
+
+-- Sezioni salvate durante la generazione del contenuto (eliminate a fine generazione)
+CREATE TABLE thesis_content_chunks (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    thesis_id UUID NOT NULL REFERENCES theses(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    chapter_index INTEGER NOT NULL,
+    section_index INTEGER NOT NULL,
+    content TEXT COMPRESSION lz4 NOT NULL,
+    raw_content TEXT COMPRESSION lz4,
+    word_count INTEGER DEFAULT 0,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
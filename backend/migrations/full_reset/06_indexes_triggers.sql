@@ -38,8 +38,14 @@ CREATE INDEX idx_theses_user_id ON theses(user_id);
 CREATE INDEX idx_theses_status ON theses(status);
 CREATE INDEX idx_theses_created_at ON theses(created_at DESC);
 CREATE INDEX idx_thesis_attachments_thesis_id ON thesis_attachments(thesis_id);
+CREATE INDEX idx_theses_user_created ON theses(user_id, created_at DESC, id DESC);
+CREATE INDEX idx_theses_user_status_created ON theses(user_id, status, created_at DESC, id DESC);
+CREATE INDEX idx_thesis_attachments_thesis_created ON thesis_attachments(thesis_id, created_at);
 CREATE INDEX idx_thesis_generation_jobs_thesis_id ON thesis_generation_jobs(thesis_id);
 CREATE INDEX idx_thesis_generation_jobs_job_id ON thesis_generation_jobs(job_id);
+CREATE INDEX idx_thesis_generation_jobs_thesis_phase_created ON thesis_generation_jobs(thesis_id, phase, created_at DESC);
+CREATE INDEX idx_thesis_content_chunks_thesis_position ON thesis_content_chunks(thesis_id, position);
+CREATE UNIQUE INDEX idx_thesis_content_chunks_thesis_section ON thesis_content_chunks(thesis_id, chapter_index, section_index);
 
 -- Trigger function
 CREATE OR REPLACE FUNCTION update_updated_at_column()
@@ -341,6 +341,7 @@ class ThesisListResponse(BaseModel):
     """Lista delle tesi dell'utente."""
     theses: List[ThesisResponse]
     total: int
+    next_cursor: Optional[str] = None  # presente se ci sono altre pagine
 
 
 class ThesisAttachmentResponse(BaseModel):
@@ -488,6 +489,15 @@ class GenerationStatusResponse(BaseModel):
     estimated_time_remaining: Optional[int] = None  # secondi
 
 
+class PartialContentResponse(BaseModel):
+    """Response con il contenuto delle sezioni gia' generate."""
+    thesis_id: str
+    status: ThesisStatus
+    completed_sections: int
+    total_sections: int
+    content: str
+
+
 # ============================================================================
 # CREDITS & PERMISSIONS MODELS
 # ============================================================================
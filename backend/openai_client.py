@@ -51,7 +51,8 @@ class OpenAIThinkingClient:
         self,
         prompt: str,
         max_tokens: Optional[int] = None,
-        temperature: float = 1.0
+        temperature: float = 1.0,
+        system: Optional[str] = None
     ) -> str:
         """
         Genera una risposta utilizzando il modello di reasoning.
@@ -63,19 +64,24 @@ class OpenAIThinkingClient:
             prompt: Il prompt da inviare al modello
             max_tokens: Numero massimo di token (default: 16000)
             temperature: Temperatura per la generazione (default: 1.0)
+            system: System prompt statico opzionale (inviato per primo)
 
         Returns:
             La risposta generata dal modello
         """
+        messages = [
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+        if system:
+            messages.insert(0, {"role": "system", "content": system})
+
         try:
             response = self.client.chat.completions.create(
                 model=self.model_id,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
+                messages=messages,
                 max_completion_tokens=max_tokens or self.max_tokens
             )
 
@@ -201,7 +207,7 @@ class OpenAIThinkingClient:
         Returns:
             Contenuto testuale della sezione
         """
-        from thesis_prompts import build_section_content_prompt
+        from thesis_prompts import build_section_content_prompt, get_section_content_system_prompt
 
         prompt = build_section_content_prompt(
             thesis_data=thesis_data,
@@ -212,7 +218,8 @@ class OpenAIThinkingClient:
             author_style_context=author_style_context
         )
 
-        return self.generate_with_thinking(prompt)
+        system = get_section_content_system_prompt(thesis_data.get('citation_style', 'footnotes'))
+        return self.generate_with_thinking(prompt, system=system)
 
 
 # Singleton per riutilizzare la connessione
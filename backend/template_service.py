@@ -4,9 +4,12 @@ Gestisce CRUD template, parametri help e applicazione a PDF/DOCX.
 """
 
 import copy
+import functools
+import json
 import logging
-import uuid
+import os
 from datetime import datetime
+from pathlib import Path
 from typing import Optional
 
 from sqlalchemy.orm import Session
@@ -94,395 +97,40 @@ DEFAULT_EXPORT_TEMPLATES = {
 # HELP / TOOLTIP PER OGNI PARAMETRO
 # ============================================================================
 
-TEMPLATE_PARAM_HELP = {
-    "pdf": {
-        "page_size": {
-            "label": "Formato pagina",
-            "description": "Dimensione fisica della pagina del documento PDF.",
-            "type": "select",
-            "options": ["A4", "Letter", "A5"],
-            "default": "A4",
-            "example": "A4 = 210x297mm (standard europeo e accademico). Letter = 216x279mm (standard USA). A5 = 148x210mm (formato piccolo)."
-        },
-        "margin_top": {
-            "label": "Margine superiore",
-            "description": "Spazio vuoto tra il bordo superiore della pagina e l'inizio del contenuto.",
-            "type": "number",
-            "min": 20, "max": 150, "default": 50, "unit": "pt",
-            "example": "50pt = circa 1.76cm. Per tesi accademiche si consiglia 60-72pt (2-2.5cm). Margini piu' ampi danno un aspetto piu' pulito."
-        },
-        "margin_bottom": {
-            "label": "Margine inferiore",
-            "description": "Spazio vuoto tra la fine del contenuto e il bordo inferiore della pagina.",
-            "type": "number",
-            "min": 20, "max": 150, "default": 50, "unit": "pt",
-            "example": "50pt = circa 1.76cm. Aumentare se si usano numeri di pagina o pie' di pagina."
-        },
-        "margin_left": {
-            "label": "Margine sinistro",
-            "description": "Spazio vuoto sul lato sinistro della pagina.",
-            "type": "number",
-            "min": 20, "max": 150, "default": 50, "unit": "pt",
-            "example": "Per documenti rilegati, usare 72-85pt (2.5-3cm) per lasciare spazio alla rilegatura."
-        },
-        "margin_right": {
-            "label": "Margine destro",
-            "description": "Spazio vuoto sul lato destro della pagina.",
-            "type": "number",
-            "min": 20, "max": 150, "default": 50, "unit": "pt",
-            "example": "50pt = circa 1.76cm. Di solito uguale o leggermente piu' piccolo del margine sinistro."
-        },
-        "font_body": {
-            "label": "Font corpo testo",
-            "description": "Il carattere tipografico usato per il testo principale del documento.",
-            "type": "select",
-            "options": ["helv", "tiro", "cour"],
-            "default": "helv",
-            "example": "helv = Helvetica (sans-serif, moderno e pulito). tiro = Times (serif, classico accademico). cour = Courier (monospazio, stile macchina da scrivere)."
-        },
-        "font_body_size": {
-            "label": "Dimensione font corpo",
-            "description": "La grandezza del testo principale in punti tipografici.",
-            "type": "number",
-            "min": 8, "max": 16, "default": 11, "unit": "pt",
-            "example": "11pt e' lo standard per documenti professionali. 12pt per tesi accademiche. 10pt per documenti compatti."
-        },
-        "font_title_size": {
-            "label": "Dimensione font titolo",
-            "description": "La grandezza del titolo principale della tesi sulla prima pagina.",
-            "type": "number",
-            "min": 14, "max": 36, "default": 24, "unit": "pt",
-            "example": "24pt per un titolo ben visibile. 20pt per un look piu' sobrio. 28pt per massimo impatto."
-        },
-        "font_chapter_size": {
-            "label": "Dimensione font capitoli",
-            "description": "La grandezza dei titoli dei capitoli (es. 'Capitolo 1: Introduzione').",
-            "type": "number",
-            "min": 12, "max": 28, "default": 18, "unit": "pt",
-            "example": "18pt crea una buona gerarchia visiva. Deve essere piu' grande delle sezioni ma piu' piccolo del titolo."
-        },
-        "font_section_size": {
-            "label": "Dimensione font sezioni",
-            "description": "La grandezza dei titoli delle sezioni all'interno dei capitoli.",
-            "type": "number",
-            "min": 10, "max": 22, "default": 14, "unit": "pt",
-            "example": "14pt distingue chiaramente le sezioni dal corpo testo (11pt). Per documenti accademici, 13-14pt e' ideale."
-        },
-        "line_height_multiplier": {
-            "label": "Interlinea",
-            "description": "Moltiplicatore dello spazio tra le righe di testo. 1.0 = singola, 1.5 = una e mezza, 2.0 = doppia.",
-            "type": "number",
-            "min": 1.0, "max": 3.0, "default": 1.5, "step": 0.1,
-            "example": "1.5 e' lo standard per documenti leggibili. 2.0 (doppia interlinea) e' richiesto da molte universita'. 1.15 per documenti compatti."
-        },
-        "include_toc": {
-            "label": "Includere indice",
-            "description": "Se attivo, inserisce automaticamente un indice (sommario) all'inizio del documento con tutti i capitoli e le sezioni.",
-            "type": "boolean",
-            "default": True,
-            "example": "L'indice viene generato automaticamente dalla struttura dei capitoli e delle sezioni della tesi."
-        },
-        "include_page_numbers": {
-            "label": "Numeri di pagina",
-            "description": "Se attivo, aggiunge il numero di pagina su ogni pagina del documento.",
-            "type": "boolean",
-            "default": True,
-            "example": "I numeri di pagina facilitano la navigazione del documento e sono richiesti nella maggior parte dei contesti accademici."
-        },
-        "page_number_position": {
-            "label": "Posizione numeri pagina",
-            "description": "Dove posizionare il numero di pagina sulla pagina.",
-            "type": "select",
-            "options": ["bottom_center", "bottom_right", "top_center", "top_right"],
-            "default": "bottom_center",
-            "example": "bottom_center = centrato in basso (standard). bottom_right = in basso a destra. top_right = in alto a destra (stile articolo)."
-        },
-        "include_header": {
-            "label": "Intestazione pagina",
-            "description": "Se attivo, aggiunge un testo fisso nell'intestazione (parte superiore) di ogni pagina.",
-            "type": "boolean",
-            "default": False,
-            "example": "L'intestazione puo' contenere il titolo della tesi abbreviato o il nome dell'autore."
-        },
-        "header_text": {
-            "label": "Testo intestazione",
-            "description": "Il testo che appare nell'intestazione di ogni pagina. Visibile solo se 'Intestazione pagina' e' attivo.",
-            "type": "text",
-            "default": "",
-            "example": "Esempio: 'Tesi di Laurea - Nome Autore' oppure 'Capitolo corrente'."
-        },
-        "include_footer": {
-            "label": "Pie' di pagina",
-            "description": "Se attivo, aggiunge un testo fisso nel pie' di pagina (parte inferiore) di ogni pagina.",
-            "type": "boolean",
-            "default": False,
-            "example": "Il pie' di pagina puo' contenere informazioni come l'universita', il dipartimento o la data."
-        },
-        "footer_text": {
-            "label": "Testo pie' di pagina",
-            "description": "Il testo che appare nel pie' di pagina di ogni pagina. Visibile solo se 'Pie' di pagina' e' attivo.",
-            "type": "text",
-            "default": "",
-            "example": "Esempio: 'Universita' degli Studi di Roma - A.A. 2024/2025'."
-        },
-        "title_alignment": {
-            "label": "Allineamento titolo",
-            "description": "Come viene allineato il titolo principale sulla pagina.",
-            "type": "select",
-            "options": ["left", "center", "right"],
-            "default": "center",
-            "example": "center = centrato (standard accademico). left = allineato a sinistra (stile moderno). right = allineato a destra (raro)."
-        },
-        "body_alignment": {
-            "label": "Allineamento testo",
-            "description": "Come viene allineato il testo del corpo del documento.",
-            "type": "select",
-            "options": ["left", "center", "right", "justify"],
-            "default": "left",
-            "example": "left = allineato a sinistra (piu' leggibile). justify = giustificato (aspetto professionale, standard nelle tesi). center = centrato (solo per testi brevi)."
-        },
-        "chapter_spacing_before": {
-            "label": "Spazio prima capitolo",
-            "description": "Spazio verticale aggiunto prima dell'inizio di ogni nuovo capitolo.",
-            "type": "number",
-            "min": 0, "max": 60, "default": 20, "unit": "pt",
-            "example": "20pt aggiunge una breve pausa visiva. 40pt crea una separazione piu' marcata tra capitoli."
-        },
-        "section_spacing_before": {
-            "label": "Spazio prima sezione",
-            "description": "Spazio verticale aggiunto prima dell'inizio di ogni nuova sezione.",
-            "type": "number",
-            "min": 0, "max": 40, "default": 15, "unit": "pt",
-            "example": "15pt e' sufficiente per distinguere le sezioni. Deve essere minore dello spazio prima capitolo."
-        },
-        "paragraph_spacing": {
-            "label": "Spazio tra paragrafi",
-            "description": "Spazio extra aggiunto tra un paragrafo e il successivo.",
-            "type": "number",
-            "min": 0, "max": 20, "default": 0, "unit": "pt",
-            "example": "0 = nessuno spazio extra (paragrafi separati solo dall'interlinea). 6pt = leggera separazione tra paragrafi."
-        },
-        "background_image": {
-            "label": "Immagine di sfondo",
-            "description": "Immagine da usare come sfondo delle pagine del PDF. Supporta JPG, PNG e WebP.",
-            "type": "image",
-            "default": "",
-            "example": "Carica un'immagine (es. logo, filigrana, texture). L'immagine verra' ridimensionata per coprire l'intera pagina."
-        },
-        "background_image_mode": {
-            "label": "Modalita' sfondo",
-            "description": "Su quali pagine applicare l'immagine di sfondo.",
-            "type": "select",
-            "options": ["all_pages", "first_page_only"],
-            "default": "all_pages",
-            "example": "all_pages = sfondo su tutte le pagine. first_page_only = sfondo solo sulla prima pagina (copertina)."
-        },
-        "background_opacity": {
-            "label": "Opacita' sfondo",
-            "description": "Trasparenza dell'immagine di sfondo. 0 = invisibile, 1 = completamente opaca.",
-            "type": "number",
-            "min": 0.05, "max": 1.0, "default": 0.15, "step": 0.05,
-            "example": "0.15 = molto trasparente (ideale per filigrane). 0.5 = semi-trasparente. 1.0 = immagine piena senza trasparenza."
-        },
-        "background_image_fit": {
-            "label": "Adattamento sfondo",
-            "description": "Come l'immagine di sfondo viene adattata alla pagina.",
-            "type": "select",
-            "options": ["tile", "stretch", "original", "center"],
-            "default": "tile",
-            "example": "tile = ripetuta a piastrella su tutta la pagina. stretch = stirata per coprire l'intera pagina. original = dimensione originale dall'angolo in alto a sinistra. center = dimensione originale centrata nella pagina."
-        },
-    },
-    "docx": {
-        "font_name": {
-            "label": "Nome font",
-            "description": "Il carattere tipografico usato nel documento Word.",
-            "type": "select",
-            "options": ["Times New Roman", "Arial", "Calibri", "Georgia", "Garamond", "Cambria"],
-            "default": "Times New Roman",
-            "example": "Times New Roman = serif classico, standard accademico. Arial = sans-serif, moderno. Calibri = default Word, leggibile. Garamond = serif elegante."
-        },
-        "font_size": {
-            "label": "Dimensione font corpo",
-            "description": "La grandezza del testo principale nel documento Word.",
-            "type": "number",
-            "min": 8, "max": 16, "default": 12, "unit": "pt",
-            "example": "12pt e' lo standard accademico per Times New Roman. 11pt per Arial o Calibri."
-        },
-        "font_title_size": {
-            "label": "Dimensione font titolo",
-            "description": "La grandezza del titolo principale della tesi sulla prima pagina del documento Word.",
-            "type": "number",
-            "min": 14, "max": 36, "default": 26, "unit": "pt",
-            "example": "26pt per un titolo ben visibile. 20pt per un look sobrio. 30pt per massimo impatto."
-        },
-        "title_alignment": {
-            "label": "Allineamento titolo",
-            "description": "Come viene allineato il titolo principale nel documento Word.",
-            "type": "select",
-            "options": ["left", "center", "right"],
-            "default": "center",
-            "example": "center = centrato (standard per tesi). left = allineato a sinistra."
-        },
-        "body_alignment": {
-            "label": "Allineamento testo corpo",
-            "description": "Come viene allineato il testo del corpo del documento Word.",
-            "type": "select",
-            "options": ["left", "center", "right", "justify"],
-            "default": "left",
-            "example": "left = allineato a sinistra (piu' leggibile). justify = giustificato (aspetto professionale, standard nelle tesi). center = centrato (solo per testi brevi)."
-        },
-        "line_spacing": {
-            "label": "Interlinea",
-            "description": "Spazio tra le righe di testo nel documento Word.",
-            "type": "number",
-            "min": 1.0, "max": 3.0, "default": 1.5, "step": 0.1,
-            "example": "1.5 = una e mezza (standard). 2.0 = doppia (richiesta da molte universita'). 1.15 = compatta."
-        },
-        "paragraph_spacing_after": {
-            "label": "Spazio dopo paragrafo",
-            "description": "Spazio aggiunto dopo ogni paragrafo nel documento Word.",
-            "type": "number",
-            "min": 0, "max": 24, "default": 6, "unit": "pt",
-            "example": "6pt = leggera separazione (standard). 12pt = separazione marcata tra paragrafi."
-        },
-        "chapter_spacing_before": {
-            "label": "Spazio prima capitolo",
-            "description": "Spazio verticale aggiunto prima di ogni titolo di capitolo (Heading 1) nel documento Word.",
-            "type": "number",
-            "min": 0, "max": 60, "default": 18, "unit": "pt",
-            "example": "18pt aggiunge una pausa visiva tra capitoli. 36pt crea una separazione piu' marcata. 0 = nessuno spazio extra."
-        },
-        "section_spacing_before": {
-            "label": "Spazio prima sezione",
-            "description": "Spazio verticale aggiunto prima di ogni titolo di sezione (Heading 2) nel documento Word.",
-            "type": "number",
-            "min": 0, "max": 40, "default": 12, "unit": "pt",
-            "example": "12pt e' sufficiente per distinguere le sezioni. Deve essere minore dello spazio prima capitolo."
-        },
-        "include_toc": {
-            "label": "Includere indice",
-            "description": "Se attivo, inserisce un indice automatico all'inizio del documento Word.",
-            "type": "boolean",
-            "default": True,
-            "example": "L'indice nel DOCX usa gli stili Heading di Word ed e' aggiornabile automaticamente."
-        },
-        "include_page_numbers": {
-            "label": "Numeri di pagina",
-            "description": "Se attivo, aggiunge numeri di pagina nel documento Word.",
-            "type": "boolean",
-            "default": True,
-            "example": "I numeri di pagina vengono inseriti nella posizione configurata (intestazione o pie' di pagina)."
-        },
-        "page_number_position": {
-            "label": "Posizione numeri pagina",
-            "description": "Dove posizionare il numero di pagina nel documento Word.",
-            "type": "select",
-            "options": ["bottom_center", "bottom_right", "top_center", "top_right"],
-            "default": "bottom_center",
-            "example": "bottom_center = centrato in basso (standard). bottom_right = in basso a destra. top_right = in alto a destra (stile articolo)."
-        },
-        "toc_indent": {
-            "label": "Indentazione indice",
-            "description": "Rientro delle voci dell'indice rispetto al margine sinistro.",
-            "type": "number",
-            "min": 0.0, "max": 2.0, "default": 0.5, "step": 0.1, "unit": "inches",
-            "example": "0.5 inches = circa 1.27cm. Le sezioni vengono indentate rispetto ai capitoli."
-        },
-        "heading1_size": {
-            "label": "Dimensione titolo capitoli",
-            "description": "La grandezza dei titoli dei capitoli (Heading 1) nel documento Word.",
-            "type": "number",
-            "min": 12, "max": 28, "default": 16, "unit": "pt",
-            "example": "16pt crea una buona gerarchia. Deve essere piu' grande del corpo testo."
-        },
-        "heading2_size": {
-            "label": "Dimensione titolo sezioni",
-            "description": "La grandezza dei titoli delle sezioni (Heading 2) nel documento Word.",
-            "type": "number",
-            "min": 10, "max": 24, "default": 14, "unit": "pt",
-            "example": "14pt distingue le sezioni dal corpo testo. Deve essere piu' piccolo di Heading 1."
-        },
-        "margin_top": {
-            "label": "Margine superiore",
-            "description": "Spazio vuoto tra il bordo superiore della pagina e l'inizio del contenuto nel documento Word.",
-            "type": "number",
-            "min": 20, "max": 200, "default": 72, "unit": "pt",
-            "example": "72pt = 1 inch = 2.54cm (standard Word). Per tesi accademiche si consiglia 72pt. Margini piu' ampi danno un aspetto piu' pulito."
-        },
-        "margin_bottom": {
-            "label": "Margine inferiore",
-            "description": "Spazio vuoto tra la fine del contenuto e il bordo inferiore della pagina nel documento Word.",
-            "type": "number",
-            "min": 20, "max": 200, "default": 72, "unit": "pt",
-            "example": "72pt = 1 inch = 2.54cm. Aumentare se si usano numeri di pagina o pie' di pagina."
-        },
-        "margin_left": {
-            "label": "Margine sinistro",
-            "description": "Spazio vuoto sul lato sinistro della pagina nel documento Word.",
-            "type": "number",
-            "min": 20, "max": 200, "default": 72, "unit": "pt",
-            "example": "72pt = 1 inch. Per documenti rilegati, usare 90-100pt (circa 3cm) per lasciare spazio alla rilegatura."
-        },
-        "margin_right": {
-            "label": "Margine destro",
-            "description": "Spazio vuoto sul lato destro della pagina nel documento Word.",
-            "type": "number",
-            "min": 20, "max": 200, "default": 72, "unit": "pt",
-            "example": "72pt = 1 inch. Di solito uguale o leggermente piu' piccolo del margine sinistro."
-        },
-        "include_header": {
-            "label": "Intestazione pagina",
-            "description": "Se attivo, aggiunge un testo fisso nell'intestazione (parte superiore) di ogni pagina del documento Word.",
-            "type": "boolean",
-            "default": False,
-            "example": "L'intestazione puo' contenere il titolo della tesi abbreviato o il nome dell'autore."
-        },
-        "header_text": {
-            "label": "Testo intestazione",
-            "description": "Il testo che appare nell'intestazione di ogni pagina. Visibile solo se 'Intestazione pagina' e' attivo.",
-            "type": "text",
-            "default": "",
-            "example": "Esempio: 'Tesi di Laurea - Nome Autore' oppure 'Capitolo corrente'."
-        },
-        "include_footer": {
-            "label": "Pie' di pagina",
-            "description": "Se attivo, aggiunge un testo fisso nel pie' di pagina (parte inferiore) di ogni pagina del documento Word.",
-            "type": "boolean",
-            "default": False,
-            "example": "Il pie' di pagina puo' contenere informazioni come l'universita', il dipartimento o la data."
-        },
-        "footer_text": {
-            "label": "Testo pie' di pagina",
-            "description": "Il testo che appare nel pie' di pagina di ogni pagina. Visibile solo se 'Pie' di pagina' e' attivo.",
-            "type": "text",
-            "default": "",
-            "example": "Esempio: 'Universita' degli Studi di Roma - A.A. 2024/2025'."
-        },
-    }
-}
+_HELP_PATH = Path(__file__).parent / "resources" / "template_param_help.json"
+
 
+@functools.cache
+def get_template_param_help() -> dict:
+    """Carica (una sola volta) le descrizioni dei parametri template dal file JSON."""
+    with open(_HELP_PATH, "rb") as f:
+        return json.loads(f.read())
 
 # ============================================================================
 # FUNZIONI CRUD
 # ============================================================================
 
-def get_export_templates(db: Optional[Session] = None) -> dict:
-    """Recupera i template di esportazione dal DB o ritorna i default."""
-    if db is None:
-        return copy.deepcopy(DEFAULT_EXPORT_TEMPLATES)
+def get_export_templates(db: Optional[Session] = None, mutable: bool = False) -> dict:
+    """
+    Recupera i template di esportazione dal DB o ritorna i default.
+
+    Di default il risultato e' in sola lettura (nessuna copia): i chiamanti che
+    devono modificarlo richiedono una copia propria con mutable=True.
+    """
+    data = DEFAULT_EXPORT_TEMPLATES
 
-    try:
-        setting = db.query(SystemSetting).filter(
-            SystemSetting.key == 'export_templates'
-        ).first()
+    if db is not None:
+        try:
+            setting = db.query(SystemSetting).filter(
+                SystemSetting.key == 'export_templates'
+            ).first()
 
-        if setting and setting.value:
-            return setting.value
-    except Exception as e:
-        logger.warning(f"Errore lettura template da DB, uso default: {e}")
+            if setting and setting.value:
+                data = setting.value
+        except Exception as e:
+            logger.warning(f"Errore lettura template da DB, uso default: {e}")
 
-    return copy.deepcopy(DEFAULT_EXPORT_TEMPLATES)
+    return copy.deepcopy(data) if mutable else data
 
 
 def save_export_templates(templates_data: dict, admin_user_id, db: Session) -> dict:
@@ -526,7 +174,7 @@ def delete_template(template_id: str, admin_user_id, db: Session) -> dict:
     if template_id == "default":
         raise HTTPException(status_code=400, detail="Non puoi eliminare il template Standard")
 
-    data = get_export_templates(db)
+    data = get_export_templates(db, mutable=True)
     templates = data.get("templates", [])
     original_len = len(templates)
 
@@ -568,9 +216,15 @@ def get_template_by_id(template_id: Optional[str], db: Optional[Session] = None)
     return DEFAULT_EXPORT_TEMPLATES["templates"][0]
 
 
+def generate_template_ids(n: int = 1) -> list:
+    """Genera n ID univoci per nuovi template con una sola lettura da os.urandom."""
+    raw = os.urandom(4 * n)  # 4 byte -> 8 caratteri hex
+    return [f"tpl-{raw[i * 4:(i + 1) * 4].hex()}" for i in range(n)]
+
+
 def generate_template_id() -> str:
     """Genera un ID univoco per un nuovo template."""
-    return f"tpl-{uuid.uuid4().hex[:8]}"
+    return generate_template_ids(1)[0]
 
 
 # ============================================================================
@@ -168,6 +168,112 @@ class TestValidation:
         assert response.status_code == 422
 
 
+class TestThesisRaiseload:
+    """
+    Le letture delle tesi usano raiseload('*'): verifica che get_thesis,
+    list_theses e list_attachments non tocchino relazioni non caricate
+    (InvalidRequestError). Usa un DB SQLite temporaneo al posto di Postgres.
+    """
+
+    @pytest.fixture(autouse=True)
+    def cleanup(self):
+        """Nessuna sessione in memoria da ripulire: i dati stanno nel DB temporaneo."""
+        yield
+
+    @pytest.fixture
+    def thesis_db(self, tmp_path, monkeypatch):
+        import uuid
+        from sqlalchemy import create_engine, ARRAY, Uuid
+        from sqlalchemy.dialects.postgresql import JSONB
+        from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+        from sqlalchemy.ext.compiler import compiles
+        from sqlalchemy.orm import sessionmaker
+        from auth import AuthedUser, get_current_authed_user
+        from database import Base, get_db, get_async_db
+        from db_models import User, Thesis, ThesisAttachment
+
+        @compiles(JSONB, "sqlite")
+        @compiles(ARRAY, "sqlite")
+        def _as_json(type_, compiler, **kw):
+            return "JSON"
+
+        # Postgres accetta gli id come stringa, il tipo Uuid su SQLite no
+        uuid_bind_processor = Uuid.bind_processor
+
+        def bind_processor(type_, dialect):
+            process = uuid_bind_processor(type_, dialect)
+            if process is None:
+                return None
+            return lambda value: process(uuid.UUID(value) if isinstance(value, str) else value)
+
+        monkeypatch.setattr(Uuid, "bind_processor", bind_processor)
+
+        db_path = tmp_path / "theses.db"
+        engine = create_engine(f"sqlite:///{db_path}")
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        Base.metadata.create_all(engine, tables=[
+            User.__table__, Thesis.__table__, ThesisAttachment.__table__
+        ])
+
+        SessionLocal = sessionmaker(bind=engine)
+        AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+        user = User(email="raiseload@test.it", username="test_raiseload", hashed_password="x")
+        thesis = Thesis(user=user, title="Tesi di prova", status="draft")
+        attachment = ThesisAttachment(
+            thesis=thesis, filename="fonte.txt", original_filename="fonte.txt",
+            file_path=str(tmp_path / "fonte.txt"), file_size=5, mime_type="text/plain"
+        )
+        with SessionLocal() as db:
+            db.add_all([user, thesis, attachment])
+            db.commit()
+            ids = {"user": user.id, "thesis": str(thesis.id)}
+
+        def override_get_db():
+            db = SessionLocal()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        async def override_get_async_db():
+            async with AsyncSessionLocal() as db:
+                yield db
+
+        app.dependency_overrides[get_db] = override_get_db
+        app.dependency_overrides[get_async_db] = override_get_async_db
+        app.dependency_overrides[get_current_authed_user] = lambda: AuthedUser(
+            id=ids["user"], is_active=True, is_admin=False
+        )
+        try:
+            yield ids
+        finally:
+            app.dependency_overrides.clear()
+            engine.dispose()
+
+    def test_get_thesis(self, thesis_db):
+        """Il dettaglio tesi non carica relazioni."""
+        response = client.get(f"/api/thesis/{thesis_db['thesis']}")
+        assert response.status_code == 200
+        assert response.json()["title"] == "Tesi di prova"
+
+    def test_list_theses(self, thesis_db):
+        """La lista tesi non carica relazioni."""
+        response = client.get("/api/thesis")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["total"] == 1
+        assert data["theses"][0]["id"] == thesis_db["thesis"]
+
+    def test_list_attachments(self, thesis_db):
+        """La lista allegati non carica relazioni ne' il testo estratto."""
+        response = client.get(f"/api/thesis/{thesis_db['thesis']}/attachments")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["total"] == 1
+        assert data["attachments"][0]["original_filename"] == "fonte.txt"
+
+
 # Cleanup fixture
 @pytest.fixture(autouse=True)
 def cleanup():
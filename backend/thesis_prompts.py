@@ -5,9 +5,238 @@ Questo modulo contiene i prompt dettagliati per ogni fase
 della generazione di tesi utilizzando OpenAI o1/o3.
 """
 
+import functools
+import json
+import math
+import re
+import string
 from typing import Dict, Any, List, Optional
 
 
+# Default dei parametri tesi condivisi da tutti i prompt builder
+_DEFAULTS: Dict[str, Any] = {
+    "title": "Non specificato",
+    "description": "Non specificata",
+    "writing_style_name": "Non specificato",
+    "writing_style_hint": "",
+    "content_depth_name": "Intermedio",
+    "num_chapters": 5,
+    "sections_per_chapter": 3,
+    "words_per_section": 5000,
+    "knowledge_level_name": "Intermedio",
+    "knowledge_level_hint": "",
+    "industry_name": "Generale",
+    "target_audience_name": "Pubblico Generale",
+    "target_audience_hint": "",
+}
+
+# Contratto di output delle FASI 1 e 2. Con i provider che supportano lo
+# structured output (JSON Schema) l'esempio JSON in prosa non serve: il
+# formato e' garantito dallo schema e nel prompt resta solo una nota breve.
+CHAPTERS_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "chapters": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "index": {"type": "integer"},
+                    "title": {"type": "string"},
+                    "brief_description": {"type": "string"},
+                },
+                "required": ["index", "title", "brief_description"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["chapters"],
+    "additionalProperties": False,
+}
+
+SECTIONS_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "chapters": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "chapter_index": {"type": "integer"},
+                    "chapter_title": {"type": "string"},
+                    "sections": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "index": {"type": "integer"},
+                                "title": {"type": "string"},
+                                "key_points": {"type": "array", "items": {"type": "string"}},
+                            },
+                            "required": ["index", "title", "key_points"],
+                            "additionalProperties": False,
+                        },
+                    },
+                },
+                "required": ["chapter_index", "chapter_title", "sections"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["chapters"],
+    "additionalProperties": False,
+}
+
+_CHAPTERS_OUTPUT_EXAMPLE = """Restituisci SOLO un JSON valido con questa struttura esatta:
+{
+  "chapters": [
+    {
+      "index": 1,
+      "title": "Titolo del primo capitolo",
+      "brief_description": "Breve descrizione di cosa tratterà questo capitolo (1-2 frasi)"
+    },
+    {
+      "index": 2,
+      "title": "Titolo del secondo capitolo",
+      "brief_description": "Breve descrizione di cosa tratterà questo capitolo (1-2 frasi)"
+    }
+  ]
+}
+
+IMPORTANTE:
+- Restituisci SOLO il JSON, senza testo aggiuntivo
+- Non usare markdown code blocks
+- Assicurati che il JSON sia valido e parsabile"""
+
+_CHAPTERS_OUTPUT_SCHEMA_NOTE = (
+    "Restituisci i capitoli secondo lo schema JSON richiesto: per ognuno index, "
+    "title e brief_description (1-2 frasi)."
+)
+
+_SECTIONS_OUTPUT_EXAMPLE = """Restituisci SOLO un JSON valido con questa struttura esatta:
+{
+  "chapters": [
+    {
+      "chapter_index": 1,
+      "chapter_title": "Titolo del primo capitolo (esattamente come fornito)",
+      "sections": [
+        {
+          "index": 1,
+          "title": "Titolo della prima sezione",
+          "key_points": [
+            "Primo punto chiave da sviluppare",
+            "Secondo punto chiave da sviluppare",
+            "Terzo punto chiave da sviluppare"
+          ]
+        },
+        {
+          "index": 2,
+          "title": "Titolo della seconda sezione",
+          "key_points": [
+            "Primo punto chiave",
+            "Secondo punto chiave",
+            "Terzo punto chiave"
+          ]
+        }
+      ]
+    }
+  ]
+}
+
+IMPORTANTE:
+- Restituisci SOLO il JSON, senza testo aggiuntivo
+- Mantieni i titoli dei capitoli ESATTAMENTE come forniti
+- Ogni sezione deve avere 2-4 key_points
+- Assicurati che il JSON sia valido e parsabile"""
+
+_SECTIONS_OUTPUT_SCHEMA_NOTE = (
+    "Restituisci la struttura secondo lo schema JSON richiesto: per ogni capitolo "
+    "chapter_index, chapter_title (ESATTAMENTE come fornito) e sections, "
+    "ognuna con index, title e 2-4 key_points."
+)
+
+
+# Riga di separazione dei blocchi nei prompt
+_BAR = "═" * 79
+
+
+class _PromptTemplate:
+    """
+    Scheletro di prompt con la sintassi di string.Template ($nome, ${nome}),
+    convertito all'import in una format string: la sostituzione avviene in
+    un solo passaggio in C (str.format_map) invece che tramite regex e
+    callback Python per ogni placeholder.
+    """
+
+    __slots__ = ("_format",)
+
+    def __init__(self, source: str):
+        parts = []
+        pos = 0
+        for m in string.Template.pattern.finditer(source):
+            parts.append(source[pos:m.start()].replace("{", "{{").replace("}", "}}"))
+            name = m.group("named") or m.group("braced")
+            if name is not None:
+                parts.append("{" + name + "}")
+            elif m.group("escaped") is not None:
+                parts.append("$")
+            else:
+                raise ValueError(f"Placeholder non valido nel template: {m.group()!r}")
+            pos = m.end()
+        parts.append(source[pos:].replace("{", "{{").replace("}", "}}"))
+        self._format = "".join(parts)
+
+    def substitute(self, mapping: Optional[Dict[str, Any]] = None, **kwargs: Any) -> str:
+        """Come string.Template.substitute: KeyError se manca un parametro."""
+        if kwargs:
+            mapping = {**mapping, **kwargs} if mapping else kwargs
+        return self._format.format_map(mapping)
+
+
+def _template(source: str) -> _PromptTemplate:
+    """
+    Compila uno scheletro di prompt espandendo una sola volta, all'import,
+    le righe di separazione ${BAR}: il template risultante e' un unico
+    letterale e i placeholder restanti vengono riempiti dai builder.
+    """
+    return _PromptTemplate(string.Template(source).safe_substitute(BAR=_BAR))
+
+
+# Citazioni numeriche [x] nel testo generato
+_CITE_RE = re.compile(r'\[(\d+)\]')
+# Note a piè di pagina {{nota:...}} nel testo generato
+_NOTE_RE = re.compile(r'\{\{nota:\s*(.*?)\}\}')
+
+# Caratteri del contenuto della tesi inclusi nel prompt della bibliografia
+_BIBLIOGRAPHY_CONTENT_CHARS = 15000
+
+_NO_AUTHOR_STYLE = "Nessuno stile specifico addestrato - usa lo stile richiesto nei parametri."
+
+
+def _thesis_params(thesis_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Estrae i parametri della tesi per i template, applicando i default."""
+    params = {key: thesis_data.get(key, default) for key, default in _DEFAULTS.items()}
+    # Il target di parole compare piu' volte nei template: viene risolto una
+    # sola volta qui, come intero (es. 1500.0 o "1500" -> 1500)
+    try:
+        params["words_per_section"] = int(params["words_per_section"])
+    except (TypeError, ValueError):
+        pass
+    return params
+
+
+def format_key_topics(thesis_data: Dict[str, Any]) -> str:
+    """Argomenti chiave come testo unico ("Non specificati" se assenti)."""
+    key_topics = thesis_data.get('key_topics')
+    return ", ".join(key_topics) if key_topics else "Non specificati"
+
+
+def _key_topics_text(thesis_data: Dict[str, Any]) -> str:
+    """Argomenti chiave, usando il testo gia' calcolato in thesis_data se presente."""
+    text = thesis_data.get('key_topics_text')
+    return text if text is not None else format_key_topics(thesis_data)
+
+
 def _get_citation_instructions(citation_style: str = "footnotes") -> str:
     """Restituisce le istruzioni sulle citazioni in base allo stile scelto."""
     if citation_style == "bibliography":
@@ -48,69 +277,56 @@ def _get_no_citation_instruction(citation_style: str = "footnotes") -> str:
         return "NON inserire note bibliografiche {{nota:...}}"
 
 
-def build_chapters_prompt(thesis_data: Dict[str, Any], attachments_context: str = "") -> str:
-    """
-    Costruisce il prompt per la FASE 1: Generazione titoli capitoli.
-
-    Args:
-        thesis_data: Dizionario con tutti i parametri della tesi
-        attachments_context: Contesto estratto dagli allegati
-
-    Returns:
-        Prompt completo per la generazione dei capitoli
-    """
-    key_topics_str = ", ".join(thesis_data.get('key_topics', [])) if thesis_data.get('key_topics') else "Non specificati"
-
-    return f"""
-═══════════════════════════════════════════════════════════════════════════════
+_CHAPTERS_TPL = _template("""
+${BAR}
 GENERAZIONE INDICE TESI/RELAZIONE - FASE 1: CAPITOLI
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
 Sei un esperto nella strutturazione di documenti accademici e professionali.
 Il tuo compito è generare l'INDICE (titoli dei capitoli) per una tesi/relazione.
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 PARAMETRI DELLA TESI
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-TITOLO: {thesis_data.get('title', 'Non specificato')}
-DESCRIZIONE: {thesis_data.get('description', 'Non specificata')}
-ARGOMENTI CHIAVE: {key_topics_str}
+TITOLO: $title
+DESCRIZIONE: $description
+ARGOMENTI CHIAVE: $key_topics
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 PARAMETRI DI GENERAZIONE
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-STILE DI SCRITTURA: {thesis_data.get('writing_style_name', 'Non specificato')}
-  → Indicazione: {thesis_data.get('writing_style_hint', '')}
+STILE DI SCRITTURA: $writing_style_name
+  → Indicazione: $writing_style_hint
 
-LIVELLO DI PROFONDITÀ: {thesis_data.get('content_depth_name', 'Intermedio')}
-NUMERO CAPITOLI RICHIESTI: {thesis_data.get('num_chapters', 5)}
-SEZIONI PER CAPITOLO: {thesis_data.get('sections_per_chapter', 3)}
-PAROLE PER SEZIONE: ~{thesis_data.get('words_per_section', 5000)}
+LIVELLO DI PROFONDITÀ: $content_depth_name
+NUMERO CAPITOLI RICHIESTI: $num_chapters
+SEZIONI PER CAPITOLO: $sections_per_chapter
+PAROLE PER SEZIONE: ~$words_per_section
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 CARATTERISTICHE DEL PUBBLICO
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-LIVELLO DI CONOSCENZA: {thesis_data.get('knowledge_level_name', 'Intermedio')}
-  → Indicazione: {thesis_data.get('knowledge_level_hint', '')}
+LIVELLO DI CONOSCENZA: $knowledge_level_name
+  → Indicazione: $knowledge_level_hint
 
 DIMENSIONE PUBBLICO: Commissione di laurea
-SETTORE/INDUSTRIA: {thesis_data.get('industry_name', 'Generale')}
-DESTINATARI: {thesis_data.get('target_audience_name', 'Pubblico Generale')}
-  → Indicazione: {thesis_data.get('target_audience_hint', '')}
+SETTORE/INDUSTRIA: $industry_name
+DESTINATARI: $target_audience_name
+  → Indicazione: $target_audience_hint
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 CONTESTO DAGLI ALLEGATI
-═══════════════════════════════════════════════════════════════════════════════
-{attachments_context if attachments_context else "Nessun allegato fornito."}
+${BAR}
+$attachments_context
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 ISTRUZIONI
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-1. Genera esattamente {thesis_data.get('num_chapters', 5)} titoli di capitoli
+1. Genera esattamente $num_chapters titoli di capitoli
 
 2. I titoli devono essere:
    - INFORMATIVI e SPECIFICI (evita titoli generici come "Introduzione", "Conclusioni",
@@ -129,259 +345,162 @@ ISTRUZIONI
 5. La struttura deve essere bilanciata: ogni capitolo dovrebbe avere
    importanza e dimensione simile
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 OUTPUT RICHIESTO
-═══════════════════════════════════════════════════════════════════════════════
-
-Restituisci SOLO un JSON valido con questa struttura esatta:
-{{
-  "chapters": [
-    {{
-      "index": 1,
-      "title": "Titolo del primo capitolo",
-      "brief_description": "Breve descrizione di cosa tratterà questo capitolo (1-2 frasi)"
-    }},
-    {{
-      "index": 2,
-      "title": "Titolo del secondo capitolo",
-      "brief_description": "Breve descrizione di cosa tratterà questo capitolo (1-2 frasi)"
-    }}
-  ]
-}}
+${BAR}
 
-IMPORTANTE:
-- Restituisci SOLO il JSON, senza testo aggiuntivo
-- Non usare markdown code blocks
-- Assicurati che il JSON sia valido e parsabile
-"""
+$output_contract
+""")
 
 
-def build_sections_prompt(
+def build_chapters_prompt(
     thesis_data: Dict[str, Any],
-    chapters: List[Dict[str, Any]],
-    attachments_context: str = ""
+    attachments_context: str = "",
+    structured_output: bool = False
 ) -> str:
     """
-    Costruisce il prompt per la FASE 2: Generazione titoli sezioni.
+    Costruisce il prompt per la FASE 1: Generazione titoli capitoli.
 
     Args:
-        thesis_data: Dizionario con i parametri della tesi
-        chapters: Lista dei capitoli confermati
+        thesis_data: Dizionario con tutti i parametri della tesi
         attachments_context: Contesto estratto dagli allegati
+        structured_output: Se il formato e' imposto da CHAPTERS_SCHEMA
+            (niente esempio JSON nel prompt)
 
     Returns:
-        Prompt completo per la generazione delle sezioni
+        Prompt completo per la generazione dei capitoli
     """
-    chapters_text = "\n".join([
-        f"  Capitolo {c.get('index', i+1)}: {c.get('title', 'Senza titolo')}\n"
-        f"    → {c.get('brief_description', 'Nessuna descrizione')}"
-        for i, c in enumerate(chapters)
-    ])
+    params = _thesis_params(thesis_data)
+    params["key_topics"] = _key_topics_text(thesis_data)
+    params["attachments_context"] = attachments_context or "Nessun allegato fornito."
+    params["output_contract"] = _CHAPTERS_OUTPUT_SCHEMA_NOTE if structured_output else _CHAPTERS_OUTPUT_EXAMPLE
 
-    return f"""
-═══════════════════════════════════════════════════════════════════════════════
+    return _CHAPTERS_TPL.substitute(params)
+
+
+_SECTIONS_TPL = _template("""
+${BAR}
 GENERAZIONE INDICE TESI/RELAZIONE - FASE 2: SEZIONI
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
 Sei un esperto nella strutturazione di documenti accademici e professionali.
 Il tuo compito è generare i TITOLI DELLE SEZIONI per ogni capitolo della tesi.
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 CONTESTO DELLA TESI
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-TITOLO: {thesis_data.get('title', 'Non specificato')}
-DESCRIZIONE: {thesis_data.get('description', 'Non specificata')}
-STILE: {thesis_data.get('writing_style_name', 'Non specificato')}
-LIVELLO PROFONDITÀ: {thesis_data.get('content_depth_name', 'Intermedio')}
+TITOLO: $title
+DESCRIZIONE: $description
+STILE: $writing_style_name
+LIVELLO PROFONDITÀ: $content_depth_name
 
-PUBBLICO: {thesis_data.get('target_audience_name', 'Generale')}
-  (Livello: {thesis_data.get('knowledge_level_name', 'Intermedio')})
+PUBBLICO: $target_audience_name
+  (Livello: $knowledge_level_name)
 
-SEZIONI PER CAPITOLO: {thesis_data.get('sections_per_chapter', 3)}
-PAROLE PER SEZIONE: ~{thesis_data.get('words_per_section', 5000)}
+SEZIONI PER CAPITOLO: $sections_per_chapter
+PAROLE PER SEZIONE: ~$words_per_section
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 CAPITOLI CONFERMATI
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-{chapters_text}
+$chapters_text
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 CONTESTO DAGLI ALLEGATI
-═══════════════════════════════════════════════════════════════════════════════
-{attachments_context if attachments_context else "Nessun allegato fornito."}
+${BAR}
+$attachments_context
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 ISTRUZIONI
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-Per OGNI capitolo, genera esattamente {thesis_data.get('sections_per_chapter', 3)} sezioni.
+Per OGNI capitolo, genera esattamente $sections_per_chapter sezioni.
 
 Le sezioni devono:
 1. COPRIRE l'argomento del capitolo in modo completo e esaustivo
 2. Avere una PROGRESSIONE LOGICA interna (dalla teoria alla pratica,
    dal generale al particolare, ecc.)
-3. Essere sufficientemente AMPIE da giustificare ~{thesis_data.get('words_per_section', 5000)} parole
+3. Essere sufficientemente AMPIE da giustificare ~$words_per_section parole
 4. NON SOVRAPPORSI tra loro - ogni sezione deve coprire aspetti distinti
 5. Essere SPECIFICHE e descrittive (evita titoli vaghi)
 6. Avere 2-4 punti chiave che verranno sviluppati nella sezione
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 OUTPUT RICHIESTO
-═══════════════════════════════════════════════════════════════════════════════
-
-Restituisci SOLO un JSON valido con questa struttura esatta:
-{{
-  "chapters": [
-    {{
-      "chapter_index": 1,
-      "chapter_title": "Titolo del primo capitolo (esattamente come fornito)",
-      "sections": [
-        {{
-          "index": 1,
-          "title": "Titolo della prima sezione",
-          "key_points": [
-            "Primo punto chiave da sviluppare",
-            "Secondo punto chiave da sviluppare",
-            "Terzo punto chiave da sviluppare"
-          ]
-        }},
-        {{
-          "index": 2,
-          "title": "Titolo della seconda sezione",
-          "key_points": [
-            "Primo punto chiave",
-            "Secondo punto chiave",
-            "Terzo punto chiave"
-          ]
-        }}
-      ]
-    }}
-  ]
-}}
+${BAR}
 
-IMPORTANTE:
-- Restituisci SOLO il JSON, senza testo aggiuntivo
-- Mantieni i titoli dei capitoli ESATTAMENTE come forniti
-- Ogni sezione deve avere 2-4 key_points
-- Assicurati che il JSON sia valido e parsabile
-"""
+$output_contract
+""")
 
 
-def build_section_content_prompt(
+def build_sections_prompt(
     thesis_data: Dict[str, Any],
-    chapter: Dict[str, Any],
-    section: Dict[str, Any],
-    previous_sections_summary: str = "",
+    chapters: List[Dict[str, Any]],
     attachments_context: str = "",
-    author_style_context: str = ""
+    structured_output: bool = False
 ) -> str:
     """
-    Costruisce il prompt per la FASE 3: Generazione contenuto sezione.
+    Costruisce il prompt per la FASE 2: Generazione titoli sezioni.
 
     Args:
-        thesis_data: Parametri della tesi
-        chapter: Dati del capitolo corrente
-        section: Dati della sezione da generare
-        previous_sections_summary: Riassunto delle sezioni precedenti
-        attachments_context: Contesto dagli allegati
-        author_style_context: Contesto dello stile autore (se addestrato)
+        thesis_data: Dizionario con i parametri della tesi
+        chapters: Lista dei capitoli confermati
+        attachments_context: Contesto estratto dagli allegati
+        structured_output: Se il formato e' imposto da SECTIONS_SCHEMA
+            (niente esempio JSON nel prompt)
 
     Returns:
-        Prompt completo per la generazione del contenuto
+        Prompt completo per la generazione delle sezioni
     """
-    key_points = section.get('key_points', [])
-    key_points_text = "\n".join([f"• {point}" for point in key_points]) if key_points else "Non specificati"
-
-    return f"""
-═══════════════════════════════════════════════════════════════════════════════
-GENERAZIONE CONTENUTO SEZIONE
-═══════════════════════════════════════════════════════════════════════════════
-
-TESI: "{thesis_data.get('title', 'Non specificato')}"
-CAPITOLO {chapter.get('chapter_index', '?')}: {chapter.get('chapter_title', 'Non specificato')}
-SEZIONE {section.get('index', '?')}: {section.get('title', 'Non specificato')}
-
-═══════════════════════════════════════════════════════════════════════════════
-PARAMETRI DI SCRITTURA
-═══════════════════════════════════════════════════════════════════════════════
-
-STILE: {thesis_data.get('writing_style_name', 'Non specificato')}
-  → {thesis_data.get('writing_style_hint', '')}
-
-LIVELLO PROFONDITÀ: {thesis_data.get('content_depth_name', 'Intermedio')}
-PAROLE TARGET: ~{thesis_data.get('words_per_section', 5000)} parole
-
-═══════════════════════════════════════════════════════════════════════════════
-PUBBLICO TARGET
-═══════════════════════════════════════════════════════════════════════════════
-
-DESTINATARI: {thesis_data.get('target_audience_name', 'Pubblico Generale')}
-  → {thesis_data.get('target_audience_hint', '')}
-
-LIVELLO CONOSCENZA: {thesis_data.get('knowledge_level_name', 'Intermedio')}
-  → {thesis_data.get('knowledge_level_hint', '')}
-
-SETTORE: {thesis_data.get('industry_name', 'Generale')}
-
-═══════════════════════════════════════════════════════════════════════════════
-PUNTI CHIAVE DA SVILUPPARE
-═══════════════════════════════════════════════════════════════════════════════
-{key_points_text}
+    params = _thesis_params(thesis_data)
+    params["target_audience_name"] = thesis_data.get('target_audience_name', 'Generale')
+    params["chapters_text"] = "\n".join(
+        f"  Capitolo {c.get('index', i+1)}: {c.get('title', 'Senza titolo')}\n"
+        f"    → {c.get('brief_description', 'Nessuna descrizione')}"
+        for i, c in enumerate(chapters)
+    )
+    params["attachments_context"] = attachments_context or "Nessun allegato fornito."
+    params["output_contract"] = _SECTIONS_OUTPUT_SCHEMA_NOTE if structured_output else _SECTIONS_OUTPUT_EXAMPLE
 
-═══════════════════════════════════════════════════════════════════════════════
-CONTESTO PRECEDENTE
-═══════════════════════════════════════════════════════════════════════════════
-{previous_sections_summary if previous_sections_summary else "Questa è la prima sezione della tesi."}
+    return _SECTIONS_TPL.substitute(params)
 
-═══════════════════════════════════════════════════════════════════════════════
-MATERIALE DI RIFERIMENTO (dagli allegati)
-═══════════════════════════════════════════════════════════════════════════════
-{attachments_context if attachments_context else "Nessun materiale allegato."}
 
-═══════════════════════════════════════════════════════════════════════════════
-STILE DELL'AUTORE
-═══════════════════════════════════════════════════════════════════════════════
-{author_style_context if author_style_context else "Nessuno stile specifico addestrato - usa lo stile richiesto nei parametri."}
+# Istruzioni fisse della FASE 3 (identiche per tutte le sezioni di una tesi):
+# inviate come system prompt, cosi' il provider puo' metterle in cache
+_SECTION_CONTENT_SYSTEM_TPL = _template("""Sei un autore accademico che scrive, una alla volta, le sezioni di una tesi/relazione.
+Ogni richiesta contiene i parametri della tesi e della sezione da scrivere.
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 ISTRUZIONI DI SCRITTURA
-═══════════════════════════════════════════════════════════════════════════════
-
-1. REQUISITO CRITICO — LUNGHEZZA MINIMA:
-   ⚠️ Devi scrivere ALMENO {thesis_data.get('words_per_section', 5000)} parole per questa sezione
-   ⚠️ NON scrivere meno di {thesis_data.get('words_per_section', 5000)} parole — è un requisito OBBLIGATORIO
-   ⚠️ Se il testo ti sembra lungo, VA BENE — deve essere lungo!
-   ⚠️ Sviluppa OGNI punto in profondità con esempi, analisi, dati e riflessioni
-   ⚠️ Ogni paragrafo deve avere almeno 150-200 parole
-   ⚠️ NON riassumere, NON sintetizzare, NON abbreviare
+${BAR}
 
-2. STRUTTURA il contenuto in modo chiaro:
+1. STRUTTURA il contenuto in modo chiaro:
    - Introduzione al tema della sezione (1-2 paragrafi)
    - Sviluppo completo di ogni punto chiave
    - Esempi concreti e casi pratici dove appropriato
    - Eventuali riferimenti a fonti/studi (se rilevante per lo stile)
    - Transizione verso la sezione successiva (se non è l'ultima)
 
-3. MANTIENI COERENZA con le sezioni precedenti:
+2. MANTIENI COERENZA con le sezioni precedenti:
    - Non ripetere concetti già trattati
    - Fai riferimento a quanto già discusso quando rilevante
    - Usa terminologia consistente
 
-4. ADATTA il linguaggio al pubblico target:
+3. ADATTA il linguaggio al pubblico target:
    - Livello di tecnicità appropriato
    - Spiegazioni adeguate al livello di conoscenza
    - Esempi pertinenti al settore
 
-5. Se sono stati forniti allegati:
+4. Se sono stati forniti allegati:
    - Integra informazioni rilevanti
    - Fai riferimento ai materiali dove appropriato
    - Non copiare verbatim, rielabora
 
-6. {_get_citation_instructions(thesis_data.get('citation_style', 'footnotes'))}
+5. $citation_instructions
 
-7. SCRIVI COME UNO STUDENTE UNIVERSITARIO REALE:
+6. SCRIVI COME UNO STUDENTE UNIVERSITARIO REALE:
    Il testo DEVE sembrare scritto da uno studente preparato, NON da un'AI.
    Questo e' il requisito piu' importante. Segui TUTTE queste regole:
 
@@ -434,9 +553,9 @@ ISTRUZIONI DI SCRITTURA
    - Qualche volta fai un'osservazione personale breve senza citazioni
    - Varia il ritmo: dopo 2-3 paragrafi densi, inserisci uno piu' leggero
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 OUTPUT
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
 Scrivi SOLO il contenuto della sezione.
 
@@ -446,8 +565,325 @@ IMPORTANTE:
 - NON usare placeholder o [inserire qui]
 - Scrivi il contenuto completo e definitivo
 - Il testo deve essere pronto per la pubblicazione
-- RICORDA: ALMENO {thesis_data.get('words_per_section', 5000)} parole! Questo è NON negoziabile.
-"""
+""")
+
+
+_SECTION_CONTENT_TPL = _template("""
+${BAR}
+GENERAZIONE CONTENUTO SEZIONE
+${BAR}
+
+TESI: "$title"
+CAPITOLO $chapter_index: $chapter_title
+SEZIONE $section_index: $section_title
+
+${BAR}
+PARAMETRI DI SCRITTURA
+${BAR}
+
+STILE: $writing_style_name
+  → $writing_style_hint
+
+LIVELLO PROFONDITÀ: $content_depth_name
+PAROLE TARGET: ~$words_per_section parole
+
+${BAR}
+PUBBLICO TARGET
+${BAR}
+
+DESTINATARI: $target_audience_name
+  → $target_audience_hint
+
+LIVELLO CONOSCENZA: $knowledge_level_name
+  → $knowledge_level_hint
+
+SETTORE: $industry_name
+
+${BAR}
+PUNTI CHIAVE DA SVILUPPARE
+${BAR}
+$key_points
+
+${BAR}
+CONTESTO PRECEDENTE
+${BAR}
+$previous_sections_summary
+
+${BAR}
+MATERIALE DI RIFERIMENTO (dagli allegati)
+${BAR}
+$attachments_context
+
+${BAR}
+STILE DELL'AUTORE
+${BAR}
+$author_style_context
+
+${BAR}
+LUNGHEZZA
+${BAR}
+
+REQUISITO CRITICO — LUNGHEZZA MINIMA:
+   ⚠️ Devi scrivere ALMENO $words_per_section parole per questa sezione
+   ⚠️ NON scrivere meno di $words_per_section parole — è un requisito OBBLIGATORIO
+   ⚠️ Se il testo ti sembra lungo, VA BENE — deve essere lungo!
+   ⚠️ Sviluppa OGNI punto in profondità con esempi, analisi, dati e riflessioni
+   ⚠️ Ogni paragrafo deve avere almeno 150-200 parole
+   ⚠️ NON riassumere, NON sintetizzare, NON abbreviare
+
+Segui le istruzioni di scrittura e di output ricevute.
+RICORDA: ALMENO $words_per_section parole! Questo è NON negoziabile.
+""")
+
+
+@functools.lru_cache(maxsize=None)
+def get_section_content_system_prompt(citation_style: str = "footnotes") -> str:
+    """
+    System prompt della FASE 3: istruzioni di scrittura comuni a tutte le
+    sezioni. Dipende solo dallo stile citazioni, quindi resta identico
+    (e memorizzabile nella cache del provider) per l'intera tesi.
+    """
+    return _SECTION_CONTENT_SYSTEM_TPL.substitute(
+        citation_instructions=_get_citation_instructions(citation_style)
+    )
+
+
+def build_section_content_prompt(
+    thesis_data: Dict[str, Any],
+    chapter: Dict[str, Any],
+    section: Dict[str, Any],
+    previous_sections_summary: str = "",
+    attachments_context: str = "",
+    author_style_context: str = ""
+) -> str:
+    """
+    Costruisce il prompt per la FASE 3: Generazione contenuto sezione.
+
+    Args:
+        thesis_data: Parametri della tesi
+        chapter: Dati del capitolo corrente
+        section: Dati della sezione da generare
+        previous_sections_summary: Riassunto delle sezioni precedenti
+        attachments_context: Contesto dagli allegati
+        author_style_context: Contesto dello stile autore (se addestrato)
+
+    Le istruzioni fisse di scrittura non sono incluse: vanno inviate come
+    system prompt con get_section_content_system_prompt().
+
+    Returns:
+        Prompt (messaggio utente) per la generazione del contenuto
+    """
+    key_points = section.get('key_points', [])
+
+    params = _thesis_params(thesis_data)
+    params.update(
+        chapter_index=chapter.get('chapter_index', '?'),
+        chapter_title=chapter.get('chapter_title', 'Non specificato'),
+        section_index=section.get('index', '?'),
+        section_title=section.get('title', 'Non specificato'),
+        key_points=("• " + "\n• ".join(map(str, key_points))) if key_points else "Non specificati",
+        previous_sections_summary=previous_sections_summary or "Questa è la prima sezione della tesi.",
+        attachments_context=attachments_context or "Nessun materiale allegato.",
+        author_style_context=author_style_context or _NO_AUTHOR_STYLE,
+    )
+
+    return _SECTION_CONTENT_TPL.substitute(params)
+
+
+# Prompt per generare in una sola chiamata tutte le sezioni di un capitolo
+# (usato quando le sezioni sono brevi, vedi ai_client.SECTION_BATCH_MAX_WORDS)
+_SECTION_CONTENT_BATCH_TPL = _template("""
+${BAR}
+GENERAZIONE CONTENUTO SEZIONI (INTERO CAPITOLO)
+${BAR}
+
+TESI: "$title"
+CAPITOLO $chapter_index: $chapter_title
+
+${BAR}
+PARAMETRI DI SCRITTURA
+${BAR}
+
+STILE: $writing_style_name
+  → $writing_style_hint
+
+LIVELLO PROFONDITÀ: $content_depth_name
+PAROLE TARGET: ~$words_per_section parole per sezione
+
+${BAR}
+PUBBLICO TARGET
+${BAR}
+
+DESTINATARI: $target_audience_name
+  → $target_audience_hint
+
+LIVELLO CONOSCENZA: $knowledge_level_name
+  → $knowledge_level_hint
+
+SETTORE: $industry_name
+
+${BAR}
+CONTESTO PRECEDENTE
+${BAR}
+$previous_sections_summary
+
+${BAR}
+MATERIALE DI RIFERIMENTO (dagli allegati)
+${BAR}
+$attachments_context
+
+${BAR}
+STILE DELL'AUTORE
+${BAR}
+$author_style_context
+
+${BAR}
+SEZIONI DA GENERARE (in questo ordine)
+${BAR}
+$sections_json
+
+${BAR}
+LUNGHEZZA
+${BAR}
+
+REQUISITO CRITICO — LUNGHEZZA MINIMA:
+   ⚠️ Devi scrivere ALMENO $words_per_section parole per OGNI sezione
+   ⚠️ NON scrivere meno di $words_per_section parole per sezione — è un requisito OBBLIGATORIO
+   ⚠️ Sviluppa OGNI punto chiave in profondità con esempi, analisi, dati e riflessioni
+   ⚠️ NON riassumere, NON sintetizzare, NON abbreviare
+
+Le sezioni sono consecutive: ognuna deve proseguire il discorso della
+precedente senza ripeterne i contenuti.
+
+${BAR}
+FORMATO RISPOSTA
+${BAR}
+
+Rispondi SOLO con un JSON valido (nessun testo prima o dopo):
+{
+  "sections": [
+    {
+      "chapter_index": $chapter_index,
+      "section_index": 1,
+      "content": "Testo completo della sezione..."
+    }
+  ]
+}
+
+- Una voce per OGNI sezione richiesta, nello stesso ordine
+- "content" contiene SOLO il testo della sezione, senza titolo
+- Segui le istruzioni di scrittura ricevute per il testo di ogni sezione
+""")
+
+
+def build_section_content_batch_prompt(
+    thesis_data: Dict[str, Any],
+    chapter: Dict[str, Any],
+    sections: List[Dict[str, Any]],
+    previous_sections_summary: str = "",
+    attachments_context: str = "",
+    author_style_context: str = ""
+) -> str:
+    """
+    Costruisce il prompt per generare piu' sezioni dello stesso capitolo
+    in una sola chiamata, con risposta JSON {"sections": [...]}.
+
+    Come per build_section_content_prompt, le istruzioni fisse di scrittura
+    vanno inviate come system prompt con get_section_content_system_prompt().
+
+    Args:
+        thesis_data: Parametri della tesi
+        chapter: Dati del capitolo corrente
+        sections: Sezioni del capitolo da generare
+        previous_sections_summary: Riassunto delle sezioni dei capitoli precedenti
+        attachments_context: Contesto dagli allegati
+        author_style_context: Contesto dello stile autore (se addestrato)
+
+    Returns:
+        Prompt (messaggio utente) per la generazione delle sezioni
+    """
+    chapter_index = chapter.get('chapter_index', '?')
+    sections_payload = [
+        {
+            "chapter_index": chapter_index,
+            "section_index": section.get('index', i),
+            "title": section.get('title', 'Non specificato'),
+            "key_points": section.get('key_points', []),
+        }
+        for i, section in enumerate(sections, 1)
+    ]
+
+    params = _thesis_params(thesis_data)
+    params.update(
+        chapter_index=chapter_index,
+        chapter_title=chapter.get('chapter_title', 'Non specificato'),
+        sections_json=json.dumps(sections_payload, ensure_ascii=False, indent=2),
+        previous_sections_summary=previous_sections_summary or "Questa è la prima sezione della tesi.",
+        attachments_context=attachments_context or "Nessun materiale allegato.",
+        author_style_context=author_style_context or _NO_AUTHOR_STYLE,
+    )
+
+    return _SECTION_CONTENT_BATCH_TPL.substitute(params)
+
+
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?])\s+')
+_WORD_RE = re.compile(r'\w{4,}')
+
+
+def summarize_section_locally(section_content: str, max_words: int = 50) -> str:
+    """
+    Riassunto estrattivo deterministico di una sezione, senza chiamate AI.
+
+    Ogni frase riceve un punteggio TF-IDF medio (frasi come documenti, parole
+    di almeno 4 caratteri); le frasi migliori vengono riportate nell'ordine
+    originale fino a max_words parole. Alternativa locale a
+    build_section_summary_prompt per il contesto delle sezioni successive.
+
+    Args:
+        section_content: Contenuto della sezione da riassumere
+        max_words: Numero massimo di parole per il riassunto
+
+    Returns:
+        Riassunto della sezione
+    """
+    sentences = [s.strip() for s in _SENTENCE_SPLIT_RE.split(section_content) if s.strip()]
+    if not sentences:
+        return ""
+
+    sentence_words = [[w.lower() for w in _WORD_RE.findall(s)] for s in sentences]
+    term_freq: Dict[str, int] = {}
+    doc_freq: Dict[str, int] = {}
+    for words in sentence_words:
+        for w in words:
+            term_freq[w] = term_freq.get(w, 0) + 1
+        for w in set(words):
+            doc_freq[w] = doc_freq.get(w, 0) + 1
+
+    num_sentences = len(sentences)
+    scores = []
+    for i, words in enumerate(sentence_words):
+        if words:
+            score = sum(term_freq[w] * math.log(num_sentences / doc_freq[w] + 1) for w in words) / len(words)
+        else:
+            score = 0.0
+        scores.append((score, i))
+
+    selected = []
+    total_words = 0
+    for _, i in sorted(scores, key=lambda item: (-item[0], item[1])):
+        length = len(sentences[i].split())
+        if selected and total_words + length > max_words:
+            continue
+        selected.append(i)
+        total_words += length
+        if total_words >= max_words:
+            break
+
+    summary = " ".join(sentences[i] for i in sorted(selected))
+    words = summary.split()
+    if len(words) > max_words:
+        summary = " ".join(words[:max_words]) + "..."
+    return summary
 
 
 def build_section_summary_prompt(section_content: str, max_words: int = 150) -> str:
@@ -486,16 +922,22 @@ def build_thesis_title_enhancement_prompt(
     Returns:
         Prompt per il miglioramento del titolo
     """
+    style_name = thesis_data.get('writing_style_name', 'Non specificato')
+    industry = thesis_data.get('industry_name', 'Generale')
+    audience = thesis_data.get('target_audience_name', 'Generale')
+    # Qui, senza argomenti, la riga resta vuota (non "Non specificati")
+    key_topics = ", ".join(thesis_data.get('key_topics') or [])
+
     return f"""
 Valuta il seguente titolo per una tesi/relazione e, se necessario, suggerisci un miglioramento.
 
 TITOLO ORIGINALE: {original_title}
 
 CONTESTO:
-- Stile: {thesis_data.get('writing_style_name', 'Non specificato')}
-- Settore: {thesis_data.get('industry_name', 'Generale')}
-- Pubblico: {thesis_data.get('target_audience_name', 'Generale')}
-- Argomenti chiave: {', '.join(thesis_data.get('key_topics', []))}
+- Stile: {style_name}
+- Settore: {industry}
+- Pubblico: {audience}
+- Argomenti chiave: {key_topics}
 
 Se il titolo è già efficace, rispondi con: {{"keep_original": true, "title": "{original_title}"}}
 
@@ -506,87 +948,66 @@ Rispondi SOLO con il JSON, senza altro testo.
 """
 
 
-def build_introduction_prompt(
-    thesis_data: Dict[str, Any],
-    chapters_titles: List[str],
-    attachments_context: str = "",
-    author_style_context: str = ""
-) -> str:
-    """
-    Costruisce il prompt per generare l'Introduzione della tesi.
-
-    Args:
-        thesis_data: Parametri della tesi
-        chapters_titles: Lista dei titoli dei capitoli
-        attachments_context: Contesto dagli allegati
-        author_style_context: Contesto dello stile autore
-
-    Returns:
-        Prompt completo per la generazione dell'introduzione
-    """
-    key_topics_str = ", ".join(thesis_data.get('key_topics', [])) if thesis_data.get('key_topics') else "Non specificati"
-    chapters_list = "\n".join([f"  {i+1}. {title}" for i, title in enumerate(chapters_titles)])
-
-    return f"""
-═══════════════════════════════════════════════════════════════════════════════
+_INTRODUCTION_TPL = _template("""
+${BAR}
 GENERAZIONE INTRODUZIONE TESI
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
 Sei un esperto nella scrittura di documenti accademici e professionali.
 Il tuo compito è scrivere l'INTRODUZIONE della tesi.
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 PARAMETRI DELLA TESI
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-TITOLO: {thesis_data.get('title', 'Non specificato')}
-DESCRIZIONE: {thesis_data.get('description', 'Non specificata')}
-ARGOMENTI CHIAVE: {key_topics_str}
+TITOLO: $title
+DESCRIZIONE: $description
+ARGOMENTI CHIAVE: $key_topics
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 PARAMETRI DI SCRITTURA
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-STILE: {thesis_data.get('writing_style_name', 'Non specificato')}
-  → {thesis_data.get('writing_style_hint', '')}
+STILE: $writing_style_name
+  → $writing_style_hint
 
-LIVELLO PROFONDITÀ: {thesis_data.get('content_depth_name', 'Intermedio')}
-PAROLE TARGET: ~{thesis_data.get('words_per_section', 5000)} parole
+LIVELLO PROFONDITÀ: $content_depth_name
+PAROLE TARGET: ~$words_per_section parole
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 PUBBLICO TARGET
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-DESTINATARI: {thesis_data.get('target_audience_name', 'Pubblico Generale')}
-  → {thesis_data.get('target_audience_hint', '')}
+DESTINATARI: $target_audience_name
+  → $target_audience_hint
 
-LIVELLO CONOSCENZA: {thesis_data.get('knowledge_level_name', 'Intermedio')}
-  → {thesis_data.get('knowledge_level_hint', '')}
+LIVELLO CONOSCENZA: $knowledge_level_name
+  → $knowledge_level_hint
 
-SETTORE: {thesis_data.get('industry_name', 'Generale')}
+SETTORE: $industry_name
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 STRUTTURA DEI CAPITOLI DELLA TESI
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-{chapters_list}
+$chapters_list
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 MATERIALE DI RIFERIMENTO (dagli allegati)
-═══════════════════════════════════════════════════════════════════════════════
-{attachments_context if attachments_context else "Nessun materiale allegato."}
+${BAR}
+$attachments_context
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 STILE DELL'AUTORE
-═══════════════════════════════════════════════════════════════════════════════
-{author_style_context if author_style_context else "Nessuno stile specifico addestrato - usa lo stile richiesto nei parametri."}
+${BAR}
+$author_style_context
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 ISTRUZIONI
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-⚠️ REQUISITO CRITICO — LUNGHEZZA: Scrivi ALMENO {thesis_data.get('words_per_section', 5000)} parole.
-NON scrivere meno di {thesis_data.get('words_per_section', 5000)} parole — è OBBLIGATORIO.
+⚠️ REQUISITO CRITICO — LUNGHEZZA: Scrivi ALMENO $words_per_section parole.
+NON scrivere meno di $words_per_section parole — è OBBLIGATORIO.
 Sviluppa ogni punto in profondità con analisi, esempi e riflessioni dettagliate.
 
 L'introduzione deve:
@@ -598,7 +1019,7 @@ L'introduzione deve:
 5. Contestualizzare il lavoro nel panorama attuale del settore
 6. Essere COINVOLGENTE e motivare il lettore a proseguire
 
-{_get_no_citation_instruction(thesis_data.get('citation_style', 'footnotes'))} nell'introduzione.
+$no_citation_instruction nell'introduzione.
 
 SCRIVI COME UNO STUDENTE UNIVERSITARIO REALE:
 - Usa parole normali, evita vocabolario pomposo
@@ -616,92 +1037,102 @@ SCRIVI COME UNO STUDENTE UNIVERSITARIO REALE:
 - Paragrafi di lunghezze MOLTO diverse (da 3 frasi a 10 frasi)
 - Qualche passaggio logico puo' restare implicito
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 OUTPUT
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
 Scrivi SOLO il contenuto dell'introduzione.
 NON includere il titolo "Introduzione" (verra' aggiunto separatamente).
 NON includere meta-commenti o note.
 Il testo deve essere pronto per la pubblicazione.
-"""
+""")
 
 
-def build_conclusion_prompt(
+def build_introduction_prompt(
     thesis_data: Dict[str, Any],
-    content_summary: str,
     chapters_titles: List[str],
+    attachments_context: str = "",
     author_style_context: str = ""
 ) -> str:
     """
-    Costruisce il prompt per generare la Conclusione della tesi.
+    Costruisce il prompt per generare l'Introduzione della tesi.
 
     Args:
         thesis_data: Parametri della tesi
-        content_summary: Riassunto del contenuto generato
         chapters_titles: Lista dei titoli dei capitoli
+        attachments_context: Contesto dagli allegati
         author_style_context: Contesto dello stile autore
 
     Returns:
-        Prompt completo per la generazione della conclusione
+        Prompt completo per la generazione dell'introduzione
     """
-    chapters_list = "\n".join([f"  {i+1}. {title}" for i, title in enumerate(chapters_titles)])
+    params = _thesis_params(thesis_data)
+    params.update(
+        key_topics=_key_topics_text(thesis_data),
+        chapters_list="\n".join(f"  {i}. {title}" for i, title in enumerate(chapters_titles, 1)),
+        attachments_context=attachments_context or "Nessun materiale allegato.",
+        author_style_context=author_style_context or _NO_AUTHOR_STYLE,
+        no_citation_instruction=_get_no_citation_instruction(thesis_data.get('citation_style', 'footnotes')),
+    )
 
-    return f"""
-═══════════════════════════════════════════════════════════════════════════════
+    return _INTRODUCTION_TPL.substitute(params)
+
+
+_CONCLUSION_TPL = _template("""
+${BAR}
 GENERAZIONE CONCLUSIONE TESI
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
 Sei un esperto nella scrittura di documenti accademici e professionali.
 Il tuo compito è scrivere la CONCLUSIONE della tesi.
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 PARAMETRI DELLA TESI
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-TITOLO: {thesis_data.get('title', 'Non specificato')}
-DESCRIZIONE: {thesis_data.get('description', 'Non specificata')}
+TITOLO: $title
+DESCRIZIONE: $description
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 PARAMETRI DI SCRITTURA
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-STILE: {thesis_data.get('writing_style_name', 'Non specificato')}
-  → {thesis_data.get('writing_style_hint', '')}
+STILE: $writing_style_name
+  → $writing_style_hint
 
-LIVELLO PROFONDITÀ: {thesis_data.get('content_depth_name', 'Intermedio')}
-PAROLE TARGET: ~{thesis_data.get('words_per_section', 5000)} parole
+LIVELLO PROFONDITÀ: $content_depth_name
+PAROLE TARGET: ~$words_per_section parole
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 PUBBLICO TARGET
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-DESTINATARI: {thesis_data.get('target_audience_name', 'Pubblico Generale')}
-LIVELLO CONOSCENZA: {thesis_data.get('knowledge_level_name', 'Intermedio')}
+DESTINATARI: $target_audience_name
+LIVELLO CONOSCENZA: $knowledge_level_name
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 CAPITOLI DELLA TESI
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-{chapters_list}
+$chapters_list
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 RIASSUNTO DEI CONTENUTI DELLA TESI
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-{content_summary}
+$content_summary
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 STILE DELL'AUTORE
-═══════════════════════════════════════════════════════════════════════════════
-{author_style_context if author_style_context else "Nessuno stile specifico addestrato - usa lo stile richiesto nei parametri."}
+${BAR}
+$author_style_context
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 ISTRUZIONI
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
-⚠️ REQUISITO CRITICO — LUNGHEZZA: Scrivi ALMENO {thesis_data.get('words_per_section', 5000)} parole.
-NON scrivere meno di {thesis_data.get('words_per_section', 5000)} parole — è OBBLIGATORIO.
+⚠️ REQUISITO CRITICO — LUNGHEZZA: Scrivi ALMENO $words_per_section parole.
+NON scrivere meno di $words_per_section parole — è OBBLIGATORIO.
 Sviluppa ogni punto in profondità con analisi dettagliate e riflessioni.
 
 La conclusione deve:
@@ -712,7 +1143,7 @@ La conclusione deve:
 5. Suggerire possibili SVILUPPI FUTURI e direzioni di ricerca
 6. Chiudere con una riflessione finale significativa
 
-{_get_no_citation_instruction(thesis_data.get('citation_style', 'footnotes'))} nella conclusione.
+$no_citation_instruction nella conclusione.
 NON ripetere verbatim frasi dai capitoli precedenti — rielabora i concetti.
 
 SCRIVI COME UNO STUDENTE UNIVERSITARIO REALE:
@@ -729,20 +1160,133 @@ SCRIVI COME UNO STUDENTE UNIVERSITARIO REALE:
 - Paragrafi di lunghezze MOLTO diverse tra loro
 - Il tono sia riflessivo ma naturale, non magniloquente
 
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 OUTPUT
-═══════════════════════════════════════════════════════════════════════════════
+${BAR}
 
 Scrivi SOLO il contenuto della conclusione.
 NON includere il titolo "Conclusione" (verra' aggiunto separatamente).
 NON includere meta-commenti o note.
 Il testo deve essere pronto per la pubblicazione.
-"""
+""")
+
+
+def build_conclusion_prompt(
+    thesis_data: Dict[str, Any],
+    content_summary: str,
+    chapters_titles: List[str],
+    author_style_context: str = ""
+) -> str:
+    """
+    Costruisce il prompt per generare la Conclusione della tesi.
+
+    Args:
+        thesis_data: Parametri della tesi
+        content_summary: Riassunto del contenuto generato
+        chapters_titles: Lista dei titoli dei capitoli
+        author_style_context: Contesto dello stile autore
+
+    Returns:
+        Prompt completo per la generazione della conclusione
+    """
+    params = _thesis_params(thesis_data)
+    params.update(
+        chapters_list="\n".join(f"  {i}. {title}" for i, title in enumerate(chapters_titles, 1)),
+        content_summary=content_summary,
+        author_style_context=author_style_context or _NO_AUTHOR_STYLE,
+        no_citation_instruction=_get_no_citation_instruction(thesis_data.get('citation_style', 'footnotes')),
+    )
+
+    return _CONCLUSION_TPL.substitute(params)
+
+
+def update_citation_index(citation_index: Dict[int, str], new_text: str) -> Dict[int, str]:
+    """
+    Aggiorna l'indice delle citazioni [x] con un nuovo blocco di testo.
+
+    Per ogni numero di citazione non ancora indicizzato registra la prima
+    frase (delimitata da '.') in cui compare. Pensato per essere chiamato
+    dopo ogni sezione generata, cosi' la bibliografia non deve riscansionare
+    l'intera tesi.
+
+    Args:
+        citation_index: Indice {numero_citazione: contesto} da aggiornare
+        new_text: Testo appena generato
+
+    Returns:
+        Lo stesso indice, aggiornato
+    """
+    for m in _CITE_RE.finditer(new_text):
+        c = int(m.group(1))
+        if c in citation_index:
+            continue
+        end = new_text.find('.', m.end())
+        if end >= 0:
+            start = new_text.rfind('.', 0, m.start()) + 1
+            citation_index[c] = new_text[start:end + 1].strip()[:300]
+        else:
+            # Nessun punto dopo la citazione: finestra di 100 caratteri
+            start = max(0, m.start() - 100)
+            citation_index[c] = new_text[start:m.start() + 100].strip()
+    return citation_index
+
+
+# System prompt statico per le singole voci bibliografiche (stile [x]):
+# identico per tutte le citazioni, quindi riutilizzabile dalla cache del provider
+BIBLIOGRAPHY_ENTRY_SYSTEM = """Sei un ricercatore accademico esperto. Il tuo compito è indicare il
+riferimento bibliografico per UNA citazione [x] di una tesi, a partire dal
+contesto in cui la citazione compare.
+
+Come selezionare la fonte:
+1. Leggi il contesto in cui appare la citazione
+2. Identifica l'argomento specifico trattato in quel punto
+3. Dalla tua conoscenza, seleziona un'opera REALE pertinente a quell'argomento
+4. Privilegia opere classiche e fondamentali del campo che CONOSCI CON CERTEZZA
+5. Se il testo menziona esplicitamente un autore o opera, usa QUELLA
+
+FORMATO richiesto (APA italiano), una sola riga:
+[x] Cognome, N. (Anno). Titolo dell'opera. Casa editrice.
+[x] Cognome, N. & Cognome, N. (Anno). Titolo articolo. Nome Rivista, vol(num), pp-pp.
+[x] Organizzazione. (Anno). Titolo report. URL (se noto)
+
+REGOLE TASSATIVE:
+1. Genera ESATTAMENTE una voce, con il numero della citazione richiesta
+2. NON scrivere messaggi, scuse, avvertenze o disclaimer
+3. NON dire che non puoi farlo — FALLO E BASTA
+4. NON aggiungere note come "verificare", "controllare", "potrebbe non essere reale"
+5. Output: SOLO la voce bibliografica, nient'altro"""
+
+
+def build_bibliography_entry_prompt(
+    citation_num: int,
+    context: str,
+    thesis_data: Dict[str, Any]
+) -> str:
+    """
+    Prompt breve per la voce bibliografica di una singola citazione [x].
+    Va inviato con BIBLIOGRAPHY_ENTRY_SYSTEM come system prompt.
+
+    Args:
+        citation_num: Numero della citazione
+        context: Frase in cui la citazione compare (da update_citation_index)
+        thesis_data: Parametri della tesi
+
+    Returns:
+        Prompt per la singola voce
+    """
+    return f"""TITOLO TESI: {thesis_data.get('title', 'Non specificato')}
+SETTORE: {thesis_data.get('industry_name', 'Generale')}
+
+CITAZIONE: [{citation_num}]
+CONTESTO: "{context}"
+
+Scrivi la voce bibliografica, iniziando con [{citation_num}]."""
 
 
 def build_bibliography_prompt(
     thesis_data: Dict[str, Any],
-    all_content: str
+    all_content: str,
+    citation_index: Optional[Dict[int, str]] = None
 ) -> str:
     """
     Costruisce il prompt per generare la Bibliografia della tesi.
@@ -754,34 +1298,35 @@ def build_bibliography_prompt(
     Args:
         thesis_data: Parametri della tesi
         all_content: Tutto il contenuto generato
+        citation_index: Indice delle citazioni gia' costruito con
+            update_citation_index (se assente viene calcolato da all_content)
 
     Returns:
         Prompt completo per la generazione della bibliografia
     """
-    import re
-
     citation_style = thesis_data.get('citation_style', 'footnotes')
+    title = thesis_data.get('title', 'Non specificato')
+    description = thesis_data.get('description', 'Non specificata')
+    industry = thesis_data.get('industry_name', 'Generale')
+
+    # Estratto del contenuto calcolato una volta per entrambi gli stili
+    if len(all_content) > _BIBLIOGRAPHY_CONTENT_CHARS:
+        content_excerpt = all_content[:_BIBLIOGRAPHY_CONTENT_CHARS]
+        truncation_marker = "[...contenuto troncato...]"
+    else:
+        content_excerpt = all_content
+        truncation_marker = ""
 
     if citation_style == 'bibliography':
         # Stile classico [x]
-        citations = sorted(set(int(m) for m in re.findall(r'\[(\d+)\]', all_content)))
+        if citation_index is None:
+            citation_index = update_citation_index({}, all_content)
+
+        citations = sorted(citation_index)
         citations_str = ", ".join([f"[{c}]" for c in citations]) if citations else "Nessuna citazione trovata"
         num_citations = len(citations)
 
-        citation_contexts = []
-        for c in citations:
-            pattern = rf'[^.]*\[{c}\][^.]*\.'
-            matches = re.findall(pattern, all_content)
-            if matches:
-                context = matches[0].strip()[:300]
-                citation_contexts.append(f"  [{c}] usata nel contesto: \"{context}\"")
-            else:
-                idx = all_content.find(f'[{c}]')
-                if idx >= 0:
-                    start = max(0, idx - 100)
-                    end = min(len(all_content), idx + 100)
-                    context = all_content[start:end].strip()
-                    citation_contexts.append(f"  [{c}] usata nel contesto: \"{context}\"")
+        citation_contexts = [f"  [{c}] usata nel contesto: \"{citation_index[c]}\"" for c in citations]
 
         contexts_text = "\n".join(citation_contexts) if citation_contexts else "Nessun contesto estratto."
 
@@ -789,9 +1334,9 @@ def build_bibliography_prompt(
 bibliografia per una tesi, associando a ogni citazione [x] nel testo
 un riferimento bibliografico appropriato.
 
-TITOLO TESI: {thesis_data.get('title', 'Non specificato')}
-DESCRIZIONE: {thesis_data.get('description', 'Non specificata')}
-SETTORE: {thesis_data.get('industry_name', 'Generale')}
+TITOLO TESI: {title}
+DESCRIZIONE: {description}
+SETTORE: {industry}
 
 CITAZIONI DA RISOLVERE: {citations_str} (totale: {num_citations})
 
@@ -799,8 +1344,8 @@ CONTESTO DI OGNI CITAZIONE:
 {contexts_text}
 
 CONTENUTO DELLA TESI:
-{all_content[:15000]}
-{"[...contenuto troncato...]" if len(all_content) > 15000 else ""}
+{content_excerpt}
+{truncation_marker}
 
 ISTRUZIONI:
 
@@ -833,7 +1378,7 @@ Inizia direttamente con [1] e prosegui fino a [{num_citations}].
 
     else:
         # Stile footnotes {{nota:...}}
-        all_notes = re.findall(r'\{\{nota:\s*(.*?)\}\}', all_content)
+        all_notes = _NOTE_RE.findall(all_content)
 
         full_refs = []
         for note in all_notes:
@@ -850,16 +1395,16 @@ Inizia direttamente con [1] e prosegui fino a [{num_citations}].
 bibliografia finale per una tesi, a partire dalle note a piè di pagina
 inserite nel testo.
 
-TITOLO TESI: {thesis_data.get('title', 'Non specificato')}
-DESCRIZIONE: {thesis_data.get('description', 'Non specificata')}
-SETTORE: {thesis_data.get('industry_name', 'Generale')}
+TITOLO TESI: {title}
+DESCRIZIONE: {description}
+SETTORE: {industry}
 
 RIFERIMENTI TROVATI NELLE NOTE ({num_refs} unici):
 {refs_list}
 
 CONTENUTO DELLA TESI (per contesto):
-{all_content[:15000]}
-{"[...contenuto troncato...]" if len(all_content) > 15000 else ""}
+{content_excerpt}
+{truncation_marker}
 
 ISTRUZIONI:
 
@@ -5,49 +5,81 @@ Questo modulo contiene tutti gli endpoint relativi alla funzionalità
 di generazione tesi, inclusi lookup, CRUD, allegati e fasi di generazione.
 """
 
+import re
+import sys
 import uuid
+import base64
+import hashlib
+import io
+import zipfile
 import json
+import asyncio
 import logging
-from datetime import datetime
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional, List
+from urllib.parse import quote
 
 logger = logging.getLogger(__name__)
 
-from fastapi import APIRouter, HTTPException, UploadFile, File, BackgroundTasks, Depends, Form
-from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session as DBSession
-from sqlalchemy import text
+from fastapi import APIRouter, HTTPException, UploadFile, File, BackgroundTasks, Depends, Form, Request, Query
+from fastapi.responses import FileResponse, Response
+import fitz  # PyMuPDF
+from lxml import etree
+from xml.sax.saxutils import escape as xml_escape, quoteattr as xml_quoteattr
+
+# Importazione condizionale per python-docx (solo export DOCX)
+try:
+    from docx import Document as DocxDocument
+    from docx.shared import Pt, Inches, Cm, Emu
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from docx.oxml.ns import qn, nsdecls
+    from docx.oxml import OxmlElement, parse_xml
+    DOCX_AVAILABLE = True
+except ImportError:
+    DOCX_AVAILABLE = False
+from sqlalchemy.orm import Session as DBSession, raiseload, selectinload, undefer
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import text, select, insert, update, delete, func, tuple_, cast, Text
+from sqlalchemy.dialects.postgresql import JSONB, array as pg_array, insert as pg_insert
 
 from models import (
     ThesisCreateRequest, ThesisResponse, ThesisListResponse,
     ThesisAttachmentResponse, ThesisAttachmentsListResponse,
     GenerateChaptersResponse, ConfirmChaptersRequest,
     GenerateSectionsResponse, ConfirmSectionsRequest,
-    StartContentGenerationResponse, GenerationStatusResponse,
+    StartContentGenerationResponse, GenerationStatusResponse, PartialContentResponse,
     ChapterGenerationStatus, SectionGenerationStatus, LookupDataResponse,
-    WritingStyleResponse, ContentDepthResponse,
-    AudienceKnowledgeLevelResponse, AudienceSizeResponse,
-    IndustryResponse, TargetAudienceResponse,
     ThesisStatus, ChapterInfo, ThesisUrlAttachmentRequest,
     ThesisResearchSearchRequest, ThesisResearchSummarizeRequest,
     ThesisAddPapersRequest, ThesisAddPapersResponse,
 )
 from db_models import (
-    User, Thesis, ThesisAttachment, ThesisGenerationJob,
+    User, Thesis, ThesisAttachment, ThesisGenerationJob, ThesisContentChunk,
     WritingStyle, ContentDepthLevel, AudienceKnowledgeLevel,
     AudienceSize, Industry, TargetAudience, Session
 )
-from database import SessionLocal, get_db
-from auth import get_current_active_user, require_permission
+from database import SessionLocal, get_db, get_async_db
+from auth import AuthedUser, get_current_authed_user, require_permission
 from credits import estimate_credits, deduct_credits
 from attachment_processor import (
-    process_attachment, save_uploaded_file, delete_attachment_file,
-    build_attachments_context, cleanup_thesis_attachments
+    process_attachment_async, save_uploaded_file, delete_attachment_file,
+    build_attachments_context, chars_per_attachment, cleanup_thesis_attachments
 )
-from ai_client import get_ai_client, humanize_text_with_claude
+from ai_client import get_ai_client, humanize_text_with_claude, BatchGenerateClient, SECTION_BATCH_MAX_WORDS
 from ai_exceptions import InsufficientCreditsError
 from session_manager import session_manager
+from thesis_prompts import (
+    format_key_topics, summarize_section_locally,
+    build_introduction_prompt, build_conclusion_prompt,
+    build_bibliography_prompt, update_citation_index,
+    build_bibliography_entry_prompt, BIBLIOGRAPHY_ENTRY_SYSTEM,
+    get_section_content_system_prompt
+)
 from template_service import get_template_by_id, get_page_dimensions, get_export_templates
 from research_providers import UnifiedPaper
 from research_service import DEFAULT_SOURCES, PROVIDER_REGISTRY, run_search_pipeline
@@ -62,29 +94,183 @@ import config
 # Mime type convenzionale per allegati di tipo "paper accademico"
 PAPER_MIME_TYPE = "application/x-research-paper"
 
+# Serializzazione JSON con orjson (piu' rapida della catena json + encoder
+# Pydantic sulle liste di tesi e allegati), se disponibile
+try:
+    import orjson
+    from fastapi.responses import ORJSONResponse as DefaultJSONResponse
+except ImportError:
+    orjson = None
+    from fastapi.responses import JSONResponse as DefaultJSONResponse
+    logger.warning("orjson non installato: uso la serializzazione JSON standard")
+
 # Router
-router = APIRouter(prefix="/api/thesis", tags=["Thesis Generation"])
+router = APIRouter(
+    prefix="/api/thesis",
+    tags=["Thesis Generation"],
+    default_response_class=DefaultJSONResponse
+)
 
 
 # ============================================================================
 # HELPER FUNCTIONS
 # ============================================================================
 
-def get_thesis_by_id(db: DBSession, thesis_id: str, user_id: str) -> Thesis:
-    """Recupera una tesi verificando l'ownership."""
-    thesis = db.query(Thesis).filter(
+# Allegati della tesi (senza extracted_text, che e' deferred): una SELECT IN
+# emessa insieme alla query della tesi. Gli id fanno da chiave per la cache
+# di get_attachments_context.
+_THESIS_ATTACHMENTS_LOAD = selectinload(Thesis.attachments)
+
+# I valori di lookup usati nei prompt arrivano da _get_lookup_row (cache in
+# memoria), non dalle relazioni: la tesi si legge senza JOIN. Negli handler si
+# aggiunge raiseload('*'): ogni relazione letta per errore solleva subito
+# un'eccezione invece di diventare una query N+1.
+
+def load_thesis(db: DBSession, thesis_id: str, *options) -> Optional[Thesis]:
+    """Recupera una tesi (senza verifica ownership; options: relazioni da caricare)."""
+    return db.scalars(select(Thesis).options(*options).where(
+        Thesis.id == thesis_id
+    )).first()
+
+
+def get_thesis_by_id(db: DBSession, thesis_id: str, user_id: str, *options) -> Thesis:
+    """Recupera una tesi verificando l'ownership (options: relazioni da caricare)."""
+    thesis = db.scalars(select(Thesis).options(*options, raiseload('*')).where(
         Thesis.id == thesis_id,
         Thesis.user_id == user_id
+    )).first()
+
+    if not thesis:
+        raise HTTPException(status_code=404, detail="Tesi non trovata")
+
+    return thesis
+
+
+def get_thesis_for_new_attachments(db: DBSession, thesis_id: str, user_id: str, new_count: int) -> Thesis:
+    """
+    Recupera una tesi verificando l'ownership e il limite allegati.
+
+    Il numero di allegati esistenti arriva come subquery correlata nella
+    stessa SELECT della tesi: un solo round trip invece di due.
+    """
+    attachment_count = select(func.count()).where(
+        ThesisAttachment.thesis_id == Thesis.id
+    ).correlate(Thesis).scalar_subquery()
+
+    row = db.execute(
+        select(Thesis, attachment_count).options(raiseload('*')).where(
+            Thesis.id == thesis_id,
+            Thesis.user_id == user_id
+        )
     ).first()
 
+    if not row:
+        raise HTTPException(status_code=404, detail="Tesi non trovata")
+
+    thesis, existing_count = row
+    if existing_count + new_count > config.THESIS_MAX_ATTACHMENTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Superato il limite di {config.THESIS_MAX_ATTACHMENTS} allegati"
+        )
+
+    return thesis
+
+
+async def get_thesis_by_id_async(db: AsyncSession, thesis_id: str, user_id: str, *options) -> Thesis:
+    """Versione asincrona di get_thesis_by_id (senza lookup, con raiseload)."""
+    stmt = select(Thesis).options(*options, raiseload('*')).where(
+        Thesis.id == thesis_id,
+        Thesis.user_id == user_id
+    )
+    thesis = (await db.execute(stmt)).scalar_one_or_none()
+
     if not thesis:
         raise HTTPException(status_code=404, detail="Tesi non trovata")
 
     return thesis
 
 
+# Campi di thesis_data con valori presi da tabelle di lookup (insieme ristretto)
+_INTERNED_LOOKUP_KEYS = (
+    "writing_style_name", "content_depth_name", "knowledge_level_name",
+    "audience_size_name", "industry_name", "target_audience_name", "citation_style",
+)
+
+
+# Righe di lookup (nome e, dove esiste, prompt_hint) per (tabella, id): tabelle
+# piccole e quasi statiche, lette una riga alla volta al primo uso e tenute per
+# THESIS_LOOKUP_CACHE_TTL secondi. Svuotata da invalidate_lookup_cache().
+_lookup_rows_cache = {}  # (tabella, id) -> (riga, caricata_alle)
+_lookup_rows_lock = threading.Lock()
+
+
+def _get_lookup_row(db: DBSession, model, pk: Optional[int]) -> Optional[dict]:
+    """Campi di una riga di lookup usati nei prompt, dalla cache o dal DB."""
+    if pk is None:
+        return None
+
+    key = (model.__tablename__, pk)
+    cached = _lookup_rows_cache.get(key)
+    if cached is not None and time.monotonic() - cached[1] < config.THESIS_LOOKUP_CACHE_TTL:
+        return cached[0]
+
+    columns = [model.name, model.prompt_hint] if hasattr(model, "prompt_hint") else [model.name]
+    result = db.execute(select(*columns).where(model.id == pk)).first()
+    if result is None:
+        return None
+
+    row = result._asdict()
+    with _lookup_rows_lock:
+        _lookup_rows_cache[key] = (row, time.monotonic())
+    return row
+
+
+# thesis_data gia' costruiti, per tesi: le fasi di generazione (capitoli,
+# sezioni, contenuto) lo riusano. Ogni voce ricorda l'updated_at della tesi
+# da cui e' stata costruita: qualsiasi modifica alla riga (anche con UPDATE
+# diretta, tramite il trigger su updated_at) la rende non piu' valida. I
+# valori di lookup cambiano solo con invalidate_lookup_cache().
+_THESIS_DATA_CACHE_SIZE = 256
+_thesis_data_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_thesis_data_lock = threading.Lock()
+
+
+def invalidate_thesis_data(thesis_id: Optional[str] = None) -> None:
+    """Rimuove il thesis_data di una tesi dalla cache (tutte se thesis_id e' None)."""
+    with _thesis_data_lock:
+        if thesis_id is None:
+            _thesis_data_cache.clear()
+        else:
+            _thesis_data_cache.pop(str(thesis_id), None)
+
+
 def build_thesis_data_dict(thesis: Thesis, db: DBSession) -> dict:
-    """Costruisce il dizionario con tutti i dati della tesi per i prompt."""
+    """
+    Costruisce il dizionario con tutti i dati della tesi per i prompt.
+
+    Il dizionario restituito e' condiviso tramite cache: non va modificato.
+    """
+    key = str(thesis.id)
+    with _thesis_data_lock:
+        entry = _thesis_data_cache.get(key)
+        if entry is not None and entry[0] == thesis.updated_at:
+            _thesis_data_cache.move_to_end(key)
+            return entry[1]
+
+    data = _build_thesis_data(thesis, db)
+
+    with _thesis_data_lock:
+        _thesis_data_cache[key] = (thesis.updated_at, data)
+        _thesis_data_cache.move_to_end(key)
+        while len(_thesis_data_cache) > _THESIS_DATA_CACHE_SIZE:
+            _thesis_data_cache.popitem(last=False)
+
+    return data
+
+
+def _build_thesis_data(thesis: Thesis, db: DBSession) -> dict:
+    """Costruisce thesis_data dai campi e dalle relazioni di lookup della tesi."""
     data = {
         "title": thesis.title,
         "description": thesis.description,
@@ -94,158 +280,378 @@ def build_thesis_data_dict(thesis: Thesis, db: DBSession) -> dict:
         "words_per_section": thesis.words_per_section,
         "citation_style": getattr(thesis, 'citation_style', 'footnotes') or 'footnotes',
     }
-
-    # Carica i dati di lookup
-    if thesis.writing_style_id:
-        style = db.query(WritingStyle).get(thesis.writing_style_id)
-        if style:
-            data["writing_style_name"] = style.name
-            data["writing_style_hint"] = style.prompt_hint or ""
-
-    if thesis.content_depth_id:
-        depth = db.query(ContentDepthLevel).get(thesis.content_depth_id)
-        if depth:
-            data["content_depth_name"] = depth.name
-
-    if thesis.knowledge_level_id:
-        level = db.query(AudienceKnowledgeLevel).get(thesis.knowledge_level_id)
-        if level:
-            data["knowledge_level_name"] = level.name
-            data["knowledge_level_hint"] = level.prompt_hint or ""
-
-    if thesis.audience_size_id:
-        size = db.query(AudienceSize).get(thesis.audience_size_id)
-        if size:
-            data["audience_size_name"] = size.name
-
-    if thesis.industry_id:
-        industry = db.query(Industry).get(thesis.industry_id)
-        if industry:
-            data["industry_name"] = industry.name
-
-    if thesis.target_audience_id:
-        target = db.query(TargetAudience).get(thesis.target_audience_id)
-        if target:
-            data["target_audience_name"] = target.name
-            data["target_audience_hint"] = target.prompt_hint or ""
+    # Testo degli argomenti chiave calcolato una volta per tutti i prompt
+    data["key_topics_text"] = format_key_topics(data)
+
+    # Dati di lookup dalla cache delle righe (una query solo al primo uso)
+    style = _get_lookup_row(db, WritingStyle, thesis.writing_style_id)
+    if style:
+        data["writing_style_name"] = style["name"]
+        data["writing_style_hint"] = style["prompt_hint"] or ""
+
+    depth = _get_lookup_row(db, ContentDepthLevel, thesis.content_depth_id)
+    if depth:
+        data["content_depth_name"] = depth["name"]
+
+    level = _get_lookup_row(db, AudienceKnowledgeLevel, thesis.knowledge_level_id)
+    if level:
+        data["knowledge_level_name"] = level["name"]
+        data["knowledge_level_hint"] = level["prompt_hint"] or ""
+
+    size = _get_lookup_row(db, AudienceSize, thesis.audience_size_id)
+    if size:
+        data["audience_size_name"] = size["name"]
+
+    industry = _get_lookup_row(db, Industry, thesis.industry_id)
+    if industry:
+        data["industry_name"] = industry["name"]
+
+    target = _get_lookup_row(db, TargetAudience, thesis.target_audience_id)
+    if target:
+        data["target_audience_name"] = target["name"]
+        data["target_audience_hint"] = target["prompt_hint"] or ""
+
+    # I nomi dei lookup provengono da poche tabelle fisse: internarli evita
+    # copie identiche tra le tesi (e confronti piu' rapidi nelle cache dei prompt)
+    for key in _INTERNED_LOOKUP_KEYS:
+        value = data.get(key)
+        if isinstance(value, str):
+            data[key] = sys.intern(value)
 
     return data
 
 
+# Contesto allegati gia' costruito, per (tesi, insieme di allegati): le tre
+# fasi di generazione lo riusano invece di rileggere i testi dal DB. Il testo
+# di un allegato non cambia dopo il caricamento, quindi gli id bastano come chiave.
+# Insieme al contesto si conserva la lunghezza totale dei testi (usata per la
+# stima crediti), letta dalla stessa query.
+_ATTACHMENTS_CONTEXT_CACHE_SIZE = 64
+_attachments_context_cache: "OrderedDict[tuple, tuple[str, int]]" = OrderedDict()
+_attachments_context_lock = threading.Lock()
+
+
+def _get_attachments_entry(db: DBSession, thesis: Thesis) -> tuple[str, int]:
+    """(contesto, caratteri totali) degli allegati della tesi, dalla cache o dal DB."""
+    attachment_ids = tuple(sorted(str(a.id) for a in thesis.attachments))
+    if not attachment_ids:
+        return "", 0
+
+    key = (str(thesis.id), attachment_ids)
+    with _attachments_context_lock:
+        entry = _attachments_context_cache.get(key)
+        if entry is not None:
+            _attachments_context_cache.move_to_end(key)
+            return entry
+
+    # Un carattere oltre il limite: build_attachments_context deve poter
+    # riconoscere i testi da troncare
+    max_chars_per_doc = chars_per_attachment(len(attachment_ids))
+    rows = db.execute(
+        select(
+            ThesisAttachment.original_filename,
+            func.substr(ThesisAttachment.extracted_text, 1, max_chars_per_doc + 1).label("extracted_text"),
+            func.coalesce(func.char_length(ThesisAttachment.extracted_text), 0).label("text_chars")
+        )
+        .where(ThesisAttachment.thesis_id == thesis.id)
+        .order_by(ThesisAttachment.created_at, ThesisAttachment.id)
+    ).mappings().all()
+    # Le RowMapping espongono gia' get()/[]: nessun dizionario intermedio
+    entry = (
+        build_attachments_context(rows, max_chars_per_doc=max_chars_per_doc),
+        sum(row["text_chars"] for row in rows)
+    )
+
+    with _attachments_context_lock:
+        _attachments_context_cache[key] = entry
+        while len(_attachments_context_cache) > _ATTACHMENTS_CONTEXT_CACHE_SIZE:
+            _attachments_context_cache.popitem(last=False)
+
+    return entry
+
+
+def invalidate_attachments_context(thesis_id) -> None:
+    """
+    Rimuove dalla cache i contesti allegati di una tesi.
+
+    Le voci superate non sarebbero piu' lette (la chiave contiene gli id degli
+    allegati), ma resterebbero in memoria fino all'espulsione LRU.
+    """
+    thesis_key = str(thesis_id)
+    with _attachments_context_lock:
+        for key in [k for k in _attachments_context_cache if k[0] == thesis_key]:
+            del _attachments_context_cache[key]
+
+
+def get_attachments_context(db: DBSession, thesis: Thesis) -> str:
+    """
+    Contesto allegati per i prompt (thesis.attachments deve essere gia' caricato).
+
+    extracted_text e' deferred: dal DB arriva solo la parte di testo che entra
+    nel contesto (substr), non il testo completo di ogni allegato.
+    """
+    return _get_attachments_entry(db, thesis)[0]
+
+
+def get_attachments_chars(db: DBSession, thesis: Thesis) -> int:
+    """Caratteri totali degli allegati (stessa cache di get_attachments_context)."""
+    return _get_attachments_entry(db, thesis)[1]
+
+
 # ============================================================================
 # LOOKUP ENDPOINTS
 # ============================================================================
 
+# Tabelle di lookup: chiave nella risposta -> modello
+_LOOKUP_MODELS = (
+    ("writing_styles", WritingStyle),
+    ("content_depths", ContentDepthLevel),
+    ("knowledge_levels", AudienceKnowledgeLevel),
+    ("audience_sizes", AudienceSize),
+    ("industries", Industry),
+    ("target_audiences", TargetAudience),
+)
+
+# Campi presenti solo su alcune tabelle di lookup, con le stesse regole di to_dict()
+_LOOKUP_OPTIONAL_FIELDS = {
+    "prompt_hint": "prompt_hint",
+    "detail_multiplier": "COALESCE(NULLIF(detail_multiplier, 0), 1.0)",
+    "keywords": "COALESCE(to_jsonb(keywords), '[]'::jsonb)",
+}
+
+
+def _lookup_json_sql() -> str:
+    """
+    Query che costruisce in Postgres l'intero oggetto dei lookup:
+    {chiave: [righe attive ordinate per sort_order]} con jsonb_agg.
+    """
+    parts = []
+    for kind, model in _LOOKUP_MODELS:
+        fields = ["'id', id", "'code', code", "'name', name", "'description', description"]
+        fields += [
+            f"'{col}', {expr}"
+            for col, expr in _LOOKUP_OPTIONAL_FIELDS.items()
+            if hasattr(model, col)
+        ]
+        parts.append(
+            f"'{kind}', COALESCE((SELECT jsonb_agg(jsonb_build_object({', '.join(fields)}) "
+            f"ORDER BY sort_order, id) FROM {model.__tablename__} WHERE is_active), '[]'::jsonb)"
+        )
+    return f"SELECT jsonb_build_object({', '.join(parts)})"
+
+
+_LOOKUP_JSON_SQL = text(_lookup_json_sql())
+
+
+def _load_lookup_data(db: DBSession) -> dict:
+    """
+    Carica tutte le tabelle di lookup attive con una sola query.
+
+    Il JSON viene aggregato lato DB: nessun oggetto ORM ne' to_dict() per
+    riga. Ritorna {chiave: [dict]} con gli stessi campi di to_dict().
+    """
+    return db.execute(_LOOKUP_JSON_SQL).scalar_one()
+
+
+# Chiave usata da ciascun endpoint /lookup/* nella propria risposta
+_LOOKUP_ENDPOINT_KEYS = {
+    "writing_styles": "styles",
+    "content_depths": "levels",
+    "knowledge_levels": "levels",
+    "audience_sizes": "sizes",
+    "industries": "industries",
+    "target_audiences": "audiences",
+}
+
+# Le tabelle di lookup non cambiano a runtime: le risposte JSON vengono
+# serializzate una volta e servite dalla memoria fino alla scadenza del TTL
+_lookup_cache = {"payloads": None, "loaded_at": 0.0}
+_lookup_cache_lock = threading.Lock()
+
+
+def invalidate_lookup_cache():
+    """Svuota la cache dei lookup (la prossima richiesta ricarica dal DB)."""
+    with _lookup_cache_lock:
+        _lookup_cache["payloads"] = None
+        _lookup_cache["loaded_at"] = 0.0
+    with _lookup_rows_lock:
+        _lookup_rows_cache.clear()
+    # Nomi e suggerimenti dei lookup sono copiati nei thesis_data in cache
+    invalidate_thesis_data()
+
+
+def _dumps_json(data) -> bytes:
+    """Serializza in JSON (bytes) con orjson se disponibile."""
+    if orjson is not None:
+        return orjson.dumps(data, default=str)
+    return json.dumps(data, default=str).encode()
+
+
+def _build_lookup_payloads(db: DBSession) -> dict:
+    """
+    Serializza i lookup: {chiave: (corpo JSON, ETag)}.
+
+    "all" ha la forma di LookupDataResponse, le altre chiavi la risposta del
+    singolo endpoint /lookup/* corrispondente.
+    """
+    data = _load_lookup_data(db)
+    bodies = {
+        kind: _dumps_json({_LOOKUP_ENDPOINT_KEYS[kind]: items})
+        for kind, items in data.items()
+    }
+    # Stessa forma di LookupDataResponse, serializzata senza passare da Pydantic
+    bodies["all"] = _dumps_json({kind: data[kind] for kind, _ in _LOOKUP_MODELS})
+
+    return {
+        kind: (body, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"')
+        for kind, body in bodies.items()
+    }
+
+
+def _get_lookup_payloads(db: DBSession) -> dict:
+    """
+    Ritorna le risposte dei lookup dalla cache, ricaricandola se scaduta.
+
+    Alla scadenza del TTL un solo thread ricarica dal DB: le richieste
+    concorrenti continuano a ricevere la copia precedente invece di
+    accodarsi sul lock (stale-while-revalidate).
+    """
+    payloads = _lookup_cache["payloads"]
+    if payloads is not None and time.monotonic() - _lookup_cache["loaded_at"] < config.THESIS_LOOKUP_CACHE_TTL:
+        return payloads
+
+    # Senza copia precedente si attende il caricamento in corso
+    if not _lookup_cache_lock.acquire(blocking=payloads is None):
+        return payloads
+    try:
+        payloads = _lookup_cache["payloads"]
+        if payloads is not None and time.monotonic() - _lookup_cache["loaded_at"] < config.THESIS_LOOKUP_CACHE_TTL:
+            return payloads
+
+        payloads = _build_lookup_payloads(db)
+        _lookup_cache["payloads"] = payloads
+        _lookup_cache["loaded_at"] = time.monotonic()
+        return payloads
+    finally:
+        _lookup_cache_lock.release()
+
+
+def warm_lookup_cache():
+    """
+    Pre-carica la cache dei lookup all'avvio: payload ed ETag sono pronti
+    prima della prima richiesta.
+    """
+    db = SessionLocal()
+    try:
+        _get_lookup_payloads(db)
+    finally:
+        db.close()
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Confronto debole di If-None-Match (RFC 9110): accetta "*", le liste di
+    tag e i tag W/ che alcuni proxy producono ricomprimendo la risposta.
+    """
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+async def _lookup_response(request: Request, db: DBSession, kind: str) -> Response:
+    """
+    Risposta JSON di un lookup servita dalla cache.
+
+    Include ETag e Cache-Control: il browser riusa la propria copia per la
+    durata del TTL e poi la rivalida con un 304, senza che nessun worker
+    debba serializzare di nuovo i dati.
+    """
+    payloads = _lookup_cache["payloads"]
+    if payloads is None or time.monotonic() - _lookup_cache["loaded_at"] >= config.THESIS_LOOKUP_CACHE_TTL:
+        # Cache assente o scaduta: la query va in un thread, non blocca l'event loop
+        payloads = await asyncio.to_thread(_get_lookup_payloads, db)
+    body, etag = payloads[kind]
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={config.THESIS_LOOKUP_CACHE_TTL}",
+    }
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
 @router.get("/lookup", response_model=LookupDataResponse)
 async def get_all_lookup_data(
-    current_user: User = Depends(get_current_active_user),
+    request: Request,
+    current_user: AuthedUser = Depends(get_current_authed_user),
     db: DBSession = Depends(get_db)
 ):
     """Restituisce tutti i dati di lookup in una singola chiamata."""
-    writing_styles = db.query(WritingStyle).filter(
-        WritingStyle.is_active == True
-    ).order_by(WritingStyle.sort_order).all()
-
-    content_depths = db.query(ContentDepthLevel).filter(
-        ContentDepthLevel.is_active == True
-    ).order_by(ContentDepthLevel.sort_order).all()
-
-    knowledge_levels = db.query(AudienceKnowledgeLevel).filter(
-        AudienceKnowledgeLevel.is_active == True
-    ).order_by(AudienceKnowledgeLevel.sort_order).all()
-
-    audience_sizes = db.query(AudienceSize).filter(
-        AudienceSize.is_active == True
-    ).order_by(AudienceSize.sort_order).all()
-
-    industries = db.query(Industry).filter(
-        Industry.is_active == True
-    ).order_by(Industry.sort_order).all()
-
-    target_audiences = db.query(TargetAudience).filter(
-        TargetAudience.is_active == True
-    ).order_by(TargetAudience.sort_order).all()
-
-    return LookupDataResponse(
-        writing_styles=[WritingStyleResponse(**s.to_dict()) for s in writing_styles],
-        content_depths=[ContentDepthResponse(**d.to_dict()) for d in content_depths],
-        knowledge_levels=[AudienceKnowledgeLevelResponse(**l.to_dict()) for l in knowledge_levels],
-        audience_sizes=[AudienceSizeResponse(**s.to_dict()) for s in audience_sizes],
-        industries=[IndustryResponse(**i.to_dict()) for i in industries],
-        target_audiences=[TargetAudienceResponse(**t.to_dict()) for t in target_audiences]
-    )
+    return await _lookup_response(request, db, "all")
 
 
 @router.get("/lookup/writing-styles")
 async def get_writing_styles(
-    current_user: User = Depends(get_current_active_user),
+    request: Request,
+    current_user: AuthedUser = Depends(get_current_authed_user),
     db: DBSession = Depends(get_db)
 ):
     """Restituisce gli stili di scrittura disponibili."""
-    styles = db.query(WritingStyle).filter(
-        WritingStyle.is_active == True
-    ).order_by(WritingStyle.sort_order).all()
-    return {"styles": [s.to_dict() for s in styles]}
+    return await _lookup_response(request, db, "writing_styles")
 
 
 @router.get("/lookup/content-depths")
 async def get_content_depths(
-    current_user: User = Depends(get_current_active_user),
+    request: Request,
+    current_user: AuthedUser = Depends(get_current_authed_user),
     db: DBSession = Depends(get_db)
 ):
     """Restituisce i livelli di profondità contenuto."""
-    levels = db.query(ContentDepthLevel).filter(
-        ContentDepthLevel.is_active == True
-    ).order_by(ContentDepthLevel.sort_order).all()
-    return {"levels": [l.to_dict() for l in levels]}
+    return await _lookup_response(request, db, "content_depths")
 
 
 @router.get("/lookup/knowledge-levels")
 async def get_knowledge_levels(
-    current_user: User = Depends(get_current_active_user),
+    request: Request,
+    current_user: AuthedUser = Depends(get_current_authed_user),
     db: DBSession = Depends(get_db)
 ):
     """Restituisce i livelli di conoscenza del pubblico."""
-    levels = db.query(AudienceKnowledgeLevel).filter(
-        AudienceKnowledgeLevel.is_active == True
-    ).order_by(AudienceKnowledgeLevel.sort_order).all()
-    return {"levels": [l.to_dict() for l in levels]}
+    return await _lookup_response(request, db, "knowledge_levels")
 
 
 @router.get("/lookup/audience-sizes")
 async def get_audience_sizes(
-    current_user: User = Depends(get_current_active_user),
+    request: Request,
+    current_user: AuthedUser = Depends(get_current_authed_user),
     db: DBSession = Depends(get_db)
 ):
     """Restituisce le dimensioni del pubblico."""
-    sizes = db.query(AudienceSize).filter(
-        AudienceSize.is_active == True
-    ).order_by(AudienceSize.sort_order).all()
-    return {"sizes": [s.to_dict() for s in sizes]}
+    return await _lookup_response(request, db, "audience_sizes")
 
 
 @router.get("/lookup/industries")
 async def get_industries(
-    current_user: User = Depends(get_current_active_user),
+    request: Request,
+    current_user: AuthedUser = Depends(get_current_authed_user),
     db: DBSession = Depends(get_db)
 ):
     """Restituisce i settori/industrie."""
-    industries = db.query(Industry).filter(
-        Industry.is_active == True
-    ).order_by(Industry.sort_order).all()
-    return {"industries": [i.to_dict() for i in industries]}
+    return await _lookup_response(request, db, "industries")
 
 
 @router.get("/lookup/target-audiences")
 async def get_target_audiences(
-    current_user: User = Depends(get_current_active_user),
+    request: Request,
+    current_user: AuthedUser = Depends(get_current_authed_user),
     db: DBSession = Depends(get_db)
 ):
     """Restituisce i destinatari target."""
-    audiences = db.query(TargetAudience).filter(
-        TargetAudience.is_active == True
-    ).order_by(TargetAudience.sort_order).all()
-    return {"audiences": [a.to_dict() for a in audiences]}
+    return await _lookup_response(request, db, "target_audiences")
 
 
 # ============================================================================
@@ -256,7 +662,7 @@ async def get_target_audiences(
 async def create_thesis(
     request: ThesisCreateRequest,
     current_user: User = Depends(require_permission('thesis')),
-    db: DBSession = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Crea una nuova tesi/relazione.
@@ -266,12 +672,12 @@ async def create_thesis(
     # Verifica sessione se specificata
     session_uuid = None
     if request.session_id:
-        session = db.query(Session).filter(
-            Session.session_id == request.session_id,
-            Session.user_id == current_user.id
-        ).first()
-        if session:
-            session_uuid = session.id
+        session_uuid = (await db.execute(
+            select(Session.id).where(
+                Session.session_id == request.session_id,
+                Session.user_id == current_user.id
+            )
+        )).scalar_one_or_none()
 
     # Crea la tesi
     thesis = Thesis(
@@ -295,58 +701,155 @@ async def create_thesis(
     )
 
     db.add(thesis)
-    db.commit()
-    db.refresh(thesis)
+    await db.commit()
+    await db.refresh(thesis)
 
     return ThesisResponse(**thesis.to_dict())
 
 
+# Colonne di ThesisResponse lette da list_theses: il contenuto generato e la
+# struttura dei capitoli (i campi piu' pesanti) servono solo nel dettaglio
+_THESIS_LIST_COLUMNS = (
+    "id", "session_id", "title", "description", "key_topics",
+    "writing_style_id", "content_depth_id", "num_chapters",
+    "sections_per_chapter", "words_per_section", "knowledge_level_id",
+    "audience_size_id", "industry_id", "target_audience_id", "ai_provider",
+    "citation_style", "status", "current_phase", "generation_progress",
+    "total_words_generated", "created_at", "updated_at", "completed_at",
+)
+
+
+def _thesis_list_item(row) -> dict:
+    """
+    Voce di ThesisListResponse da una riga proiettata (stesse regole di
+    Thesis.to_dict), gia' nella forma JSON: nessun modello Pydantic per tesi.
+    """
+    data = row._asdict()
+    del data["total"]
+    data["id"] = str(data["id"])
+    data["session_id"] = str(data["session_id"]) if data["session_id"] else None
+    data["key_topics"] = data["key_topics"] or []
+    data["ai_provider"] = data["ai_provider"] or "openai"
+    data["citation_style"] = data["citation_style"] or "footnotes"
+    for name in ("created_at", "updated_at", "completed_at"):
+        if data[name] is not None:
+            data[name] = data[name].isoformat()
+    # Campi pesanti esclusi dalla lista (come i default di ThesisResponse)
+    data["chapters_structure"] = None
+    data["generated_content"] = None
+    return data
+
+
+def _encode_thesis_cursor(thesis) -> str:
+    """Cursore opaco (created_at, id) dell'ultima tesi di una pagina."""
+    raw = f"{thesis.created_at.isoformat()}|{thesis.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_thesis_cursor(cursor: str) -> tuple:
+    """Decodifica un cursore di paginazione in (created_at, id)."""
+    try:
+        created_at, thesis_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), uuid.UUID(thesis_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursore di paginazione non valido")
+
+
 @router.get("", response_model=ThesisListResponse)
 async def list_theses(
     status: Optional[str] = None,
-    current_user: User = Depends(get_current_active_user),
-    db: DBSession = Depends(get_db)
+    limit: Optional[int] = Query(None, ge=1, le=100),
+    cursor: Optional[str] = None,
+    current_user: AuthedUser = Depends(get_current_authed_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Elenca tutte le tesi dell'utente."""
-    query = db.query(Thesis).filter(Thesis.user_id == current_user.id)
+    """
+    Elenca le tesi dell'utente, dalla piu' recente.
 
+    Senza limit restituisce tutte le tesi. Con limit la lista e' paginata
+    per keyset: next_cursor va passato come cursor per la pagina successiva.
+    chapters_structure e generated_content non sono inclusi: si leggono dal
+    dettaglio GET /{thesis_id}.
+    """
+    filters = [Thesis.user_id == current_user.id]
     if status:
-        query = query.filter(Thesis.status == status)
-
-    theses = query.order_by(Thesis.created_at.desc()).all()
-
-    return ThesisListResponse(
-        theses=[ThesisResponse(**t.to_dict()) for t in theses],
-        total=len(theses)
+        filters.append(Thesis.status == status)
+
+    # Il totale e' calcolato con una window function nella stessa query,
+    # prima di applicare cursore e limite
+    ranked = select(
+        *(getattr(Thesis, name) for name in _THESIS_LIST_COLUMNS),
+        func.count().over().label("total")
+    ).where(*filters).subquery()
+    stmt = select(ranked)
+
+    if cursor:
+        stmt = stmt.where(tuple_(ranked.c.created_at, ranked.c.id) < tuple_(*_decode_thesis_cursor(cursor)))
+
+    stmt = stmt.order_by(ranked.c.created_at.desc(), ranked.c.id.desc())
+    if limit:
+        stmt = stmt.limit(limit)
+
+    rows = (await db.execute(stmt)).all()
+
+    if rows:
+        total = rows[0].total
+    elif cursor:
+        # Pagina vuota oltre la fine: il totale va contato a parte
+        total = await db.scalar(select(func.count()).select_from(Thesis).where(*filters))
+    else:
+        total = 0
+
+    next_cursor = None
+    if limit and len(rows) == limit:
+        next_cursor = _encode_thesis_cursor(rows[-1])
+
+    # Serializzata direttamente: response_model resta solo per la documentazione,
+    # FastAPI non rivalida una Response gia' pronta
+    return Response(
+        content=_dumps_json({
+            "theses": [_thesis_list_item(row) for row in rows],
+            "total": total,
+            "next_cursor": next_cursor,
+        }),
+        media_type="application/json"
     )
 
 
 @router.get("/{thesis_id}", response_model=ThesisResponse)
 async def get_thesis(
     thesis_id: str,
-    current_user: User = Depends(get_current_active_user),
-    db: DBSession = Depends(get_db)
+    current_user: AuthedUser = Depends(get_current_authed_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Ottiene i dettagli di una tesi."""
-    thesis = get_thesis_by_id(db, thesis_id, str(current_user.id))
+    thesis = await get_thesis_by_id_async(db, thesis_id, str(current_user.id))
     return ThesisResponse(**thesis.to_dict())
 
 
 @router.delete("/{thesis_id}")
 async def delete_thesis(
     thesis_id: str,
-    current_user: User = Depends(get_current_active_user),
-    db: DBSession = Depends(get_db)
+    background_tasks: BackgroundTasks,
+    current_user: AuthedUser = Depends(get_current_authed_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Elimina una tesi e tutti i suoi dati."""
-    thesis = get_thesis_by_id(db, thesis_id, str(current_user.id))
-
-    # Elimina allegati dal filesystem
-    cleanup_thesis_attachments(thesis_id)
+    # Allegati e job caricati subito: servono alla cascade del delete
+    thesis = await get_thesis_by_id_async(
+        db, thesis_id, str(current_user.id),
+        selectinload(Thesis.attachments), selectinload(Thesis.generation_jobs)
+    )
 
     # Elimina dal database (cascade eliminerà allegati e job)
-    db.delete(thesis)
-    db.commit()
+    await db.delete(thesis)
+    await db.commit()
+    invalidate_thesis_data(thesis_id)
+    invalidate_attachments_context(thesis.id)
+
+    # Elimina allegati dal filesystem dopo la risposta (task sincrono,
+    # eseguito da Starlette nel threadpool, fuori dall'event loop)
+    background_tasks.add_task(cleanup_thesis_attachments, thesis_id)
 
     return {"message": "Tesi eliminata con successo"}
 
@@ -355,11 +858,45 @@ async def delete_thesis(
 # ATTACHMENTS ENDPOINTS
 # ============================================================================
 
+def _insert_attachments(db: DBSession, new_rows: List[dict]) -> List[ThesisAttachmentResponse]:
+    """
+    Registra gli allegati con un'unica INSERT multi-riga e un solo commit.
+
+    Core, senza unit-of-work ORM. Gli id sono generati qui, cosi' le righe
+    restituite si associano senza dipendere dall'ordine di RETURNING.
+    """
+    if not new_rows:
+        return []
+
+    for row in new_rows:
+        row.setdefault("id", uuid.uuid4())
+
+    created = dict(db.execute(
+        insert(ThesisAttachment).returning(ThesisAttachment.id, ThesisAttachment.created_at),
+        new_rows
+    ).all())
+    db.commit()
+    invalidate_attachments_context(new_rows[0]["thesis_id"])
+
+    return [
+        ThesisAttachmentResponse(
+            id=str(row["id"]),
+            thesis_id=str(row["thesis_id"]),
+            filename=row["filename"],
+            original_filename=row["original_filename"],
+            file_size=row["file_size"],
+            mime_type=row["mime_type"],
+            created_at=created[row["id"]]
+        )
+        for row in new_rows
+    ]
+
+
 @router.post("/{thesis_id}/attachments", response_model=ThesisAttachmentsListResponse)
 async def upload_attachments(
     thesis_id: str,
     files: List[UploadFile] = File(...),
-    current_user: User = Depends(get_current_active_user),
+    current_user: AuthedUser = Depends(get_current_authed_user),
     db: DBSession = Depends(get_db)
 ):
     """
@@ -367,53 +904,51 @@ async def upload_attachments(
 
     Supporta PDF, DOCX, TXT. Estrae automaticamente il testo.
     """
-    thesis = get_thesis_by_id(db, thesis_id, str(current_user.id))
+    # Tesi e verifica limite allegati in una sola query
+    thesis = get_thesis_for_new_attachments(db, thesis_id, str(current_user.id), len(files))
 
-    # Verifica limite allegati
-    existing_count = db.query(ThesisAttachment).filter(
-        ThesisAttachment.thesis_id == thesis.id
-    ).count()
-
-    if existing_count + len(files) > config.THESIS_MAX_ATTACHMENTS:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Superato il limite di {config.THESIS_MAX_ATTACHMENTS} allegati"
-        )
-
-    uploaded = []
-
-    for file in files:
-        # Leggi contenuto
-        content = await file.read()
+    async def _save_and_extract(file: UploadFile) -> dict:
+        # Scrittura a blocchi (senza caricare il file in memoria) ed estrazione
+        # del testo nel pool di processi
+        file_path, file_size = await save_uploaded_file(file, file.filename, thesis_id)
+        try:
+            return await process_attachment_async(file_path, file.filename, file_size)
+        except Exception:
+            delete_attachment_file(str(file_path))
+            raise
 
-        # Salva file
-        file_path = save_uploaded_file(content, file.filename, thesis_id)
+    # Tutti i file in parallelo: I/O su disco ed estrazione si sovrappongono
+    results = await asyncio.gather(
+        *(_save_and_extract(file) for file in files),
+        return_exceptions=True
+    )
 
-        try:
-            # Processa e estrai testo
-            attachment_data = process_attachment(file_path, file.filename)
-
-            # Salva nel database
-            attachment = ThesisAttachment(
-                thesis_id=thesis.id,
-                filename=attachment_data["filename"],
-                original_filename=attachment_data["original_filename"],
-                file_path=attachment_data["file_path"],
-                file_size=attachment_data["file_size"],
-                mime_type=attachment_data["mime_type"],
-                extracted_text=attachment_data["extracted_text"]
-            )
+    new_rows = []
+    error = None
+    for index, attachment_data in enumerate(results):
+        if isinstance(attachment_data, BaseException):
+            # Se fallisce, elimina i file successivi gia' salvati (non registrati)
+            for later in results[index + 1:]:
+                if not isinstance(later, BaseException):
+                    delete_attachment_file(later["file_path"])
+            error = attachment_data
+            break
 
-            db.add(attachment)
-            db.commit()
-            db.refresh(attachment)
+        new_rows.append({
+            "thesis_id": thesis.id,
+            "filename": attachment_data["filename"],
+            "original_filename": attachment_data["original_filename"],
+            "file_path": attachment_data["file_path"],
+            "file_size": attachment_data["file_size"],
+            "mime_type": attachment_data["mime_type"],
+            "extracted_text": attachment_data["extracted_text"]
+        })
 
-            uploaded.append(ThesisAttachmentResponse(**attachment.to_dict()))
+    # Tutti gli allegati estratti in un'unica transazione
+    uploaded = _insert_attachments(db, new_rows)
 
-        except Exception as e:
-            # Se fallisce, elimina il file
-            delete_attachment_file(str(file_path))
-            raise HTTPException(status_code=400, detail=str(e))
+    if error is not None:
+        raise HTTPException(status_code=400, detail=str(error))
 
     return ThesisAttachmentsListResponse(
         attachments=uploaded,
@@ -424,18 +959,18 @@ async def upload_attachments(
 @router.get("/{thesis_id}/attachments", response_model=ThesisAttachmentsListResponse)
 async def list_attachments(
     thesis_id: str,
-    current_user: User = Depends(get_current_active_user),
+    current_user: AuthedUser = Depends(get_current_authed_user),
     db: DBSession = Depends(get_db)
 ):
     """Elenca gli allegati di una tesi."""
     thesis = get_thesis_by_id(db, thesis_id, str(current_user.id))
 
-    attachments = db.query(ThesisAttachment).filter(
+    attachments = db.scalars(select(ThesisAttachment).options(raiseload('*')).where(
         ThesisAttachment.thesis_id == thesis.id
-    ).order_by(ThesisAttachment.created_at).all()
+    ).order_by(ThesisAttachment.created_at)).all()
 
     return ThesisAttachmentsListResponse(
-        attachments=[ThesisAttachmentResponse(**a.to_dict()) for a in attachments],
+        attachments=[ThesisAttachmentResponse.model_construct(**a.to_dict()) for a in attachments],
         total=len(attachments)
     )
 
@@ -444,16 +979,16 @@ async def list_attachments(
 async def delete_attachment(
     thesis_id: str,
     attachment_id: str,
-    current_user: User = Depends(get_current_active_user),
+    current_user: AuthedUser = Depends(get_current_authed_user),
     db: DBSession = Depends(get_db)
 ):
     """Elimina un allegato."""
     thesis = get_thesis_by_id(db, thesis_id, str(current_user.id))
 
-    attachment = db.query(ThesisAttachment).filter(
+    attachment = db.scalars(select(ThesisAttachment).where(
         ThesisAttachment.id == attachment_id,
         ThesisAttachment.thesis_id == thesis.id
-    ).first()
+    )).first()
 
     if not attachment:
         raise HTTPException(status_code=404, detail="Allegato non trovato")
@@ -464,6 +999,7 @@ async def delete_attachment(
     # Elimina dal database
     db.delete(attachment)
     db.commit()
+    invalidate_attachments_context(thesis.id)
 
     return {"message": "Allegato eliminato con successo"}
 
@@ -472,7 +1008,7 @@ async def delete_attachment(
 async def add_url_attachments(
     thesis_id: str,
     request: ThesisUrlAttachmentRequest,
-    current_user: User = Depends(get_current_active_user),
+    current_user: AuthedUser = Depends(get_current_authed_user),
     db: DBSession = Depends(get_db)
 ):
     """
@@ -483,20 +1019,10 @@ async def add_url_attachments(
     import httpx
     from bs4 import BeautifulSoup
 
-    thesis = get_thesis_by_id(db, thesis_id, str(current_user.id))
-
-    # Verifica limite allegati
-    existing_count = db.query(ThesisAttachment).filter(
-        ThesisAttachment.thesis_id == thesis.id
-    ).count()
-
-    if existing_count + len(request.urls) > config.THESIS_MAX_ATTACHMENTS:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Superato il limite di {config.THESIS_MAX_ATTACHMENTS} allegati"
-        )
+    # Tesi e verifica limite allegati in una sola query
+    thesis = get_thesis_for_new_attachments(db, thesis_id, str(current_user.id), len(request.urls))
 
-    uploaded = []
+    new_rows = []
 
     async with httpx.AsyncClient(timeout=20, follow_redirects=True) as client:
         for url in request.urls:
@@ -539,27 +1065,24 @@ async def add_url_attachments(
                     logger.warning(f"Nessun contenuto estratto da URL: {url}")
                     continue
 
-                attachment = ThesisAttachment(
-                    thesis_id=thesis.id,
-                    filename=f"url_{uuid.uuid4().hex[:8]}.html",
-                    original_filename=title or url,
-                    file_path=url,
-                    file_size=len(content_text),
-                    mime_type="text/html",
-                    extracted_text=content_text
-                )
-
-                db.add(attachment)
-                db.commit()
-                db.refresh(attachment)
-
-                uploaded.append(ThesisAttachmentResponse(**attachment.to_dict()))
+                new_rows.append({
+                    "thesis_id": thesis.id,
+                    "filename": f"url_{uuid.uuid4().hex[:8]}.html",
+                    "original_filename": title or url,
+                    "file_path": url,
+                    "file_size": len(content_text),
+                    "mime_type": "text/html",
+                    "extracted_text": content_text
+                })
 
             except httpx.HTTPStatusError as e:
                 logger.warning(f"Errore HTTP per URL {url}: {e.response.status_code}")
             except Exception as e:
                 logger.warning(f"Errore recupero URL {url}: {e}")
 
+    # Pagine recuperate registrate in un'unica transazione
+    uploaded = _insert_attachments(db, new_rows)
+
     if not uploaded:
         raise HTTPException(
             status_code=400,
@@ -680,82 +1203,85 @@ async def add_paper_attachments(
     server-side (consumando 'research_summary' in crediti).
     L'extracted_text combina sempre paper completo + riassunto AI.
     """
-    thesis = get_thesis_by_id(db, thesis_id, str(current_user.id))
-
-    existing_count = db.query(ThesisAttachment).filter(
-        ThesisAttachment.thesis_id == thesis.id
-    ).count()
-
-    if existing_count + len(request.items) > config.THESIS_MAX_ATTACHMENTS:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Superato il limite di {config.THESIS_MAX_ATTACHMENTS} allegati",
-        )
+    # Tesi e verifica limite allegati in una sola query
+    thesis = get_thesis_for_new_attachments(db, thesis_id, str(current_user.id), len(request.items))
 
     summary_cost = estimate_credits("research_summary", {}, db=db)["credits_needed"]
     summarized_count = 0
     credits_consumed = 0
 
-    created: List[ThesisAttachmentResponse] = []
+    new_rows: List[dict] = []
 
-    for item in request.items:
-        try:
-            paper = UnifiedPaper(**item.paper)
-        except Exception:
-            raise HTTPException(status_code=400, detail="Paper non valido nel payload")
-
-        # Riusa summary fornito o generalo (a costo di crediti)
-        summary: Optional[SummaryResult] = None
-        if item.summary is not None:
-            try:
-                summary = SummaryResult(**item.summary)
-            except Exception:
-                summary = None
-
-        if summary is None:
-            # Deduce crediti PRIMA di chiamare il provider (pattern coerente col resto del codice)
-            deduct_credits(
-                user=current_user,
-                amount=summary_cost,
-                operation_type="research_summary",
-                description=f"Riassunto paper aggiunto a tesi: {paper.title[:80]}",
-                db=db,
-            )
+    # Gli allegati si registrano tutti insieme alla fine. Se un paper fallisce
+    # a meta' (payload non valido, crediti esauriti) quelli gia' elaborati,
+    # e gia' pagati, vengono comunque salvati prima di propagare l'errore.
+    try:
+        for item in request.items:
             try:
-                summary = await summarize_paper(paper)
+                paper = UnifiedPaper(**item.paper)
             except Exception:
-                logger.exception("Riassunto fallito per paper '%s', salvo solo metadati", paper.title[:80])
-                summary = None  # Salvo comunque l'attachment con solo metadati
-            else:
-                summarized_count += 1
-                credits_consumed += summary_cost
+                raise HTTPException(status_code=400, detail="Paper non valido nel payload")
 
-        extracted_text = render_paper_with_summary(paper, summary)
+            # Riusa summary fornito o generalo (a costo di crediti)
+            summary: Optional[SummaryResult] = None
+            if item.summary is not None:
+                try:
+                    summary = SummaryResult(**item.summary)
+                except Exception:
+                    summary = None
+
+            if summary is None:
+                # Deduce crediti PRIMA di chiamare il provider (pattern coerente col resto del codice)
+                deduct_credits(
+                    user=current_user,
+                    amount=summary_cost,
+                    operation_type="research_summary",
+                    description=f"Riassunto paper aggiunto a tesi: {paper.title[:80]}",
+                    db=db,
+                )
+                try:
+                    summary = await summarize_paper(paper)
+                except Exception:
+                    logger.exception("Riassunto fallito per paper '%s', salvo solo metadati", paper.title[:80])
+                    summary = None  # Salvo comunque l'attachment con solo metadati
+                else:
+                    summarized_count += 1
+                    credits_consumed += summary_cost
 
-        # Placeholder per file_path (la colonna è NOT NULL)
-        if paper.full_text_url:
-            file_path = paper.full_text_url
-        elif paper.doi:
-            file_path = f"doi:{paper.doi}"
-        else:
-            file_path = f"paper:{paper.id}"
-
-        title = (paper.title or "Paper accademico")[:500]
-
-        attachment = ThesisAttachment(
-            thesis_id=thesis.id,
-            filename=f"paper_{uuid.uuid4().hex[:8]}.txt",
-            original_filename=title,
-            file_path=file_path,
-            file_size=len(extracted_text),
-            mime_type=PAPER_MIME_TYPE,
-            extracted_text=extracted_text,
-        )
-        db.add(attachment)
-        db.commit()
-        db.refresh(attachment)
+            extracted_text = render_paper_with_summary(paper, summary)
+
+            # Placeholder per file_path (la colonna è NOT NULL)
+            if paper.full_text_url:
+                file_path = paper.full_text_url
+            elif paper.doi:
+                file_path = f"doi:{paper.doi}"
+            else:
+                file_path = f"paper:{paper.id}"
+
+            title = (paper.title or "Paper accademico")[:500]
+
+            new_rows.append({
+                "thesis_id": thesis.id,
+                "filename": f"paper_{uuid.uuid4().hex[:8]}.txt",
+                "original_filename": title,
+                "file_path": file_path,
+                "file_size": len(extracted_text),
+                "mime_type": PAPER_MIME_TYPE,
+                "extracted_text": extracted_text,
+            })
+    except Exception as original_error:
+        db.rollback()
+        try:
+            _insert_attachments(db, new_rows)
+        except Exception:
+            # Non deve sostituire l'errore originale, che viene rilanciato sotto
+            db.rollback()
+            logger.exception(
+                f"Salvataggio di {len(new_rows)} paper gia' elaborati fallito dopo l'errore: {original_error}"
+            )
+        raise
 
-        created.append(ThesisAttachmentResponse(**attachment.to_dict()))
+    created = _insert_attachments(db, new_rows)
 
     return ThesisAddPapersResponse(
         attachments=created,
@@ -769,84 +1295,38 @@ async def add_paper_attachments(
 # GENERATION ENDPOINTS
 # ============================================================================
 
-def generate_chapters_task(thesis_id: str, user_id: str):
-    """Task background per generare i capitoli."""
-    db = SessionLocal()
-    try:
-        thesis = db.query(Thesis).get(thesis_id)
-        if not thesis:
-            return
+def _latest_job(db: DBSession, thesis_id, phase: str) -> Optional[ThesisGenerationJob]:
+    """Ultimo job della tesi per la fase indicata (indice idx_thesis_generation_jobs_thesis_phase_created)."""
+    return db.scalars(select(ThesisGenerationJob).where(
+        ThesisGenerationJob.thesis_id == thesis_id,
+        ThesisGenerationJob.phase == phase
+    ).order_by(ThesisGenerationJob.created_at.desc()).limit(1)).first()
 
-        # Costruisci i dati per il prompt
-        thesis_data = build_thesis_data_dict(thesis, db)
 
-        # Costruisci contesto allegati
-        attachments = db.query(ThesisAttachment).filter(
-            ThesisAttachment.thesis_id == thesis.id
-        ).all()
-        attachments_context = build_attachments_context(
-            [a.to_dict() | {"extracted_text": a.extracted_text} for a in attachments]
-        )
+def _fail_thesis_job(db: DBSession, thesis_id, phase: str, error: str) -> None:
+    """
+    Segna come falliti l'ultimo job della fase e la tesi.
 
-        # Genera capitoli con il provider AI selezionato
-        provider = thesis.ai_provider or "openai"
-        client = get_ai_client(provider)
-        logger.info(f"Generazione capitoli con provider: {provider}")
-        result = client.generate_chapters(thesis_data, attachments_context)
-
-        # Salva risultato
-        thesis.chapters_structure = result
-        thesis.status = 'chapters_pending'
-        thesis.current_phase = 1
-
-        # Aggiorna job
-        job = db.query(ThesisGenerationJob).filter(
-            ThesisGenerationJob.thesis_id == thesis.id,
-            ThesisGenerationJob.phase == 'chapters'
-        ).order_by(ThesisGenerationJob.created_at.desc()).first()
-
-        if job:
-            job.status = 'completed'
-            job.result = json.dumps(result)
-            job.completed_at = datetime.utcnow()
-
-        db.commit()
-
-    except InsufficientCreditsError as e:
-        logger.error(f"Crediti insufficienti durante generazione capitoli: {e.user_message}")
-        job = db.query(ThesisGenerationJob).filter(
-            ThesisGenerationJob.thesis_id == thesis_id,
-            ThesisGenerationJob.phase == 'chapters'
-        ).order_by(ThesisGenerationJob.created_at.desc()).first()
-        if job:
-            job.status = 'failed'
-            job.error = f"CREDITI_INSUFFICIENTI: {e.user_message}"
-            db.commit()
-        thesis = db.query(Thesis).get(thesis_id)
-        if thesis:
-            thesis.status = 'failed'
-            db.commit()
-
-    except Exception as e:
-        # Aggiorna job con errore
-        job = db.query(ThesisGenerationJob).filter(
-            ThesisGenerationJob.thesis_id == thesis_id,
-            ThesisGenerationJob.phase == 'chapters'
-        ).order_by(ThesisGenerationJob.created_at.desc()).first()
-
-        if job:
-            job.status = 'failed'
-            job.error = str(e)
-            db.commit()
-
-        # Aggiorna stato tesi
-        thesis = db.query(Thesis).get(thesis_id)
-        if thesis:
-            thesis.status = 'failed'
-            db.commit()
-
-    finally:
-        db.close()
+    Due UPDATE e un solo commit: il job da aggiornare e' scelto da una
+    subquery (stesso indice di _latest_job), senza caricarlo nella sessione.
+    """
+    # La transazione puo' essere rimasta invalida per l'errore stesso
+    db.rollback()
+    latest_job = select(ThesisGenerationJob.id).where(
+        ThesisGenerationJob.thesis_id == thesis_id,
+        ThesisGenerationJob.phase == phase
+    ).order_by(ThesisGenerationJob.created_at.desc()).limit(1).scalar_subquery()
+    db.execute(
+        update(ThesisGenerationJob)
+        .where(ThesisGenerationJob.id == latest_job)
+        .values(status='failed', error=error),
+        execution_options={"synchronize_session": False}
+    )
+    db.execute(
+        update(Thesis).where(Thesis.id == thesis_id).values(status='failed'),
+        execution_options={"synchronize_session": False}
+    )
+    db.commit()
 
 
 @router.post("/{thesis_id}/generate-chapters")
@@ -862,7 +1342,7 @@ async def generate_chapters(
     L'utente potrà modificare i titoli prima di confermare.
     Generazione sincrona per risposta immediata.
     """
-    thesis = get_thesis_by_id(db, thesis_id, str(current_user.id))
+    thesis = get_thesis_by_id(db, thesis_id, str(current_user.id), _THESIS_ATTACHMENTS_LOAD)
 
     if thesis.status not in ['draft', 'failed']:
         raise HTTPException(
@@ -870,9 +1350,11 @@ async def generate_chapters(
             detail=f"Impossibile generare capitoli: stato attuale '{thesis.status}'"
         )
 
-    # Calcola caratteri allegati per crediti
-    ch_attachments = db.query(ThesisAttachment).filter(ThesisAttachment.thesis_id == thesis.id).all()
-    ch_attachment_chars = sum(len(a.extracted_text or '') for a in ch_attachments)
+    # Contesto allegati costruito prima della deduzione crediti (che fa commit)
+    attachments_context = get_attachments_context(db, thesis)
+
+    # Caratteri allegati per crediti: letti con il contesto, nessuna query in piu'
+    ch_attachment_chars = get_attachments_chars(db, thesis)
 
     # Deduzione crediti per generazione capitoli
     credit_estimate = estimate_credits('thesis_chapters', {'attachment_chars': ch_attachment_chars}, db=db)
@@ -888,19 +1370,18 @@ async def generate_chapters(
         # Costruisci i dati per il prompt
         thesis_data = build_thesis_data_dict(thesis, db)
 
-        # Costruisci contesto allegati
-        attachments = db.query(ThesisAttachment).filter(
-            ThesisAttachment.thesis_id == thesis.id
-        ).all()
-        attachments_context = build_attachments_context(
-            [a.to_dict() | {"extracted_text": a.extracted_text} for a in attachments]
-        )
-
         # Genera capitoli con il provider AI selezionato (sincrono)
         provider = thesis.ai_provider or "openai"
         client = get_ai_client(provider)
         logger.info(f"Generazione capitoli (sincrono) con provider: {provider}")
-        result = client.generate_chapters(thesis_data, attachments_context)
+
+        # Nessuna scrittura pendente: restituisce la connessione al pool
+        # per tutta la durata della chiamata AI
+        db.commit()
+
+        # Chiamata AI bloccante in un thread: l'event loop continua a servire
+        # le altre richieste durante l'attesa
+        result = await asyncio.to_thread(client.generate_chapters, thesis_data, attachments_context)
 
         # Salva risultato
         thesis.chapters_structure = result
@@ -933,11 +1414,49 @@ async def generate_chapters(
         )
 
 
+def _chapters_structure_update(thesis: Thesis, new_chapters: List[dict]):
+    """
+    Valore per aggiornare chapters_structure con i capitoli confermati.
+
+    Se il numero di capitoli non cambia, restituisce un'espressione jsonb_set
+    che riscrive lato DB solo i capitoli modificati (None se nessuno lo e'):
+    non si rispedisce al DB l'intera struttura. Se sono cambiati tutti, una
+    sola sostituzione costa meno di N jsonb_set annidati.
+
+    I campi a None (es. description/sections aggiunti da model_dump) non
+    vengono salvati: altrimenti ogni capitolo generato dall'AI, che non li
+    ha, risulterebbe modificato.
+    """
+    new_chapters = [
+        {key: value for key, value in chapter.items() if value is not None}
+        for chapter in new_chapters
+    ]
+    current_chapters = (thesis.chapters_structure or {}).get("chapters", [])
+    if len(new_chapters) != len(current_chapters):
+        return {"chapters": new_chapters}
+
+    changed = [
+        (i, chapter) for i, (old, chapter) in enumerate(zip(current_chapters, new_chapters))
+        if old != chapter
+    ]
+    if not changed:
+        return None
+    if len(changed) == len(new_chapters):
+        return {"chapters": new_chapters}
+
+    structure = Thesis.chapters_structure
+    for i, chapter in changed:
+        structure = func.jsonb_set(
+            structure, pg_array(["chapters", str(i)], type_=Text), cast(chapter, JSONB)
+        )
+    return structure
+
+
 @router.put("/{thesis_id}/chapters")
 async def confirm_chapters(
     thesis_id: str,
     request: ConfirmChaptersRequest,
-    current_user: User = Depends(get_current_active_user),
+    current_user: AuthedUser = Depends(get_current_authed_user),
     db: DBSession = Depends(get_db)
 ):
     """
@@ -986,11 +1505,19 @@ async def confirm_chapters(
 
         logger.info(f"chapters_data da salvare: {json.dumps(chapters_data, ensure_ascii=False, default=str)[:2000]}")
 
-        thesis.chapters_structure = {"chapters": chapters_data}
-        thesis.status = 'chapters_confirmed'
-        thesis.num_chapters = len(request.chapters)
+        # UPDATE diretta: con lo stesso numero di capitoli si riscrivono (con
+        # jsonb_set) solo quelli cambiati, non l'intera struttura
+        values = {"status": 'chapters_confirmed', "num_chapters": len(request.chapters)}
+        structure = _chapters_structure_update(thesis, chapters_data)
+        if structure is not None:
+            values["chapters_structure"] = structure
 
+        db.execute(
+            update(Thesis).where(Thesis.id == thesis.id).values(**values),
+            execution_options={"synchronize_session": False}
+        )
         db.commit()
+        invalidate_thesis_data(thesis.id)
         logger.info(f"=== CONFERMA CAPITOLI - SUCCESSO === tesi {thesis_id}")
 
         return {"message": "Capitoli confermati con successo", "status": "chapters_confirmed"}
@@ -1006,85 +1533,6 @@ async def confirm_chapters(
         )
 
 
-def generate_sections_task(thesis_id: str, user_id: str):
-    """Task background per generare le sezioni."""
-    db = SessionLocal()
-    try:
-        thesis = db.query(Thesis).get(thesis_id)
-        if not thesis:
-            return
-
-        # Costruisci dati
-        thesis_data = build_thesis_data_dict(thesis, db)
-        chapters = thesis.chapters_structure.get("chapters", [])
-
-        # Costruisci contesto allegati
-        attachments = db.query(ThesisAttachment).filter(
-            ThesisAttachment.thesis_id == thesis.id
-        ).all()
-        attachments_context = build_attachments_context(
-            [a.to_dict() | {"extracted_text": a.extracted_text} for a in attachments]
-        )
-
-        # Genera sezioni con il provider AI selezionato
-        provider = thesis.ai_provider or "openai"
-        client = get_ai_client(provider)
-        logger.info(f"Generazione sezioni con provider: {provider}")
-        result = client.generate_sections(thesis_data, chapters, attachments_context)
-
-        # Salva risultato
-        thesis.chapters_structure = result
-        thesis.status = 'sections_pending'
-        thesis.current_phase = 2
-
-        # Aggiorna job
-        job = db.query(ThesisGenerationJob).filter(
-            ThesisGenerationJob.thesis_id == thesis.id,
-            ThesisGenerationJob.phase == 'sections'
-        ).order_by(ThesisGenerationJob.created_at.desc()).first()
-
-        if job:
-            job.status = 'completed'
-            job.result = json.dumps(result)
-            job.completed_at = datetime.utcnow()
-
-        db.commit()
-
-    except InsufficientCreditsError as e:
-        logger.error(f"Crediti insufficienti durante generazione sezioni: {e.user_message}")
-        job = db.query(ThesisGenerationJob).filter(
-            ThesisGenerationJob.thesis_id == thesis_id,
-            ThesisGenerationJob.phase == 'sections'
-        ).order_by(ThesisGenerationJob.created_at.desc()).first()
-        if job:
-            job.status = 'failed'
-            job.error = f"CREDITI_INSUFFICIENTI: {e.user_message}"
-            db.commit()
-        thesis = db.query(Thesis).get(thesis_id)
-        if thesis:
-            thesis.status = 'failed'
-            db.commit()
-
-    except Exception as e:
-        job = db.query(ThesisGenerationJob).filter(
-            ThesisGenerationJob.thesis_id == thesis_id,
-            ThesisGenerationJob.phase == 'sections'
-        ).order_by(ThesisGenerationJob.created_at.desc()).first()
-
-        if job:
-            job.status = 'failed'
-            job.error = str(e)
-            db.commit()
-
-        thesis = db.query(Thesis).get(thesis_id)
-        if thesis:
-            thesis.status = 'failed'
-            db.commit()
-
-    finally:
-        db.close()
-
-
 @router.post("/{thesis_id}/generate-sections")
 async def generate_sections(
     thesis_id: str,
@@ -1097,7 +1545,7 @@ async def generate_sections(
     Richiede che i capitoli siano stati confermati.
     Generazione sincrona per risposta immediata.
     """
-    thesis = get_thesis_by_id(db, thesis_id, str(current_user.id))
+    thesis = get_thesis_by_id(db, thesis_id, str(current_user.id), _THESIS_ATTACHMENTS_LOAD)
 
     if thesis.status != 'chapters_confirmed':
         raise HTTPException(
@@ -1105,6 +1553,9 @@ async def generate_sections(
             detail=f"Devi prima confermare i capitoli. Stato attuale: '{thesis.status}'"
         )
 
+    # Contesto allegati costruito prima della deduzione crediti (che fa commit)
+    attachments_context = get_attachments_context(db, thesis)
+
     # Deduzione crediti per generazione sezioni
     credit_estimate = estimate_credits('thesis_sections', {}, db=db)
     deduct_credits(
@@ -1120,19 +1571,18 @@ async def generate_sections(
         thesis_data = build_thesis_data_dict(thesis, db)
         chapters = thesis.chapters_structure.get("chapters", [])
 
-        # Costruisci contesto allegati
-        attachments = db.query(ThesisAttachment).filter(
-            ThesisAttachment.thesis_id == thesis.id
-        ).all()
-        attachments_context = build_attachments_context(
-            [a.to_dict() | {"extracted_text": a.extracted_text} for a in attachments]
-        )
-
         # Genera sezioni con il provider AI selezionato (sincrono)
         provider = thesis.ai_provider or "openai"
         client = get_ai_client(provider)
         logger.info(f"Generazione sezioni (sincrono) con provider: {provider}")
-        result = client.generate_sections(thesis_data, chapters, attachments_context)
+
+        # Nessuna scrittura pendente: restituisce la connessione al pool
+        # per tutta la durata della chiamata AI
+        db.commit()
+
+        # Chiamata AI bloccante in un thread: l'event loop continua a servire
+        # le altre richieste durante l'attesa
+        result = await asyncio.to_thread(client.generate_sections, thesis_data, chapters, attachments_context)
 
         # Salva risultato
         thesis.chapters_structure = result
@@ -1169,7 +1619,7 @@ async def generate_sections(
 async def confirm_sections(
     thesis_id: str,
     request: ConfirmSectionsRequest,
-    current_user: User = Depends(get_current_active_user),
+    current_user: AuthedUser = Depends(get_current_authed_user),
     db: DBSession = Depends(get_db)
 ):
     """
@@ -1183,13 +1633,19 @@ async def confirm_sections(
             detail=f"Impossibile confermare sezioni: stato attuale '{thesis.status}'"
         )
 
-    # Aggiorna struttura
-    thesis.chapters_structure = {
-        "chapters": [c.model_dump() for c in request.chapters]
-    }
-    thesis.status = 'sections_confirmed'
+    # Aggiorna struttura: di solito l'utente conferma senza modifiche, quindi
+    # si riscrivono (con jsonb_set) solo i capitoli cambiati
+    values = {"status": 'sections_confirmed'}
+    structure = _chapters_structure_update(thesis, [c.model_dump() for c in request.chapters])
+    if structure is not None:
+        values["chapters_structure"] = structure
 
+    db.execute(
+        update(Thesis).where(Thesis.id == thesis.id).values(**values),
+        execution_options={"synchronize_session": False}
+    )
     db.commit()
+    invalidate_thesis_data(thesis.id)
 
     return {"message": "Sezioni confermate con successo", "status": "sections_confirmed"}
 
@@ -1229,7 +1685,6 @@ Output SOLO il testo riscritto.
         client.conversation_history.append({"role": "user", "content": style_prompt})
 
         try:
-            from anthropic import Anthropic
             response = client.client.messages.create(
                 model=client.MODEL_ID,
                 max_tokens=dynamic_max_tokens,
@@ -1250,21 +1705,28 @@ Output SOLO il testo riscritto.
         return content
 
 
-def _ensure_word_count(client, content: str, target_words: int, context_info: str, max_tokens: int) -> str:
+def _ensure_word_count(
+    client, content: str, target_words: int, context_info: str, max_tokens: int,
+    system: Optional[str] = None
+) -> str:
     """
     Verifica che il contenuto raggiunga il target di parole.
-    Se è sotto il 70%, chiede al modello di continuare ed espandere.
-    Effettua al massimo 2 tentativi di continuazione.
+    Se è sotto config.THESIS_MIN_WORDS_RATIO del target, chiede al modello di
+    continuare ed espandere, al massimo config.THESIS_MAX_CONTINUATIONS volte:
+    ogni continuazione e' una chiamata AI in piu' per la sezione.
+    system e' l'eventuale system prompt usato per generare il contenuto:
+    riusarlo mantiene le stesse regole di scrittura e lo stesso prefisso in cache.
     """
-    for attempt in range(2):
+    max_attempts = config.THESIS_MAX_CONTINUATIONS
+    for attempt in range(max_attempts):
         current_words = len(content.split())
-        if current_words >= target_words * 0.70:
+        if current_words >= target_words * config.THESIS_MIN_WORDS_RATIO:
             return content
 
         missing_words = target_words - current_words
         logger.info(
             f"Contenuto troppo corto ({current_words}/{target_words} parole) "
-            f"per {context_info}. Tentativo di espansione {attempt + 1}/2..."
+            f"per {context_info}. Tentativo di espansione {attempt + 1}/{max_attempts}..."
         )
 
         continuation_prompt = f"""Il testo seguente dovrebbe avere ALMENO {target_words} parole, ma ne ha solo circa {current_words}.
@@ -1286,7 +1748,7 @@ TESTO ESISTENTE DA CONTINUARE:
 SCRIVI la continuazione (almeno {missing_words} parole):"""
 
         try:
-            continuation = client.generate_text(continuation_prompt, max_tokens=max_tokens)
+            continuation = client.generate_text(continuation_prompt, max_tokens=max_tokens, system=system)
             content = content.rstrip() + "\n\n" + continuation.strip()
         except Exception as e:
             logger.warning(f"Errore nella continuazione: {e}")
@@ -1295,11 +1757,131 @@ SCRIVI la continuazione (almeno {missing_words} parole):"""
     return content
 
 
-def generate_content_task(thesis_id: str, user_id: str):
-    """Task background per generare il contenuto completo."""
+_REFUSAL_PATTERNS = ("i'm sorry", "i can't", "i cannot", "i apologize", "unable to provide",
+                     "not able to", "cannot provide", "can't provide")
+
+
+def _is_ai_refusal(text: str) -> bool:
+    """Vero se la risposta dell'AI e' un rifiuto ("I'm sorry, I can't...")."""
+    lowered = text.lower()
+    return any(p in lowered for p in _REFUSAL_PATTERNS)
+
+
+async def _run_llm_calls(calls: list) -> list:
+    """
+    Esegue chiamate AI sincrone indipendenti in parallelo (thread-pool),
+    al massimo config.THESIS_LLM_CONCURRENCY alla volta.
+    Restituisce i risultati nello stesso ordine delle chiamate.
+    """
+    semaphore = asyncio.Semaphore(config.THESIS_LLM_CONCURRENCY)
+
+    async def _run(call):
+        async with semaphore:
+            return await asyncio.to_thread(call)
+
+    return await asyncio.gather(*(_run(call) for call in calls))
+
+
+async def _run_llm_pipeline(calls: list, stage) -> list:
+    """
+    Come _run_llm_calls, con un secondo stadio: stage(posizione, risultato)
+    viene eseguito (in un thread) su ogni risultato appena pronto, in ordine e
+    uno alla volta, mentre le chiamate successive sono ancora in corso.
+    Restituisce i risultati di stage nello stesso ordine delle chiamate.
+    """
+    semaphore = asyncio.Semaphore(config.THESIS_LLM_CONCURRENCY)
+
+    async def _run(call):
+        async with semaphore:
+            return await asyncio.to_thread(call)
+
+    tasks = [asyncio.create_task(_run(call)) for call in calls]
+    try:
+        results = []
+        for pos, task in enumerate(tasks):
+            results.append(await asyncio.to_thread(stage, pos, await task))
+        return results
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _flush_progress(db: DBSession, thesis_id, progress: int, words_generated: int) -> None:
+    """Salva avanzamento e parole generate con un'unica UPDATE (senza unit-of-work ORM)."""
+    db.execute(
+        update(Thesis)
+        .where(Thesis.id == thesis_id)
+        .values(generation_progress=progress, total_words_generated=words_generated),
+        execution_options={"synchronize_session": False}
+    )
+    db.commit()
+
+
+def _generate_sections_via_batch_api(db: DBSession, thesis_pk, client, requests: List[dict], heartbeat) -> dict:
+    """
+    Genera le sezioni con la Batch API del provider (THESIS_CONTENT_BATCH_API).
+
+    L'id del batch viene salvato nel result del job 'content', cosi' un job
+    ripreso dopo un riavvio attende lo stesso batch invece di reinviarlo.
+    heartbeat() viene chiamata a ogni controllo dello stato: con il lease del
+    job solleva _JobLeaseLost se il job e' passato a un altro worker.
+
+    Returns:
+        Testi per custom_id; vuoto (o parziale) se il batch non e' utilizzabile:
+        le sezioni mancanti vengono generate con le chiamate dirette.
+    """
+    batch_client = BatchGenerateClient(client)
+    job = _latest_job(db, thesis_pk, 'content')
+
+    state = {}
+    if job and job.result:
+        try:
+            state = json.loads(job.result)
+        except ValueError:
+            state = {}
+    batch_id = state.get("batch_id") if state.get("provider") == client.provider else None
+
+    try:
+        if batch_id:
+            logger.info(f"Ripresa batch {batch_id} per tesi {thesis_pk}")
+        else:
+            batch_id = batch_client.submit(requests)
+            if job:
+                job.result = _dumps_json({"batch_id": batch_id, "provider": client.provider}).decode()
+            logger.info(f"Batch {batch_id} inviato per tesi {thesis_pk}: {len(requests)} sezioni")
+        db.commit()
+
+        deadline = time.monotonic() + config.THESIS_BATCH_MAX_HOURS * 3600
+        while not batch_client.poll(batch_id):
+            if time.monotonic() >= deadline:
+                logger.warning(f"Batch {batch_id} non concluso entro {config.THESIS_BATCH_MAX_HOURS}h, uso le chiamate dirette")
+                return {}
+            heartbeat()
+            time.sleep(config.THESIS_BATCH_POLL_SECONDS)
+
+        results = batch_client.fetch_results(batch_id)
+        if len(results) < len(requests):
+            logger.warning(f"Batch {batch_id}: {len(requests) - len(results)} sezioni non riuscite, rigenerate singolarmente")
+        return results
+    except (InsufficientCreditsError, _JobLeaseLost):
+        raise
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Batch API non disponibile per tesi {thesis_pk}: {e}, uso le chiamate dirette")
+        return {}
+
+
+def generate_content_task(thesis_id: str, user_id: str, lease: Optional["_JobLease"] = None):
+    """
+    Task background per generare il contenuto completo.
+
+    lease: lease del job preso dalla coda; se viene perso (job ripreso da un
+    altro worker) il task si ferma prima della scrittura successiva.
+    """
     db = SessionLocal()
+    parallel_pool = None
     try:
-        thesis = db.query(Thesis).get(thesis_id)
+        thesis = load_thesis(db, thesis_id, _THESIS_ATTACHMENTS_LOAD)
         if not thesis:
             return
 
@@ -1307,18 +1889,13 @@ def generate_content_task(thesis_id: str, user_id: str):
         chapters = thesis.chapters_structure.get("chapters", [])
 
         # Costruisci contesto allegati
-        attachments = db.query(ThesisAttachment).filter(
-            ThesisAttachment.thesis_id == thesis.id
-        ).all()
-        attachments_context = build_attachments_context(
-            [a.to_dict() | {"extracted_text": a.extracted_text} for a in attachments]
-        )
+        attachments_context = get_attachments_context(db, thesis)
 
         # Verifica se c'è una sessione addestrata per umanizzazione avanzata
         trained_session_client = None
         author_style_context = ""
         if thesis.session_id:
-            session = db.query(Session).get(thesis.session_id)
+            session = db.get(Session, thesis.session_id)
             if session and session.is_trained:
                 author_style_context = "Applica lo stile dell'autore appreso durante l'addestramento."
                 # Carica il client della sessione addestrata per umanizzazione completa
@@ -1339,20 +1916,69 @@ def generate_content_task(thesis_id: str, user_id: str):
         client = get_ai_client(provider)
         logger.info(f"Generazione contenuto con provider: {provider}")
 
-        # Import prompt builders per capitoli speciali
-        from thesis_prompts import build_introduction_prompt, build_conclusion_prompt, build_bibliography_prompt
-
         generated_chapters_content = []
         raw_chapters_content = []  # Contenuto PRE-umanizzazione per la bibliografia
-        previous_summary = ""
+        citation_index = {}  # {numero citazione [x]: primo contesto}, aggiornato sezione per sezione
+        summary_lines = []  # Riassunti delle sezioni generate, uniti solo quando servono
 
         # Total: sezioni normali + 3 (introduzione, conclusione, bibliografia)
         total_sections = sum(len(c.get("sections", [])) for c in chapters) + 3
         completed_sections = 0
+        thesis_pk = thesis.id
+
+        # Sezioni gia' scritte da un'esecuzione precedente dello stesso job
+        # (ripresa dopo un riavvio): (capitolo, sezione) -> (testo, testo raw)
+        saved_sections = {}
+        for chunk in db.scalars(
+            select(ThesisContentChunk)
+            .options(undefer(ThesisContentChunk.raw_content))
+            .where(ThesisContentChunk.thesis_id == thesis_pk)
+        ):
+            saved_sections[(chunk.chapter_index, chunk.section_index)] = (chunk.content, chunk.raw_content)
+        if saved_sections:
+            logger.info(f"Ripresa generazione tesi {thesis_id}: {len(saved_sections)} sezioni gia' salvate")
+
+        # Il conteggio riparte da zero anche in ripresa: le sezioni salvate
+        # vengono ripercorse qui sotto e ricontate una sola volta, mentre il
+        # totale in tabella puo' includere introduzione e conclusione gia' scritte
+        words_generated = 0
+
+        # Avanzamento e nuove sezioni tenuti in memoria e scritti a blocchi,
+        # nella stessa transazione
+        pending_chunks = []
+        flushed_sections = 0
+        last_flush = time.monotonic()
+
+        def _advance(words: int, force: bool = False) -> None:
+            nonlocal completed_sections, words_generated, flushed_sections, last_flush
+            completed_sections += 1
+            words_generated += words
+            if (force
+                    or completed_sections - flushed_sections >= config.THESIS_PROGRESS_FLUSH_SECTIONS
+                    or time.monotonic() - last_flush >= config.THESIS_PROGRESS_FLUSH_SECONDS):
+                if lease is not None:
+                    lease.check()
+                if pending_chunks:
+                    # Sezione gia' salvata (indice univoco): la riga esistente resta
+                    db.execute(
+                        pg_insert(ThesisContentChunk).on_conflict_do_nothing(
+                            index_elements=["thesis_id", "chapter_index", "section_index"]
+                        ),
+                        pending_chunks
+                    )
+                    pending_chunks.clear()
+                progress = int((completed_sections / total_sections) * 100)
+                _flush_progress(db, thesis_pk, progress, words_generated)
+                flushed_sections = completed_sections
+                last_flush = time.monotonic()
 
         # Calcola max_tokens dinamico per le generazioni
         words_per_section = thesis_data.get('words_per_section', 5000)
-        dynamic_max_tokens = max(int(words_per_section * 2.5) + 2000, 16000)
+        dynamic_max_tokens = client.content_max_tokens(words_per_section)
+
+        # Regole di scrittura delle sezioni (system prompt in cache presso il provider),
+        # riusate anche per le continuazioni
+        section_system_prompt = get_section_content_system_prompt(thesis_data.get('citation_style', 'footnotes'))
 
         # Raccoglie titoli dei capitoli per i prompt di intro/conclusione
         chapters_titles = [
@@ -1360,149 +1986,305 @@ def generate_content_task(thesis_id: str, user_id: str):
             for i, c in enumerate(chapters)
         ]
 
+        # Nessuna scrittura pendente: chiude la transazione di lettura e
+        # restituisce la connessione al pool per tutta la durata delle chiamate AI
+        db.commit()
+
+        # Batch API (opzionale): tutte le sezioni inviate in un unico job
+        # asincrono a costo ridotto. Le sezioni non ricevono il riassunto dei
+        # capitoli precedenti, ancora da generare al momento dell'invio.
+        batched_sections = {}
+        if config.THESIS_CONTENT_BATCH_API:
+            batch_requests = [
+                {
+                    "custom_id": f"ch{chapter_pos}-sec{section_pos}",
+                    **client.build_section_content_request(
+                        thesis_data, chapter, section,
+                        attachments_context=attachments_context,
+                        author_style_context=author_style_context
+                    )
+                }
+                for chapter_pos, chapter in enumerate(chapters)
+                for section_pos, section in enumerate(chapter.get("sections", []))
+                if (chapter_pos, section_pos) not in saved_sections
+            ]
+            if batch_requests:
+                # L'attesa del batch non scrive avanzamento: la vitalita' del
+                # job e' data dal lease, che qui viene solo verificato
+                batched_sections = _generate_sections_via_batch_api(
+                    db, thesis_pk, client, batch_requests,
+                    heartbeat=lease.check if lease is not None else (lambda: None)
+                )
+
+        # Capitoli in parallelo (opzionale): le sezioni di tutti i capitoli
+        # partono subito, fino a THESIS_LLM_CONCURRENCY alla volta, senza il
+        # riassunto dei capitoli precedenti (come con la Batch API). Ogni
+        # capitolo viene completato (continuazioni, umanizzazione, salvataggio)
+        # appena le sue sezioni sono pronte, mentre quelle dei capitoli
+        # successivi sono ancora in generazione: un crash perde solo le
+        # sezioni non ancora salvate, come nella generazione per capitolo.
+        parallel_sections = {}  # custom_id -> Future del testo raw
+        if config.THESIS_CONTENT_PARALLEL_CHAPTERS and not batched_sections:
+            parallel_pool = ThreadPoolExecutor(
+                max_workers=config.THESIS_LLM_CONCURRENCY,
+                thread_name_prefix=f"thesis-sections-{thesis_pk}"
+            )
+            for chapter_pos, chapter in enumerate(chapters):
+                for section_pos, section in enumerate(chapter.get("sections", [])):
+                    if (chapter_pos, section_pos) in saved_sections:
+                        continue
+                    parallel_sections[f"ch{chapter_pos}-sec{section_pos}"] = parallel_pool.submit(
+                        client.generate_section_content,
+                        thesis_data=thesis_data,
+                        chapter=chapter,
+                        section=section,
+                        attachments_context=attachments_context,
+                        author_style_context=author_style_context
+                    )
+
         # ===================================================================
         # FASE 1: Genera contenuto dei capitoli normali (con citazioni [x])
         # ===================================================================
-        for chapter in chapters:
-            chapter_content = f"\n\n# {chapter.get('chapter_title', 'Capitolo')}\n\n"
-            raw_chapter_content = ""
-
-            for section in chapter.get("sections", []):
-                # Genera contenuto sezione
-                raw_content = client.generate_section_content(
-                    thesis_data=thesis_data,
-                    chapter=chapter,
-                    section=section,
-                    previous_sections_summary=previous_summary,
-                    attachments_context=attachments_context,
-                    author_style_context=author_style_context
-                )
+        for chapter_pos, chapter in enumerate(chapters):
+            # Parti del capitolo accumulate in liste e unite una volta sola
+            chapter_parts = [f"\n\n# {chapter.get('chapter_title', 'Capitolo')}\n\n"]
+            raw_chapter_parts = []
+            previous_summary = "".join(summary_lines)
+            chapter_sections = chapter.get("sections", [])
+
+            # Sezioni brevi: un'unica chiamata per tutte le sezioni del capitolo.
+            # In caso di errore si ricade sulla generazione sezione per sezione.
+            batch_contents = None
+            chapter_saved = any((chapter_pos, pos) in saved_sections for pos in range(len(chapter_sections)))
+            if (not batched_sections and not parallel_sections and not chapter_saved
+                    and len(chapter_sections) > 1 and words_per_section <= SECTION_BATCH_MAX_WORDS):
+                try:
+                    batch_contents = client.generate_sections_content_batch(
+                        thesis_data=thesis_data,
+                        chapter=chapter,
+                        sections=chapter_sections,
+                        previous_sections_summary=previous_summary,
+                        attachments_context=attachments_context,
+                        author_style_context=author_style_context
+                    )
+                except InsufficientCreditsError:
+                    raise
+                except Exception as e:
+                    logger.warning(
+                        f"Generazione batch fallita per capitolo {chapter.get('chapter_index', '?')}: {e}, "
+                        f"uso una chiamata per sezione"
+                    )
 
-                # Verifica word count e richiedi continuazione se troppo corto
+            # Le sezioni del capitolo sono indipendenti: generazione e
+            # continuazioni partono in parallelo (tutte ricevono il riassunto dei
+            # capitoli precedenti). L'umanizzazione di ogni sezione parte appena
+            # la sezione e' pronta, mentre le altre sono ancora in generazione;
+            # resta sequenziale e nell'ordine delle sezioni (la sessione addestrata
+            # non e' thread-safe), come indice citazioni e progress.
+            def _section_call(section_pos: int, section: dict):
                 section_label = f"Cap. {chapter.get('chapter_index', '?')} - {section.get('title', 'Sezione')}"
-                raw_content = _ensure_word_count(
-                    client, raw_content, words_per_section,
-                    section_label, dynamic_max_tokens
-                )
 
-                # Salva contenuto raw per la bibliografia (con citazioni [x] intatte)
-                raw_chapter_content += f"\n{raw_content}\n"
+                def _call() -> str:
+                    saved = saved_sections.get((chapter_pos, section_pos))
+                    if saved is not None:
+                        return saved[1] or saved[0]
+
+                    key = f"ch{chapter_pos}-sec{section_pos}"
+                    batched = batched_sections.get(key)
+                    if batched is not None:
+                        raw_content = batched
+                    elif key in parallel_sections:
+                        raw_content = parallel_sections[key].result()
+                    elif batch_contents is not None:
+                        raw_content = batch_contents[section_pos]
+                    else:
+                        raw_content = client.generate_section_content(
+                            thesis_data=thesis_data,
+                            chapter=chapter,
+                            section=section,
+                            previous_sections_summary=previous_summary,
+                            attachments_context=attachments_context,
+                            author_style_context=author_style_context
+                        )
 
-                # Applica umanizzazione
-                content = _humanize_content(raw_content, trained_session_client, section.get('title', 'Sezione'))
+                    # Verifica word count e richiedi continuazione se troppo corto
+                    return _ensure_word_count(
+                        client, raw_content, words_per_section,
+                        section_label, dynamic_max_tokens, system=section_system_prompt
+                    )
+                return _call
+
+            def _humanize_stage(section_pos: int, raw_content: str) -> tuple:
+                saved = saved_sections.get((chapter_pos, section_pos))
+                if saved is not None:
+                    return raw_content, saved[0]
+                title = chapter_sections[section_pos].get('title', 'Sezione')
+                return raw_content, _humanize_content(raw_content, trained_session_client, title)
+
+            section_results = asyncio.run(_run_llm_pipeline(
+                [_section_call(pos, section) for pos, section in enumerate(chapter_sections)],
+                _humanize_stage
+            ))
+
+            for section_pos, (section, (raw_content, content)) in enumerate(zip(chapter_sections, section_results)):
+                # Salva contenuto raw per la bibliografia (con citazioni [x] intatte)
+                raw_chapter_parts.append(f"\n{raw_content}\n")
+                update_citation_index(citation_index, raw_content)
+
+                if (chapter_pos, section_pos) not in saved_sections:
+                    # Accoda la sezione per il salvataggio
+                    pending_chunks.append({
+                        "id": uuid.uuid4(),
+                        "thesis_id": thesis_pk,
+                        "position": completed_sections,
+                        "chapter_index": chapter_pos,
+                        "section_index": section_pos,
+                        "content": content,
+                        "raw_content": raw_content,
+                        "word_count": len(content.split())
+                    })
 
                 section_text = f"\n## {section.get('title', 'Sezione')}\n\n{content}\n"
-                chapter_content += section_text
+                chapter_parts.append(section_text)
 
                 # Aggiorna riassunto per coerenza
                 if len(content) > 500:
-                    previous_summary += f"\n- {section.get('title', 'Sezione')}: {content[:300]}..."
-
-                completed_sections += 1
+                    summary_lines.append(f"\n- {section.get('title', 'Sezione')}: {summarize_section_locally(content)}")
 
                 # Aggiorna progress
-                progress = int((completed_sections / total_sections) * 100)
-                thesis.generation_progress = progress
-                thesis.total_words_generated += len(content.split())
-                db.commit()
+                _advance(len(content.split()))
 
-            generated_chapters_content.append(chapter_content)
-            raw_chapters_content.append(raw_chapter_content)
+            generated_chapters_content.append("".join(chapter_parts))
+            raw_chapters_content.append("".join(raw_chapter_parts))
 
         # ===================================================================
-        # FASE 2: Genera INTRODUZIONE
+        # FASE 2-4: INTRODUZIONE, CONCLUSIONE e BIBLIOGRAFIA
+        # Dipendono solo dai capitoli gia' generati: le chiamate AI partono
+        # in parallelo, mentre umanizzazione e aggiornamenti DB restano
+        # sequenziali (sessione addestrata e sessione DB non sono thread-safe)
         # ===================================================================
-        logger.info("Generazione Introduzione...")
         intro_prompt = build_introduction_prompt(
             thesis_data=thesis_data,
             chapters_titles=chapters_titles,
             attachments_context=attachments_context,
             author_style_context=author_style_context
         )
-        intro_content = client.generate_text(intro_prompt, max_tokens=dynamic_max_tokens)
-        intro_content = _ensure_word_count(
-            client, intro_content, words_per_section, "Introduzione", dynamic_max_tokens
-        )
-        intro_content = _humanize_content(intro_content, trained_session_client, "Introduzione")
-
-        completed_sections += 1
-        progress = int((completed_sections / total_sections) * 100)
-        thesis.generation_progress = progress
-        thesis.total_words_generated += len(intro_content.split())
-        db.commit()
 
-        # ===================================================================
-        # FASE 3: Genera CONCLUSIONE
-        # ===================================================================
-        logger.info("Generazione Conclusione...")
         # Costruisci riassunto completo per la conclusione
-        conclusion_summary = previous_summary
+        conclusion_summary = "".join(summary_lines)
         conclusion_prompt = build_conclusion_prompt(
             thesis_data=thesis_data,
             content_summary=conclusion_summary,
             chapters_titles=chapters_titles,
             author_style_context=author_style_context
         )
-        conclusion_content = client.generate_text(conclusion_prompt, max_tokens=dynamic_max_tokens)
-        conclusion_content = _ensure_word_count(
-            client, conclusion_content, words_per_section, "Conclusione", dynamic_max_tokens
-        )
-        conclusion_content = _humanize_content(conclusion_content, trained_session_client, "Conclusione")
-
-        completed_sections += 1
-        progress = int((completed_sections / total_sections) * 100)
-        thesis.generation_progress = progress
-        thesis.total_words_generated += len(conclusion_content.split())
-        db.commit()
 
-        # ===================================================================
-        # FASE 4: Genera BIBLIOGRAFIA
-        # ===================================================================
-        logger.info("Generazione Bibliografia...")
         # Usa il contenuto RAW (pre-umanizzazione) per trovare le citazioni [x]
         # perché l'umanizzazione potrebbe averle alterate
         all_raw_text = "\n".join(raw_chapters_content)
+        # L'indice delle citazioni e' gia' stato costruito durante la generazione.
         # Fallback: se il raw non ha citazioni, prova anche con il contenuto umanizzato
-        import re as _re
-        raw_citations = _re.findall(r'\[\d+\]', all_raw_text)
-        if not raw_citations:
+        if not citation_index:
             # Prova con il contenuto umanizzato (l'anti-AI ora preserva le citazioni)
             all_raw_text = "\n".join(generated_chapters_content)
+            update_citation_index(citation_index, all_raw_text)
         bibliography_prompt = build_bibliography_prompt(
             thesis_data=thesis_data,
-            all_content=all_raw_text
+            all_content=all_raw_text,
+            citation_index=citation_index
         )
         # Usa sempre Claude per la bibliografia: i modelli OpenAI a volte si rifiutano
         # di generare riferimenti bibliografici ("I'm sorry, I can't provide...")
         try:
-            from ai_client import get_ai_client as _get_ai_client
-            bib_client = _get_ai_client("claude")
+            bib_client = get_ai_client("claude")
             logger.info("Bibliografia: uso Claude per evitare rifiuti di generazione")
         except Exception as bib_err:
             logger.warning(f"Claude non disponibile per bibliografia, uso provider default: {bib_err}")
             bib_client = client
-        bibliography_content = bib_client.generate_text(bibliography_prompt)
-        # NON umanizzare la bibliografia (è una lista formale)
-
-        # Verifica che la risposta non sia un rifiuto dell'AI
-        refusal_patterns = ["i'm sorry", "i can't", "i cannot", "i apologize", "unable to provide",
-                           "not able to", "cannot provide", "can't provide"]
-        if any(p in bibliography_content.lower() for p in refusal_patterns):
-            logger.warning("Bibliografia: rilevato rifiuto AI, ritento con prompt diretto")
-            # Ritenta con un prompt più diretto
-            fallback_prompt = (
-                f"Genera {len(raw_citations)} voci bibliografiche in formato APA per una tesi su: "
-                f"{thesis_data.get('title', '')}. "
-                f"Settore: {thesis_data.get('industry_name', 'Generale')}. "
-                f"Usa autori e opere reali e note nel campo. "
-                f"Formato: [1] Cognome, N. (Anno). Titolo. Editore.\n"
-                f"Output SOLO la lista, da [1] a [{len(raw_citations)}]."
+
+        def _generate_introduction() -> str:
+            logger.info("Generazione Introduzione...")
+            content = client.generate_text(intro_prompt, max_tokens=dynamic_max_tokens)
+            return _ensure_word_count(
+                client, content, words_per_section, "Introduzione", dynamic_max_tokens
             )
-            bibliography_content = bib_client.generate_text(fallback_prompt)
 
-        completed_sections += 1
-        thesis.generation_progress = 100
-        db.commit()
+        def _generate_conclusion() -> str:
+            logger.info("Generazione Conclusione...")
+            content = client.generate_text(conclusion_prompt, max_tokens=dynamic_max_tokens)
+            return _ensure_word_count(
+                client, content, words_per_section, "Conclusione", dynamic_max_tokens
+            )
+
+        def _generate_bibliography_entries() -> Optional[str]:
+            """
+            Stile [x]: una chiamata breve per citazione, in parallelo, con il
+            system prompt statico condiviso. None se una voce e' un rifiuto.
+            """
+            citations = sorted(citation_index)
+
+            def _entry_call(num: int):
+                prompt = build_bibliography_entry_prompt(num, citation_index[num], thesis_data)
+                return lambda: bib_client.generate_text(prompt, system=BIBLIOGRAPHY_ENTRY_SYSTEM)
+
+            answers = asyncio.run(_run_llm_calls([_entry_call(num) for num in citations]))
+
+            entries = []
+            for num, answer in zip(citations, answers):
+                lines = [line.strip() for line in (answer or "").splitlines() if line.strip()]
+                if not lines or _is_ai_refusal(lines[0]):
+                    return None
+                entry = lines[0]
+                if not entry.startswith(f"[{num}]"):
+                    entry = f"[{num}] {entry}"
+                entries.append(entry)
+            return "\n".join(entries)
+
+        def _generate_bibliography() -> str:
+            logger.info("Generazione Bibliografia...")
+            if thesis_data.get('citation_style') == 'bibliography' and citation_index:
+                content = _generate_bibliography_entries()
+                if content is not None:
+                    return content
+                logger.warning("Bibliografia: rifiuto su una voce, uso il prompt unico")
+
+            content = bib_client.generate_text(bibliography_prompt)
+            # NON umanizzare la bibliografia (è una lista formale)
+
+            # Verifica che la risposta non sia un rifiuto dell'AI
+            if _is_ai_refusal(content):
+                logger.warning("Bibliografia: rilevato rifiuto AI, ritento con prompt diretto")
+                # Ritenta con un prompt più diretto
+                fallback_prompt = (
+                    f"Genera {len(citation_index)} voci bibliografiche in formato APA per una tesi su: "
+                    f"{thesis_data.get('title', '')}. "
+                    f"Settore: {thesis_data.get('industry_name', 'Generale')}. "
+                    f"Usa autori e opere reali e note nel campo. "
+                    f"Formato: [1] Cognome, N. (Anno). Titolo. Editore.\n"
+                    f"Output SOLO la lista, da [1] a [{len(citation_index)}]."
+                )
+                content = bib_client.generate_text(fallback_prompt)
+            return content
+
+        # Umanizzazione di introduzione e conclusione appena pronte, mentre le
+        # chiamate successive (bibliografia) sono ancora in corso
+        _humanize_labels = ("Introduzione", "Conclusione")
+
+        def _humanize_stage(pos: int, content: str) -> str:
+            if pos >= len(_humanize_labels):
+                return content  # NON umanizzare la bibliografia (è una lista formale)
+            return _humanize_content(content, trained_session_client, _humanize_labels[pos])
+
+        intro_content, conclusion_content, bibliography_content = asyncio.run(_run_llm_pipeline(
+            [_generate_introduction, _generate_conclusion, _generate_bibliography],
+            _humanize_stage
+        ))
+
+        _advance(len(intro_content.split()))
+        _advance(len(conclusion_content.split()))
+
+        # Bibliografia: ultima voce, avanzamento sempre salvato
+        _advance(0, force=True)
 
         # ===================================================================
         # FASE 5: Assembla contenuto finale
@@ -1522,8 +2304,12 @@ def generate_content_task(thesis_id: str, user_id: str):
         # Bibliografia
         final_content_parts.append(f"\n\n# Bibliografia\n\n{bibliography_content}\n")
 
-        # Salva contenuto finale
+        # Salva contenuto finale: le sezioni parziali non servono piu'
         thesis.generated_content = "\n".join(final_content_parts)
+        db.execute(
+            delete(ThesisContentChunk).where(ThesisContentChunk.thesis_id == thesis_pk),
+            execution_options={"synchronize_session": False}
+        )
 
         # ===================================================================
         # FASE 6: Aggiorna chapters_structure con capitoli speciali per TOC
@@ -1563,59 +2349,288 @@ def generate_content_task(thesis_id: str, user_id: str):
         thesis.generation_progress = 100
         thesis.completed_at = datetime.utcnow()
 
-        # Aggiorna job
-        job = db.query(ThesisGenerationJob).filter(
-            ThesisGenerationJob.thesis_id == thesis.id,
-            ThesisGenerationJob.phase == 'content'
-        ).order_by(ThesisGenerationJob.created_at.desc()).first()
-
-        if job:
-            job.status = 'completed'
-            job.completed_at = datetime.utcnow()
+        # Aggiorna job: con il lease, solo se il job e' ancora di questo worker
+        if lease is not None:
+            lease.complete(db)
+        else:
+            job = _latest_job(db, thesis.id, 'content')
+            if job:
+                job.status = 'completed'
+                job.completed_at = datetime.utcnow()
 
         db.commit()
 
+    except _JobLeaseLost as e:
+        db.rollback()
+        logger.warning(str(e))
+
     except InsufficientCreditsError as e:
         logger.error(f"Crediti insufficienti durante generazione contenuto: {e.user_message}")
-        job = db.query(ThesisGenerationJob).filter(
-            ThesisGenerationJob.thesis_id == thesis_id,
-            ThesisGenerationJob.phase == 'content'
-        ).order_by(ThesisGenerationJob.created_at.desc()).first()
+        if lease is None or not lease.lost:
+            _fail_thesis_job(db, thesis_id, 'content', f"CREDITI_INSUFFICIENTI: {e.user_message}")
+
+    except Exception as e:
+        if lease is None or not lease.lost:
+            _fail_thesis_job(db, thesis_id, 'content', str(e))
 
-        if job:
-            job.status = 'failed'
-            job.error = f"CREDITI_INSUFFICIENTI: {e.user_message}"
-            db.commit()
+    finally:
+        if parallel_pool is not None:
+            parallel_pool.shutdown(wait=False, cancel_futures=True)
+        db.close()
 
-        thesis = db.query(Thesis).get(thesis_id)
-        if thesis:
-            thesis.status = 'failed'
-            db.commit()
 
-    except Exception as e:
-        job = db.query(ThesisGenerationJob).filter(
-            ThesisGenerationJob.thesis_id == thesis_id,
-            ThesisGenerationJob.phase == 'content'
-        ).order_by(ThesisGenerationJob.created_at.desc()).first()
+# ============================================================================
+# CODA DEI JOB DI GENERAZIONE
+# ============================================================================
+# La tabella thesis_generation_jobs fa da coda: un job 'pending' viene preso
+# da un solo processo (UPDATE condizionale pending -> processing) ed eseguito
+# in un pool di thread dedicato, separato dal threadpool delle richieste.
+# Ogni provider AI ha il proprio pool, con un limite di concorrenza
+# indipendente: un provider lento o saturo non blocca i job dell'altro.
+
+# Task eseguiti dalla coda, per fase del job
+_THESIS_JOB_TASKS = {
+    'content': generate_content_task,
+}
+
+# Thread per provider (i provider sconosciuti usano il client OpenAI, come
+# in get_ai_client, e quindi anche il suo pool)
+_THESIS_TASK_WORKERS = {
+    'openai': config.THESIS_TASK_WORKERS_OPENAI,
+    'claude': config.THESIS_TASK_WORKERS_CLAUDE,
+}
+
+_thesis_task_pools = {}  # provider -> ThreadPoolExecutor
+_thesis_task_pools_lock = threading.Lock()
+
+# Job gia' inviati a un pool di questo processo e non ancora terminati:
+# resume_thesis_jobs non li reinvia a ogni controllo
+_queued_thesis_jobs = set()
+_queued_thesis_jobs_lock = threading.Lock()
+
+
+def _get_thesis_task_pool(provider: Optional[str]) -> ThreadPoolExecutor:
+    """Crea (alla prima chiamata) il pool di thread dei job di un provider AI."""
+    provider = provider if provider in _THESIS_TASK_WORKERS else 'openai'
+    pool = _thesis_task_pools.get(provider)
+    if pool is None:
+        with _thesis_task_pools_lock:
+            pool = _thesis_task_pools.get(provider)
+            if pool is None:
+                pool = _thesis_task_pools[provider] = ThreadPoolExecutor(
+                    max_workers=_THESIS_TASK_WORKERS[provider],
+                    thread_name_prefix=f"thesis-job-{provider}"
+                )
+    return pool
+
+
+class _JobLeaseLost(Exception):
+    """Il job e' stato ripreso da un altro worker: questo si ferma senza scrivere."""
+
+
+class _JobLease:
+    """
+    Lease di un worker su un job 'processing'.
+
+    Un thread dedicato rinnova heartbeat_at ogni THESIS_JOB_HEARTBEAT_SECONDS,
+    indipendentemente da quanto durano le chiamate AI: resume_thesis_jobs
+    rimette in coda solo i job il cui worker non risponde piu'. Il rinnovo e'
+    condizionato al lease_token: se il job e' stato ripreso da un altro worker
+    il lease risulta perso e check()/complete() sollevano _JobLeaseLost.
+    """
+
+    def __init__(self, job_pk, token: uuid.UUID):
+        self.job_pk = job_pk
+        self.token = token
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f"thesis-job-lease-{job_pk}", daemon=True
+        )
+
+    def __enter__(self) -> "_JobLease":
+        self._thread.start()
+        return self
 
-        if job:
-            job.status = 'failed'
-            job.error = str(e)
-            db.commit()
+    def __exit__(self, *exc) -> bool:
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def _owned(self):
+        return (
+            ThesisGenerationJob.id == self.job_pk,
+            ThesisGenerationJob.lease_token == self.token,
+            ThesisGenerationJob.status == 'processing',
+        )
 
-        thesis = db.query(Thesis).get(thesis_id)
-        if thesis:
-            thesis.status = 'failed'
-            db.commit()
+    def _run(self) -> None:
+        while not self._stop.wait(config.THESIS_JOB_HEARTBEAT_SECONDS):
+            db = SessionLocal()
+            try:
+                renewed = db.execute(
+                    update(ThesisGenerationJob).where(*self._owned()).values(heartbeat_at=func.now()),
+                    execution_options={"synchronize_session": False}
+                ).rowcount
+                db.commit()
+            except Exception as e:
+                # Errore transitorio: si riprova al giro successivo
+                logger.warning(f"Rinnovo lease del job {self.job_pk} fallito: {e}")
+                continue
+            finally:
+                db.close()
+            if not renewed:
+                self.lost = True
+                return
 
+    def check(self) -> None:
+        """Solleva _JobLeaseLost se il job non appartiene piu' a questo worker."""
+        if self.lost:
+            raise _JobLeaseLost(f"Lease perso sul job {self.job_pk}: generazione interrotta")
+
+    def complete(self, db: DBSession) -> None:
+        """Segna il job come completato (nella transazione di db), se il lease e' ancora valido."""
+        self.check()
+        completed = db.execute(
+            update(ThesisGenerationJob).where(*self._owned())
+            .values(status='completed', completed_at=datetime.utcnow()),
+            execution_options={"synchronize_session": False}
+        ).rowcount
+        if not completed:
+            self.lost = True
+            self.check()
+
+
+def _claim_thesis_job(job_pk) -> Optional[tuple]:
+    """
+    Prende in carico un job 'pending' portandolo a 'processing'.
+
+    Returns:
+        (phase, thesis_id, user_id, lease_token) oppure None se il job e' gia'
+        stato preso da un altro processo o non e' piu' in attesa
+    """
+    token = uuid.uuid4()
+    db = SessionLocal()
+    try:
+        claimed = db.execute(
+            update(ThesisGenerationJob)
+            .where(ThesisGenerationJob.id == job_pk, ThesisGenerationJob.status == 'pending')
+            .values(
+                status='processing',
+                lease_token=token,
+                heartbeat_at=func.now(),
+                attempts=ThesisGenerationJob.attempts + 1
+            )
+            .returning(ThesisGenerationJob.phase, ThesisGenerationJob.thesis_id),
+            execution_options={"synchronize_session": False}
+        ).first()
+        if claimed is None:
+            db.rollback()
+            return None
+
+        user_id = db.scalar(select(Thesis.user_id).where(Thesis.id == claimed.thesis_id))
+        db.commit()
+        return claimed.phase, str(claimed.thesis_id), str(user_id), token
     finally:
         db.close()
 
 
+def _run_thesis_job(job_pk) -> None:
+    """Esegue un job della coda, se questo processo riesce a prenderlo in carico."""
+    try:
+        claimed = _claim_thesis_job(job_pk)
+        if claimed is None:
+            return
+        phase, thesis_id, user_id, token = claimed
+        with _JobLease(job_pk, token) as lease:
+            _THESIS_JOB_TASKS[phase](thesis_id, user_id, lease)
+    except Exception:
+        logger.exception(f"Errore nell'esecuzione del job di generazione {job_pk}")
+    finally:
+        with _queued_thesis_jobs_lock:
+            _queued_thesis_jobs.discard(job_pk)
+
+
+def enqueue_thesis_job(job_pk, provider: Optional[str]) -> bool:
+    """
+    Mette in esecuzione un job gia' salvato (e committato) come 'pending',
+    nel pool del provider AI della tesi.
+
+    Returns:
+        False se il job e' gia' in coda (o in esecuzione) in questo processo
+    """
+    with _queued_thesis_jobs_lock:
+        if job_pk in _queued_thesis_jobs:
+            return False
+        _queued_thesis_jobs.add(job_pk)
+    _get_thesis_task_pool(provider).submit(_run_thesis_job, job_pk)
+    return True
+
+
+def resume_thesis_jobs() -> int:
+    """
+    Rimette in coda i job rimasti in sospeso dopo un riavvio: quelli mai
+    avviati ('pending') e quelli 'processing' il cui worker non rinnova il
+    lease da piu' di THESIS_JOB_STALE_MINUTES (processo terminato durante la
+    generazione). I job che hanno gia' esaurito max_attempts prese in carico
+    vengono invece segnati come falliti, insieme alla tesi.
+
+    Returns:
+        Numero di job rimessi in coda (esclusi quelli gia' in coda qui)
+    """
+    db = SessionLocal()
+    try:
+        # La condizione di inattivita' e' nelle UPDATE stesse: sicuro anche
+        # con piu' worker che eseguono il controllo in contemporanea
+        stale = (
+            ThesisGenerationJob.phase.in_(tuple(_THESIS_JOB_TASKS)),
+            ThesisGenerationJob.status == 'processing',
+            func.coalesce(ThesisGenerationJob.heartbeat_at, ThesisGenerationJob.created_at)
+            < func.now() - timedelta(minutes=config.THESIS_JOB_STALE_MINUTES)
+        )
+        exhausted = db.scalars(
+            update(ThesisGenerationJob)
+            .where(*stale, ThesisGenerationJob.attempts >= ThesisGenerationJob.max_attempts)
+            .values(
+                status='failed',
+                lease_token=None,
+                error="Generazione interrotta piu' volte: numero massimo di tentativi raggiunto"
+            )
+            .returning(ThesisGenerationJob.thesis_id),
+            execution_options={"synchronize_session": False}
+        ).all()
+        if exhausted:
+            logger.warning(f"Job di generazione abbandonati dopo troppi tentativi: tesi {exhausted}")
+            db.execute(
+                update(Thesis)
+                .where(Thesis.id.in_(exhausted), Thesis.status == 'generating')
+                .values(status='failed'),
+                execution_options={"synchronize_session": False}
+            )
+        db.execute(
+            update(ThesisGenerationJob)
+            .where(*stale, ThesisGenerationJob.attempts < ThesisGenerationJob.max_attempts)
+            .values(status='pending', lease_token=None),
+            execution_options={"synchronize_session": False}
+        )
+        pending = db.execute(
+            select(ThesisGenerationJob.id, Thesis.ai_provider)
+            .join(Thesis, Thesis.id == ThesisGenerationJob.thesis_id)
+            .where(
+                ThesisGenerationJob.phase.in_(tuple(_THESIS_JOB_TASKS)),
+                ThesisGenerationJob.status == 'pending'
+            )
+        ).all()
+        db.commit()
+    finally:
+        db.close()
+
+    return sum(enqueue_thesis_job(job_pk, provider) for job_pk, provider in pending)
+
+
 @router.post("/{thesis_id}/generate-content", response_model=StartContentGenerationResponse)
 async def start_content_generation(
     thesis_id: str,
-    background_tasks: BackgroundTasks,
     current_user: User = Depends(require_permission('thesis')),
     db: DBSession = Depends(get_db)
 ):
@@ -1649,24 +2664,33 @@ async def start_content_generation(
         db=db
     )
 
-    # Aggiorna stato
+    # Aggiorna stato (nuova generazione: via le sezioni di un tentativo precedente)
     thesis.status = 'generating'
     thesis.current_phase = 3
     thesis.generation_progress = 0
+    thesis.total_words_generated = 0
+    db.execute(
+        delete(ThesisContentChunk).where(ThesisContentChunk.thesis_id == thesis.id),
+        execution_options={"synchronize_session": False}
+    )
 
     # Crea job
     job_id = f"thesis_content_{uuid.uuid4().hex[:8]}"
+    job_pk = uuid.uuid4()
     job = ThesisGenerationJob(
+        id=job_pk,
         thesis_id=thesis.id,
         job_id=job_id,
         phase='content',
-        status='pending'
+        status='pending',
+        max_attempts=config.THESIS_JOB_MAX_ATTEMPTS
     )
     db.add(job)
+    provider = thesis.ai_provider  # letto prima del commit, che scade l'oggetto
     db.commit()
 
-    # Avvia task
-    background_tasks.add_task(generate_content_task, str(thesis.id), str(current_user.id))
+    # Avvia il job (la richiesta risponde subito, senza occupare il worker)
+    enqueue_thesis_job(job_pk, provider)
 
     return StartContentGenerationResponse(
         thesis_id=str(thesis.id),
@@ -1677,28 +2701,96 @@ async def start_content_generation(
     )
 
 
+# Titoli di capitoli e sezioni per lo stato della generazione, per (tesi, hash
+# della struttura): il polling non rilegge ne' rianalizza chapters_structure
+# finche' la struttura non cambia.
+_GENERATION_OUTLINE_CACHE_SIZE = 256
+_generation_outline_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+_generation_outline_lock = threading.Lock()
+
+
+def _get_generation_outline(db: DBSession, thesis_pk, structure_hash: Optional[str]) -> tuple:
+    """
+    Struttura della tesi ridotta ai titoli.
+
+    Returns:
+        (capitoli, totale sezioni); ogni capitolo e' (titolo, titoli delle sezioni)
+    """
+    if structure_hash is None:
+        return (), 0
+
+    key = (str(thesis_pk), structure_hash)
+    with _generation_outline_lock:
+        outline = _generation_outline_cache.get(key)
+        if outline is not None:
+            _generation_outline_cache.move_to_end(key)
+            return outline
+
+    structure = db.scalar(select(Thesis.chapters_structure).where(Thesis.id == thesis_pk))
+    chapters = tuple(
+        (
+            ch.get("chapter_title", f"Capitolo {i+1}"),
+            tuple(sec.get("title", f"Sezione {j+1}") for j, sec in enumerate(ch.get("sections") or []))
+        )
+        for i, ch in enumerate(structure.get("chapters", []) if structure else [])
+    )
+    outline = (chapters, sum(len(section_titles) for _, section_titles in chapters))
+
+    with _generation_outline_lock:
+        _generation_outline_cache[key] = outline
+        while len(_generation_outline_cache) > _GENERATION_OUTLINE_CACHE_SIZE:
+            _generation_outline_cache.popitem(last=False)
+
+    return outline
+
+
 @router.get("/{thesis_id}/generation-status", response_model=GenerationStatusResponse)
 async def get_generation_status(
     thesis_id: str,
-    current_user: User = Depends(get_current_active_user),
+    current_user: AuthedUser = Depends(get_current_authed_user),
     db: DBSession = Depends(get_db)
 ):
     """
     Ottiene lo stato dettagliato della generazione.
+
+    Chiamato in polling durante la generazione: dalla tesi si leggono solo i
+    campi di stato e un hash della struttura, calcolato dal DB. I titoli di
+    capitoli e sezioni arrivano dalla cache, finche' la struttura non cambia.
     """
-    thesis = get_thesis_by_id(db, thesis_id, str(current_user.id))
+    thesis = db.execute(
+        select(
+            Thesis.id, Thesis.status, Thesis.current_phase, Thesis.generation_progress,
+            func.md5(cast(Thesis.chapters_structure, Text)).label("structure_hash")
+        ).where(
+            Thesis.id == thesis_id,
+            Thesis.user_id == str(current_user.id)
+        )
+    ).first()
 
-    chapters = thesis.chapters_structure.get("chapters", []) if thesis.chapters_structure else []
-    total_sections = sum(len(c.get("sections", [])) for c in chapters)
+    if not thesis:
+        raise HTTPException(status_code=404, detail="Tesi non trovata")
+
+    chapters, total_sections = _get_generation_outline(db, thesis.id, thesis.structure_hash)
     completed_sections = int(total_sections * thesis.generation_progress / 100) if thesis.generation_progress else 0
 
+    # Sezioni gia' salvate durante la generazione: (capitolo, sezione) -> parole
+    written_sections = {}
+    if thesis.status == 'generating':
+        written_sections = {
+            (row.chapter_index, row.section_index): row.word_count or 0
+            for row in db.execute(
+                select(ThesisContentChunk.chapter_index, ThesisContentChunk.section_index, ThesisContentChunk.word_count)
+                .where(ThesisContentChunk.thesis_id == thesis.id)
+            )
+        }
+
     # Calcola capitolo/sezione corrente
     current_chapter = 0
     current_section = 0
     sections_counted = 0
 
-    for i, ch in enumerate(chapters):
-        ch_sections = len(ch.get("sections", []))
+    for i, (_, section_titles) in enumerate(chapters):
+        ch_sections = len(section_titles)
         if sections_counted + ch_sections > completed_sections:
             current_chapter = i
             current_section = completed_sections - sections_counted
@@ -1707,8 +2799,8 @@ async def get_generation_status(
 
     # Costruisci stato per capitolo
     chapters_status = []
-    for i, ch in enumerate(chapters):
-        ch_sections = len(ch.get("sections", []))
+    for i, (chapter_title, section_titles) in enumerate(chapters):
+        ch_sections = len(section_titles)
         ch_completed = 0
 
         if i < current_chapter:
@@ -1722,7 +2814,7 @@ async def get_generation_status(
 
         # Costruisci stato per ogni sezione del capitolo
         sections_status = []
-        for j, sec in enumerate(ch.get("sections", [])):
+        for j, section_title in enumerate(section_titles):
             if i < current_chapter:
                 sec_status = 'completed'
             elif i == current_chapter:
@@ -1734,17 +2826,19 @@ async def get_generation_status(
                     sec_status = 'pending'
             else:
                 sec_status = 'pending'
+            if (i, j) in written_sections:
+                sec_status = 'completed'
 
             sections_status.append(SectionGenerationStatus(
                 section_index=j,
-                title=sec.get("title", f"Sezione {j+1}"),
+                title=section_title,
                 status=sec_status,
-                words_count=0  # TODO: calcolare parole reali per sezione
+                words_count=written_sections.get((i, j), 0)
             ))
 
         chapters_status.append(ChapterGenerationStatus(
             chapter_index=i,
-            chapter_title=ch.get("chapter_title", f"Capitolo {i+1}"),
+            chapter_title=chapter_title,
             total_sections=ch_sections,
             completed_sections=ch_completed,
             status=ch_status,
@@ -1765,13 +2859,62 @@ async def get_generation_status(
     )
 
 
+@router.get("/{thesis_id}/partial-content", response_model=PartialContentResponse)
+async def get_partial_content(
+    thesis_id: str,
+    current_user: AuthedUser = Depends(get_current_authed_user),
+    db: DBSession = Depends(get_db)
+):
+    """
+    Contenuto delle sezioni gia' generate, per la visualizzazione progressiva
+    durante la generazione (stesso formato markdown del contenuto finale).
+    A generazione completata restituisce il contenuto completo.
+    """
+    thesis = get_thesis_by_id(db, thesis_id, str(current_user.id))
+
+    chapters = thesis.chapters_structure.get("chapters", []) if thesis.chapters_structure else []
+    total_sections = sum(len(c.get("sections", [])) for c in chapters)
+
+    if thesis.status != 'generating':
+        return PartialContentResponse(
+            thesis_id=str(thesis.id),
+            status=ThesisStatus(thesis.status),
+            completed_sections=total_sections if thesis.generated_content else 0,
+            total_sections=total_sections,
+            content=thesis.generated_content or ""
+        )
+
+    rows = db.execute(
+        select(ThesisContentChunk.chapter_index, ThesisContentChunk.section_index, ThesisContentChunk.content)
+        .where(ThesisContentChunk.thesis_id == thesis.id)
+        .order_by(ThesisContentChunk.position)
+    ).all()
+
+    parts = []
+    current_chapter = None
+    for row in rows:
+        chapter = chapters[row.chapter_index] if row.chapter_index < len(chapters) else {}
+        if row.chapter_index != current_chapter:
+            current_chapter = row.chapter_index
+            parts.append(f"\n\n# {chapter.get('chapter_title', 'Capitolo')}\n\n")
+        sections = chapter.get("sections", [])
+        section = sections[row.section_index] if row.section_index < len(sections) else {}
+        parts.append(f"\n## {section.get('title', 'Sezione')}\n\n{row.content}\n")
+
+    return PartialContentResponse(
+        thesis_id=str(thesis.id),
+        status=ThesisStatus(thesis.status),
+        completed_sections=len(rows),
+        total_sections=total_sections,
+        content="".join(parts)
+    )
+
+
 # ============================================================================
 # FOOTNOTE PROCESSING UTILITIES
 # ============================================================================
 
-import re as _re
-
-_FOOTNOTE_PATTERN = _re.compile(r'\{\{nota:\s*(.*?)\}\}')
+_FOOTNOTE_PATTERN = re.compile(r'\{\{nota:\s*(.*?)\}\}')
 
 
 def extract_footnotes_from_line(line: str) -> list:
@@ -1803,6 +2946,30 @@ def strip_footnotes_for_plain(content: str, start_num: int = 1) -> tuple:
 # EXPORT ENDPOINTS
 # ============================================================================
 
+def _toc_entries(chapters: list) -> list:
+    """
+    Voci dell'indice lette una sola volta dalla struttura dei capitoli.
+
+    Ritorna [(titolo, speciale, numero, [(numero_sezione, titolo_sezione)])]:
+    i capitoli speciali (Introduzione, Conclusione, Bibliografia) non hanno
+    numero ne' sezioni nell'indice.
+    """
+    entries = []
+    for ch_idx, chapter in enumerate(chapters):
+        get = chapter.get
+        ch_title = get("chapter_title") or get("title", f"Capitolo {ch_idx + 1}")
+        if get("is_special", False):
+            entries.append((ch_title, True, None, ()))
+            continue
+
+        sections = []
+        for sec_idx, section in enumerate(get("sections", [])):
+            sec_num = section.get("index", sec_idx + 1)
+            sections.append((sec_num, section.get("title", f"Sezione {sec_num}")))
+        entries.append((ch_title, False, get("chapter_index", ch_idx + 1), sections))
+    return entries
+
+
 def generate_table_of_contents(chapters_structure: dict, format_type: str = "txt") -> str:
     """
     Genera l'indice della tesi basato sulla struttura dei capitoli.
@@ -1826,1069 +2993,1090 @@ def generate_table_of_contents(chapters_structure: dict, format_type: str = "txt
 
     if format_type == "md":
         # Formato Markdown
-        toc = "## Indice\n\n"
-        for ch_idx, chapter in enumerate(chapters):
-            ch_title = chapter.get("chapter_title") or chapter.get("title", f"Capitolo {ch_idx + 1}")
-            is_special = chapter.get("is_special", False)
-
+        parts = ["## Indice\n\n"]
+        for ch_title, is_special, ch_num, sections in _toc_entries(chapters):
             if is_special:
                 # Capitoli speciali (Introduzione, Conclusione, Bibliografia)
-                toc += f"**{ch_title}**\n\n"
+                parts.append(f"**{ch_title}**\n\n")
             else:
-                ch_num = chapter.get("chapter_index", ch_idx + 1)
-                toc += f"**Capitolo {ch_num}: {ch_title}**\n\n"
-
-                sections = chapter.get("sections", [])
-                for sec_idx, section in enumerate(sections):
-                    sec_num = section.get("index", sec_idx + 1)
-                    sec_title = section.get("title", f"Sezione {sec_num}")
-                    toc += f"  - {ch_num}.{sec_num}: {sec_title}\n"
-                toc += "\n"
+                parts.append(f"**Capitolo {ch_num}: {ch_title}**\n\n")
+                for sec_num, sec_title in sections:
+                    parts.append(f"  - {ch_num}.{sec_num}: {sec_title}\n")
+                parts.append("\n")
 
-        toc += "---\n\n"
-        return toc
+        parts.append("---\n\n")
+        return "".join(parts)
 
     else:
         # Formato TXT (anche per PDF e DOCX)
         separator = "═" * 65
-        toc = f"{separator}\n"
-        toc += "                           INDICE\n"
-        toc += f"{separator}\n\n"
-
-        for ch_idx, chapter in enumerate(chapters):
-            ch_title = chapter.get("chapter_title") or chapter.get("title", f"Capitolo {ch_idx + 1}")
-            is_special = chapter.get("is_special", False)
+        parts = [f"{separator}\n", "                           INDICE\n", f"{separator}\n\n"]
 
+        for ch_title, is_special, ch_num, sections in _toc_entries(chapters):
             if is_special:
                 # Capitoli speciali senza sezioni
-                toc += f"{ch_title}\n\n"
+                parts.append(f"{ch_title}\n\n")
             else:
-                ch_num = chapter.get("chapter_index", ch_idx + 1)
-                toc += f"Capitolo {ch_num}: {ch_title}\n"
+                parts.append(f"Capitolo {ch_num}: {ch_title}\n")
+                for sec_num, sec_title in sections:
+                    parts.append(f"    {ch_num}.{sec_num}: {sec_title}\n")
+                parts.append("\n")
 
-                sections = chapter.get("sections", [])
-                for sec_idx, section in enumerate(sections):
-                    sec_num = section.get("index", sec_idx + 1)
-                    sec_title = section.get("title", f"Sezione {sec_num}")
-                    toc += f"    {ch_num}.{sec_num}: {sec_title}\n"
-                toc += "\n"
+        parts.append(f"{separator}\n\n")
+        return "".join(parts)
 
-        toc += f"{separator}\n\n"
-        return toc
 
+# Indici gia' generati, per (tesi, updated_at, formato): export ripetuti della
+# stessa tesi (es. TXT e poi MD) non ripercorrono la struttura dei capitoli.
+# updated_at cambia a ogni modifica della tesi, quindi le voci vecchie non
+# vengono piu' lette e escono dalla coda LRU.
+_TOC_CACHE_SIZE = 256
+_toc_cache: "OrderedDict[tuple, str]" = OrderedDict()
+_toc_lock = threading.Lock()
 
-@router.get("/{thesis_id}/export")
-async def export_thesis(
-    thesis_id: str,
-    format: str = "pdf",
-    template_id: str = None,
-    current_user: User = Depends(get_current_active_user),
-    db: DBSession = Depends(get_db)
-):
-    """
-    Esporta la tesi completata nel formato richiesto.
 
-    Formati supportati: pdf, txt, md, docx
-    Include automaticamente l'indice all'inizio del documento.
-    """
-    thesis = get_thesis_by_id(db, thesis_id, str(current_user.id))
+def get_table_of_contents(thesis: Thesis, format_type: str = "txt") -> str:
+    """Indice della tesi (come generate_table_of_contents), dalla cache se possibile."""
+    key = (str(thesis.id), thesis.updated_at, format_type)
+    with _toc_lock:
+        toc = _toc_cache.get(key)
+        if toc is not None:
+            _toc_cache.move_to_end(key)
+            return toc
 
-    if thesis.status != 'completed':
-        raise HTTPException(
-            status_code=400,
-            detail=f"La tesi non è ancora completata. Stato: '{thesis.status}'"
-        )
+    toc = generate_table_of_contents(thesis.chapters_structure, format_type)
 
-    if not thesis.generated_content:
-        raise HTTPException(status_code=404, detail="Nessun contenuto generato")
+    with _toc_lock:
+        _toc_cache[key] = toc
+        while len(_toc_cache) > _TOC_CACHE_SIZE:
+            _toc_cache.popitem(last=False)
 
-    content = thesis.generated_content
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    safe_title = "".join(c for c in thesis.title[:50] if c.isalnum() or c in ' _-').strip()
-    cit_style = getattr(thesis, 'citation_style', 'footnotes') or 'footnotes'
+    return toc
 
-    # Genera l'indice
-    toc = generate_table_of_contents(thesis.chapters_structure, format)
-
-    if format == "txt":
-        # Export TXT con indice e note a piè di pagina come endnotes
-        has_footnotes = cit_style == 'footnotes'
-        processed_content, all_notes, _ = strip_footnotes_for_plain(content) if has_footnotes else (content, [], 1)
-        full_content = f"{thesis.title}\n{'=' * len(thesis.title)}\n\n"
-        full_content += toc
-        full_content += processed_content
-        if all_notes:
-            full_content += "\n\n" + "=" * 60 + "\nNOTE\n" + "=" * 60 + "\n\n"
-            for num, note_text in all_notes:
-                full_content += f"[{num}] {note_text}\n"
-
-        file_path = config.RESULTS_DIR / f"thesis_{safe_title}_{timestamp}.txt"
-        file_path.write_text(full_content, encoding='utf-8')
-
-        return FileResponse(
-            path=file_path,
-            filename=f"tesi_{safe_title}.txt",
-            media_type="text/plain"
-        )
 
-    elif format == "md":
-        # Export Markdown con indice e note come footnotes
-        has_footnotes = cit_style == 'footnotes'
-        processed_content, all_notes, _ = strip_footnotes_for_plain(content) if has_footnotes else (content, [], 1)
-        md_content = f"# {thesis.title}\n\n"
-        md_content += toc
-        md_content += processed_content
-        if all_notes:
-            md_content += "\n\n---\n\n### Note\n\n"
-            for num, note_text in all_notes:
-                md_content += f"[^{num}]: {note_text}\n\n"
-
-        file_path = config.RESULTS_DIR / f"thesis_{safe_title}_{timestamp}.md"
-        file_path.write_text(md_content, encoding='utf-8')
-
-        return FileResponse(
-            path=file_path,
-            filename=f"tesi_{safe_title}.md",
-            media_type="text/markdown"
-        )
+# Buffer dei file di export: il documento viene scritto su disco con poche
+# write grandi invece che a blocchi da 8 KB (DOCX: molte piccole write dello zip)
+_EXPORT_WRITE_BUFFER = 1 << 20
 
-    elif format == "docx":
-        # Export DOCX con indice — usa template (23 parametri)
-        from docx import Document as DocxDocument
-        from docx.shared import Pt, Inches, Cm, Emu
-        from docx.enum.text import WD_ALIGN_PARAGRAPH
-        from docx.oxml.ns import qn
-        from docx.oxml import OxmlElement
-        from lxml import etree
-
-        # Footnote tracking for DOCX
-        docx_footnote_id = [1]  # Mutable counter
-        docx_all_footnotes = []  # Collect all footnotes for endnotes fallback
-
-        def _ensure_footnotes_part(doc):
-            """Crea o ottieni la FootnotesPart per il documento."""
-            from docx.opc.part import Part as OpcPart
-            from docx.opc.packuri import PackURI
-
-            # Cerca se esiste già una relazione footnotes
-            FOOTNOTES_REL_TYPE = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/footnotes"
-            for rel in doc.part.rels.values():
-                if rel.reltype == FOOTNOTES_REL_TYPE:
-                    return rel.target_part
-
-            # Crea la footnotes part
-            footnotes_xml = (
-                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
-                '<w:footnotes xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
-                ' xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
-                '<w:footnote w:type="separator" w:id="-1">'
-                '<w:p><w:r><w:separator/></w:r></w:p>'
-                '</w:footnote>'
-                '<w:footnote w:type="continuationSeparator" w:id="0">'
-                '<w:p><w:r><w:continuationSeparator/></w:r></w:p>'
-                '</w:footnote>'
-                '</w:footnotes>'
-            )
-            footnotes_part = OpcPart(
-                PackURI('/word/footnotes.xml'),
-                'application/vnd.openxmlformats-officedocument.wordprocessingml.footnotes+xml',
-                footnotes_xml.encode('utf-8'),
-                doc.part.package
-            )
-            doc.part.relate_to(footnotes_part, FOOTNOTES_REL_TYPE)
-            return footnotes_part
 
-        def add_footnote(doc, paragraph, footnote_text, footnote_id, fn_font_name="Times New Roman", fn_font_size=10):
-            """Aggiunge una footnote reale al documento DOCX."""
-            try:
-                footnotes_part = _ensure_footnotes_part(doc)
-                fns_element = etree.fromstring(footnotes_part.blob)
-
-                # Crea l'elemento footnote
-                footnote_el = OxmlElement('w:footnote')
-                footnote_el.set(qn('w:id'), str(footnote_id))
-
-                # Paragrafo nella footnote
-                fn_para = OxmlElement('w:p')
-
-                # Run con il numero della footnote (nella footnote stessa)
-                fn_ref_run = OxmlElement('w:r')
-                fn_ref_rPr = OxmlElement('w:rPr')
-                fn_ref_style = OxmlElement('w:rStyle')
-                fn_ref_style.set(qn('w:val'), 'FootnoteReference')
-                fn_ref_rPr.append(fn_ref_style)
-                fn_ref_run.append(fn_ref_rPr)
-                fn_ref_elem = OxmlElement('w:footnoteRef')
-                fn_ref_run.append(fn_ref_elem)
-                fn_para.append(fn_ref_run)
-
-                # Spazio dopo il numero
-                space_run = OxmlElement('w:r')
-                space_t = OxmlElement('w:t')
-                space_t.set(qn('xml:space'), 'preserve')
-                space_t.text = ' '
-                space_run.append(space_t)
-                fn_para.append(space_run)
-
-                # Testo della nota
-                fn_text_run = OxmlElement('w:r')
-                fn_text_rPr = OxmlElement('w:rPr')
-                fn_text_sz = OxmlElement('w:sz')
-                fn_text_sz.set(qn('w:val'), str(fn_font_size * 2))  # half-points
-                fn_text_rPr.append(fn_text_sz)
-                fn_text_szCs = OxmlElement('w:szCs')
-                fn_text_szCs.set(qn('w:val'), str(fn_font_size * 2))
-                fn_text_rPr.append(fn_text_szCs)
-                if fn_font_name:
-                    fn_text_rFonts = OxmlElement('w:rFonts')
-                    fn_text_rFonts.set(qn('w:ascii'), fn_font_name)
-                    fn_text_rFonts.set(qn('w:hAnsi'), fn_font_name)
-                    fn_text_rPr.append(fn_text_rFonts)
-                fn_text_run.append(fn_text_rPr)
-                fn_text_t = OxmlElement('w:t')
-                fn_text_t.set(qn('xml:space'), 'preserve')
-                fn_text_t.text = footnote_text
-                fn_text_run.append(fn_text_t)
-                fn_para.append(fn_text_run)
-
-                footnote_el.append(fn_para)
-                fns_element.append(footnote_el)
-
-                # Aggiorna il blob
-                footnotes_part._blob = etree.tostring(fns_element, xml_declaration=True, encoding='UTF-8', standalone=True)
-
-                # Aggiungi il riferimento nel paragrafo del documento
-                fn_inline_run = OxmlElement('w:r')
-                fn_inline_rPr = OxmlElement('w:rPr')
-                fn_inline_style = OxmlElement('w:rStyle')
-                fn_inline_style.set(qn('w:val'), 'FootnoteReference')
-                fn_inline_rPr.append(fn_inline_style)
-                fn_inline_run.append(fn_inline_rPr)
-                fn_inline_ref = OxmlElement('w:footnoteReference')
-                fn_inline_ref.set(qn('w:id'), str(footnote_id))
-                fn_inline_run.append(fn_inline_ref)
-                paragraph._element.append(fn_inline_run)
+def _open_export_file(file_path: Path):
+    """Apre il file di export in scrittura binaria con buffer da 1 MB."""
+    return open(file_path, 'wb', buffering=_EXPORT_WRITE_BUFFER)
 
-            except Exception:
-                raise  # Let the caller handle the fallback
-
-        template = get_template_by_id(template_id, db)
-        ds = template.get("docx", {})
-
-        # Parametri base
-        font_name = ds.get("font_name", "Times New Roman")
-        font_sz = ds.get("font_size", 12)
-        font_title_sz = ds.get("font_title_size", 26)
-        title_align_str = ds.get("title_alignment", "center")
-        body_align_str = ds.get("body_alignment", "left")
-        line_sp = ds.get("line_spacing", 1.5)
-        para_sp_after = ds.get("paragraph_spacing_after", 6)
-        chapter_sp_before = ds.get("chapter_spacing_before", 18)
-        section_sp_before = ds.get("section_spacing_before", 12)
-        include_toc_docx = ds.get("include_toc", True)
-        include_page_nums = ds.get("include_page_numbers", True)
-        page_num_pos = ds.get("page_number_position", "bottom_center")
-        toc_indent_val = ds.get("toc_indent", 0.5)
-        h1_size = ds.get("heading1_size", 16)
-        h2_size = ds.get("heading2_size", 14)
-
-        # Margini
-        margin_top = ds.get("margin_top", 72)
-        margin_bottom = ds.get("margin_bottom", 72)
-        margin_left = ds.get("margin_left", 72)
-        margin_right = ds.get("margin_right", 72)
-
-        # Header/Footer
-        include_header = ds.get("include_header", False)
-        header_text = ds.get("header_text", "")
-        include_footer = ds.get("include_footer", False)
-        footer_text = ds.get("footer_text", "")
-
-        align_map = {
-            "left": WD_ALIGN_PARAGRAPH.LEFT,
-            "center": WD_ALIGN_PARAGRAPH.CENTER,
-            "right": WD_ALIGN_PARAGRAPH.RIGHT,
-            "justify": WD_ALIGN_PARAGRAPH.JUSTIFY,
-        }
-        title_alignment = align_map.get(title_align_str, WD_ALIGN_PARAGRAPH.CENTER)
-        body_alignment = align_map.get(body_align_str, WD_ALIGN_PARAGRAPH.LEFT)
 
-        file_path = config.RESULTS_DIR / f"thesis_{safe_title}_{timestamp}.docx"
+def _export_response(data: bytes, safe_title: str, timestamp: str, ext: str, media_type: str) -> Response:
+    """
+    Risposta di download per un export gia' serializzato in memoria.
 
-        doc = DocxDocument()
+    Con THESIS_PERSIST_EXPORTS il file viene anche archiviato in RESULTS_DIR
+    (una sola write); altrimenti i byte vanno direttamente al client.
+    """
+    filename = f"tesi_{safe_title}.{ext}"
+    if config.THESIS_PERSIST_EXPORTS:
+        file_path = config.RESULTS_DIR / f"thesis_{safe_title}_{timestamp}.{ext}"
+        with _open_export_file(file_path) as f:
+            f.write(data)
+        return FileResponse(path=file_path, filename=filename, media_type=media_type)
+
+    # Stessa intestazione prodotta da FileResponse
+    quoted = quote(filename)
+    if quoted != filename:
+        disposition = f"attachment; filename*=utf-8''{quoted}"
+    else:
+        disposition = f'attachment; filename="{filename}"'
+    return Response(content=data, media_type=media_type, headers={"Content-Disposition": disposition})
+
+
+def _export_txt(
+    thesis: Thesis, content: str, cit_style: str, template: dict
+) -> bytes:
+    """Export TXT con indice e note a piè di pagina come endnotes."""
+    has_footnotes = cit_style == 'footnotes'
+    processed_content, all_notes, _ = strip_footnotes_for_plain(content) if has_footnotes else (content, [], 1)
+    toc = get_table_of_contents(thesis, "txt")
+    parts = [f"{thesis.title}\n{'=' * len(thesis.title)}\n\n", toc, processed_content]
+    if all_notes:
+        parts.append("\n\n" + "=" * 60 + "\nNOTE\n" + "=" * 60 + "\n\n")
+        parts.extend(f"[{num}] {note_text}\n" for num, note_text in all_notes)
+
+    return "".join(parts).encode('utf-8')
+
+
+def _export_md(
+    thesis: Thesis, content: str, cit_style: str, template: dict
+) -> bytes:
+    """Export Markdown con indice e note come footnotes."""
+    has_footnotes = cit_style == 'footnotes'
+    processed_content, all_notes, _ = strip_footnotes_for_plain(content) if has_footnotes else (content, [], 1)
+    toc = get_table_of_contents(thesis, "md")
+    parts = [f"# {thesis.title}\n\n", toc, processed_content]
+    if all_notes:
+        parts.append("\n\n---\n\n### Note\n\n")
+        parts.extend(f"[^{num}]: {note_text}\n\n" for num, note_text in all_notes)
+
+    return "".join(parts).encode('utf-8')
+
+
+def _export_docx(
+    thesis: Thesis, content: str, cit_style: str, template: dict
+) -> bytes:
+    """Export DOCX con indice — usa template (23 parametri)."""
+    if not DOCX_AVAILABLE:
+        raise HTTPException(status_code=500, detail="Export DOCX non disponibile: python-docx non installato")
+
+    # Footnote tracking for DOCX
+    docx_footnote_id = [1]  # Mutable counter
+    docx_all_footnotes = []  # Collect all footnotes for endnotes fallback
+
+    def _ensure_footnotes_part(doc):
+        """Crea o ottieni la FootnotesPart per il documento."""
+        from docx.opc.part import Part as OpcPart
+        from docx.opc.packuri import PackURI
+
+        # Cerca se esiste già una relazione footnotes
+        FOOTNOTES_REL_TYPE = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/footnotes"
+        for rel in doc.part.rels.values():
+            if rel.reltype == FOOTNOTES_REL_TYPE:
+                return rel.target_part
+
+        # Crea la footnotes part
+        footnotes_xml = (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<w:footnotes xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+            ' xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            '<w:footnote w:type="separator" w:id="-1">'
+            '<w:p><w:r><w:separator/></w:r></w:p>'
+            '</w:footnote>'
+            '<w:footnote w:type="continuationSeparator" w:id="0">'
+            '<w:p><w:r><w:continuationSeparator/></w:r></w:p>'
+            '</w:footnote>'
+            '</w:footnotes>'
+        )
+        footnotes_part = OpcPart(
+            PackURI('/word/footnotes.xml'),
+            'application/vnd.openxmlformats-officedocument.wordprocessingml.footnotes+xml',
+            footnotes_xml.encode('utf-8'),
+            doc.part.package
+        )
+        doc.part.relate_to(footnotes_part, FOOTNOTES_REL_TYPE)
+        return footnotes_part
 
-        # ── Margini pagina ──
-        section_doc = doc.sections[0]
-        section_doc.top_margin = Pt(margin_top)
-        section_doc.bottom_margin = Pt(margin_bottom)
-        section_doc.left_margin = Pt(margin_left)
-        section_doc.right_margin = Pt(margin_right)
+    def add_footnote(doc, paragraph, footnote_text, footnote_id, fn_font_name="Times New Roman", fn_font_size=10):
+        """Aggiunge una footnote reale al documento DOCX."""
+        try:
+            footnotes_part = _ensure_footnotes_part(doc)
+            fns_element = etree.fromstring(footnotes_part.blob)
+
+            # Crea l'elemento footnote
+            footnote_el = OxmlElement('w:footnote')
+            footnote_el.set(qn('w:id'), str(footnote_id))
+
+            # Paragrafo nella footnote
+            fn_para = OxmlElement('w:p')
+
+            # Run con il numero della footnote (nella footnote stessa)
+            fn_ref_run = OxmlElement('w:r')
+            fn_ref_rPr = OxmlElement('w:rPr')
+            fn_ref_style = OxmlElement('w:rStyle')
+            fn_ref_style.set(qn('w:val'), 'FootnoteReference')
+            fn_ref_rPr.append(fn_ref_style)
+            fn_ref_run.append(fn_ref_rPr)
+            fn_ref_elem = OxmlElement('w:footnoteRef')
+            fn_ref_run.append(fn_ref_elem)
+            fn_para.append(fn_ref_run)
+
+            # Spazio dopo il numero
+            space_run = OxmlElement('w:r')
+            space_t = OxmlElement('w:t')
+            space_t.set(qn('xml:space'), 'preserve')
+            space_t.text = ' '
+            space_run.append(space_t)
+            fn_para.append(space_run)
+
+            # Testo della nota
+            fn_text_run = OxmlElement('w:r')
+            fn_text_rPr = OxmlElement('w:rPr')
+            fn_text_sz = OxmlElement('w:sz')
+            fn_text_sz.set(qn('w:val'), str(fn_font_size * 2))  # half-points
+            fn_text_rPr.append(fn_text_sz)
+            fn_text_szCs = OxmlElement('w:szCs')
+            fn_text_szCs.set(qn('w:val'), str(fn_font_size * 2))
+            fn_text_rPr.append(fn_text_szCs)
+            if fn_font_name:
+                fn_text_rFonts = OxmlElement('w:rFonts')
+                fn_text_rFonts.set(qn('w:ascii'), fn_font_name)
+                fn_text_rFonts.set(qn('w:hAnsi'), fn_font_name)
+                fn_text_rPr.append(fn_text_rFonts)
+            fn_text_run.append(fn_text_rPr)
+            fn_text_t = OxmlElement('w:t')
+            fn_text_t.set(qn('xml:space'), 'preserve')
+            fn_text_t.text = footnote_text
+            fn_text_run.append(fn_text_t)
+            fn_para.append(fn_text_run)
+
+            footnote_el.append(fn_para)
+            fns_element.append(footnote_el)
+
+            # Aggiorna il blob
+            footnotes_part._blob = etree.tostring(fns_element, xml_declaration=True, encoding='UTF-8', standalone=True)
+
+            # Aggiungi il riferimento nel paragrafo del documento
+            fn_inline_run = OxmlElement('w:r')
+            fn_inline_rPr = OxmlElement('w:rPr')
+            fn_inline_style = OxmlElement('w:rStyle')
+            fn_inline_style.set(qn('w:val'), 'FootnoteReference')
+            fn_inline_rPr.append(fn_inline_style)
+            fn_inline_run.append(fn_inline_rPr)
+            fn_inline_ref = OxmlElement('w:footnoteReference')
+            fn_inline_ref.set(qn('w:id'), str(footnote_id))
+            fn_inline_run.append(fn_inline_ref)
+            paragraph._element.append(fn_inline_run)
 
-        # Imposta stile Normal
-        style = doc.styles['Normal']
-        style_font = style.font
-        style_font.name = font_name
-        style_font.size = Pt(font_sz)
-        style.paragraph_format.line_spacing = line_sp
+        except Exception:
+            raise  # Let the caller handle the fallback
+
+    ds = template.get("docx", {})
+
+    # Parametri base
+    font_name = ds.get("font_name", "Times New Roman")
+    font_sz = ds.get("font_size", 12)
+    font_title_sz = ds.get("font_title_size", 26)
+    title_align_str = ds.get("title_alignment", "center")
+    body_align_str = ds.get("body_alignment", "left")
+    line_sp = ds.get("line_spacing", 1.5)
+    para_sp_after = ds.get("paragraph_spacing_after", 6)
+    chapter_sp_before = ds.get("chapter_spacing_before", 18)
+    section_sp_before = ds.get("section_spacing_before", 12)
+    include_toc_docx = ds.get("include_toc", True)
+    include_page_nums = ds.get("include_page_numbers", True)
+    page_num_pos = ds.get("page_number_position", "bottom_center")
+    toc_indent_val = ds.get("toc_indent", 0.5)
+    h1_size = ds.get("heading1_size", 16)
+    h2_size = ds.get("heading2_size", 14)
+
+    # Margini
+    margin_top = ds.get("margin_top", 72)
+    margin_bottom = ds.get("margin_bottom", 72)
+    margin_left = ds.get("margin_left", 72)
+    margin_right = ds.get("margin_right", 72)
+
+    # Header/Footer
+    include_header = ds.get("include_header", False)
+    header_text = ds.get("header_text", "")
+    include_footer = ds.get("include_footer", False)
+    footer_text = ds.get("footer_text", "")
+
+    align_map = {
+        "left": WD_ALIGN_PARAGRAPH.LEFT,
+        "center": WD_ALIGN_PARAGRAPH.CENTER,
+        "right": WD_ALIGN_PARAGRAPH.RIGHT,
+        "justify": WD_ALIGN_PARAGRAPH.JUSTIFY,
+    }
+    title_alignment = align_map.get(title_align_str, WD_ALIGN_PARAGRAPH.CENTER)
+    body_alignment = align_map.get(body_align_str, WD_ALIGN_PARAGRAPH.LEFT)
+
+    doc = DocxDocument()
+
+    # ── Margini pagina ──
+    section_doc = doc.sections[0]
+    section_doc.top_margin = Pt(margin_top)
+    section_doc.bottom_margin = Pt(margin_bottom)
+    section_doc.left_margin = Pt(margin_left)
+    section_doc.right_margin = Pt(margin_right)
+
+    # Imposta stile Normal
+    style = doc.styles['Normal']
+    style_font = style.font
+    style_font.name = font_name
+    style_font.size = Pt(font_sz)
+    style.paragraph_format.line_spacing = line_sp
+
+    # Imposta font Heading 1
+    try:
+        h1_style = doc.styles['Heading 1']
+        h1_style.font.name = font_name
+        h1_style.font.size = Pt(h1_size)
+        h1_style.paragraph_format.space_before = Pt(chapter_sp_before)
+    except Exception:
+        pass
 
-        # Imposta font Heading 1
+    # Imposta font Heading 2
+    try:
+        h2_style = doc.styles['Heading 2']
+        h2_style.font.name = font_name
+        h2_style.font.size = Pt(h2_size)
+        h2_style.paragraph_format.space_before = Pt(section_sp_before)
+    except Exception:
+        pass
+
+    # ── Helper: inserisce campo PAGE in un paragrafo ──
+    def _add_page_field(paragraph, pg_font_name, pg_font_size=9):
+        run = paragraph.add_run()
+        fld_begin = OxmlElement('w:fldChar')
+        fld_begin.set(qn('w:fldCharType'), 'begin')
+        run._r.append(fld_begin)
+        instr = OxmlElement('w:instrText')
+        instr.set(qn('xml:space'), 'preserve')
+        instr.text = ' PAGE '
+        run._r.append(instr)
+        fld_end = OxmlElement('w:fldChar')
+        fld_end.set(qn('w:fldCharType'), 'end')
+        run._r.append(fld_end)
+        for r in paragraph.runs:
+            r.font.name = pg_font_name
+            r.font.size = Pt(pg_font_size)
+
+    # ── Numeri di pagina (con posizione configurabile) ──
+    if include_page_nums:
         try:
-            h1_style = doc.styles['Heading 1']
-            h1_style.font.name = font_name
-            h1_style.font.size = Pt(h1_size)
-            h1_style.paragraph_format.space_before = Pt(chapter_sp_before)
+            is_top = page_num_pos.startswith("top")
+            is_right = page_num_pos.endswith("right")
+            pg_align = WD_ALIGN_PARAGRAPH.RIGHT if is_right else WD_ALIGN_PARAGRAPH.CENTER
+
+            if is_top:
+                target = section_doc.header
+                target.is_linked_to_previous = False
+                pg_para = target.paragraphs[0] if target.paragraphs else target.add_paragraph()
+                pg_para.alignment = pg_align
+                _add_page_field(pg_para, font_name)
+            else:
+                target = section_doc.footer
+                target.is_linked_to_previous = False
+                pg_para = target.paragraphs[0] if target.paragraphs else target.add_paragraph()
+                pg_para.alignment = pg_align
+                _add_page_field(pg_para, font_name)
         except Exception:
             pass
 
-        # Imposta font Heading 2
+    # ── Intestazione (header text) ──
+    if include_header and header_text:
         try:
-            h2_style = doc.styles['Heading 2']
-            h2_style.font.name = font_name
-            h2_style.font.size = Pt(h2_size)
-            h2_style.paragraph_format.space_before = Pt(section_sp_before)
+            section_doc.header.is_linked_to_previous = False
+            # Se numeri pagina sono in alto, aggiungi testo su una riga separata
+            if include_page_nums and page_num_pos.startswith("top"):
+                h_para = section_doc.header.add_paragraph()
+            else:
+                h_para = section_doc.header.paragraphs[0] if section_doc.header.paragraphs else section_doc.header.add_paragraph()
+            h_run = h_para.add_run(header_text)
+            h_run.font.name = font_name
+            h_run.font.size = Pt(9)
+            h_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
         except Exception:
             pass
 
-        # ── Helper: inserisce campo PAGE in un paragrafo ──
-        def _add_page_field(paragraph, pg_font_name, pg_font_size=9):
-            run = paragraph.add_run()
-            fld_begin = OxmlElement('w:fldChar')
-            fld_begin.set(qn('w:fldCharType'), 'begin')
-            run._r.append(fld_begin)
-            instr = OxmlElement('w:instrText')
-            instr.set(qn('xml:space'), 'preserve')
-            instr.text = ' PAGE '
-            run._r.append(instr)
-            fld_end = OxmlElement('w:fldChar')
-            fld_end.set(qn('w:fldCharType'), 'end')
-            run._r.append(fld_end)
-            for r in paragraph.runs:
-                r.font.name = pg_font_name
-                r.font.size = Pt(pg_font_size)
-
-        # ── Numeri di pagina (con posizione configurabile) ──
-        if include_page_nums:
-            try:
-                is_top = page_num_pos.startswith("top")
-                is_right = page_num_pos.endswith("right")
-                pg_align = WD_ALIGN_PARAGRAPH.RIGHT if is_right else WD_ALIGN_PARAGRAPH.CENTER
-
-                if is_top:
-                    target = section_doc.header
-                    target.is_linked_to_previous = False
-                    pg_para = target.paragraphs[0] if target.paragraphs else target.add_paragraph()
-                    pg_para.alignment = pg_align
-                    _add_page_field(pg_para, font_name)
-                else:
-                    target = section_doc.footer
-                    target.is_linked_to_previous = False
-                    pg_para = target.paragraphs[0] if target.paragraphs else target.add_paragraph()
-                    pg_para.alignment = pg_align
-                    _add_page_field(pg_para, font_name)
-            except Exception:
-                pass
+    # ── Pie' di pagina (footer text) ──
+    if include_footer and footer_text:
+        try:
+            section_doc.footer.is_linked_to_previous = False
+            # Se numeri pagina sono in basso, aggiungi testo su una riga separata
+            if include_page_nums and page_num_pos.startswith("bottom"):
+                f_para = section_doc.footer.add_paragraph()
+            else:
+                f_para = section_doc.footer.paragraphs[0] if section_doc.footer.paragraphs else section_doc.footer.add_paragraph()
+            f_run = f_para.add_run(footer_text)
+            f_run.font.name = font_name
+            f_run.font.size = Pt(9)
+            f_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        except Exception:
+            pass
 
-        # ── Intestazione (header text) ──
-        if include_header and header_text:
-            try:
-                section_doc.header.is_linked_to_previous = False
-                # Se numeri pagina sono in alto, aggiungi testo su una riga separata
-                if include_page_nums and page_num_pos.startswith("top"):
-                    h_para = section_doc.header.add_paragraph()
-                else:
-                    h_para = section_doc.header.paragraphs[0] if section_doc.header.paragraphs else section_doc.header.add_paragraph()
-                h_run = h_para.add_run(header_text)
-                h_run.font.name = font_name
-                h_run.font.size = Pt(9)
-                h_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            except Exception:
-                pass
+    # ── Titolo principale ──
+    title_para = doc.add_heading(thesis.title, level=0)
+    title_para.alignment = title_alignment
+    for run in title_para.runs:
+        run.font.name = font_name
+        run.font.size = Pt(font_title_sz)
 
-        # ── Pie' di pagina (footer text) ──
-        if include_footer and footer_text:
-            try:
-                section_doc.footer.is_linked_to_previous = False
-                # Se numeri pagina sono in basso, aggiungi testo su una riga separata
-                if include_page_nums and page_num_pos.startswith("bottom"):
-                    f_para = section_doc.footer.add_paragraph()
-                else:
-                    f_para = section_doc.footer.paragraphs[0] if section_doc.footer.paragraphs else section_doc.footer.add_paragraph()
-                f_run = f_para.add_run(footer_text)
-                f_run.font.name = font_name
-                f_run.font.size = Pt(9)
-                f_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            except Exception:
-                pass
+    doc.add_paragraph()  # Spazio dopo titolo
 
-        # ── Titolo principale ──
-        title_para = doc.add_heading(thesis.title, level=0)
-        title_para.alignment = title_alignment
-        for run in title_para.runs:
+    # Indice
+    chapters_for_toc = thesis.chapters_structure.get("chapters", []) if thesis.chapters_structure else []
+    if chapters_for_toc and include_toc_docx:
+        toc_heading = doc.add_heading('Indice', level=1)
+        for run in toc_heading.runs:
             run.font.name = font_name
-            run.font.size = Pt(font_title_sz)
 
-        doc.add_paragraph()  # Spazio dopo titolo
-
-        # Indice
-        chapters_for_toc = thesis.chapters_structure.get("chapters", []) if thesis.chapters_structure else []
-        if chapters_for_toc and include_toc_docx:
-            toc_heading = doc.add_heading('Indice', level=1)
-            for run in toc_heading.runs:
-                run.font.name = font_name
+        for ch_title, is_special, ch_num, sections in _toc_entries(chapters_for_toc):
+            if is_special:
+                toc_para = doc.add_paragraph()
+                toc_run = toc_para.add_run(ch_title)
+                toc_run.bold = True
+                toc_run.font.size = Pt(font_sz - 1)
+                toc_run.font.name = font_name
+            else:
+                toc_para = doc.add_paragraph()
+                toc_run = toc_para.add_run(f"Capitolo {ch_num}: {ch_title}")
+                toc_run.bold = True
+                toc_run.font.size = Pt(font_sz - 1)
+                toc_run.font.name = font_name
+
+                for sec_num, sec_title in sections:
+                    sec_para = doc.add_paragraph(
+                        f"    {ch_num}.{sec_num}: {sec_title}",
+                        style='List Bullet'
+                    )
+                    sec_para.paragraph_format.left_indent = Inches(toc_indent_val)
+                    for run in sec_para.runs:
+                        run.font.size = Pt(font_sz - 2)
+                        run.font.name = font_name
 
-            for ch_idx, chapter in enumerate(chapters_for_toc):
-                ch_title = chapter.get("chapter_title") or chapter.get("title", f"Capitolo {ch_idx + 1}")
-                is_special = chapter.get("is_special", False)
+        doc.add_page_break()
+
+    # ── Contenuto con body_alignment e footnotes ──
+    # doc.add_paragraph cerca ogni volta il sectPr finale scorrendo il body
+    # (costo lineare per paragrafo, quadratico sul documento): i paragrafi
+    # vengono inseriti prima di un paragrafo sentinella, in tempo costante.
+    sentinel = doc.add_paragraph()
+    add_para = sentinel.insert_paragraph_before
+
+    # I paragrafi di testo semplice (la gran parte del contenuto) hanno tutti la
+    # stessa formattazione: il loro XML viene composto come stringa e
+    # interpretato da lxml a blocchi, invece di costruire pPr/rPr run per run
+    # tramite l'API di python-docx. L'XML e' quello che produrrebbe add_para.
+    jc_map = {"left": "left", "center": "center", "right": "right", "justify": "both"}
+    body_p_open = (
+        f'<w:p><w:pPr><w:spacing w:after="{round(para_sp_after * 20)}" '
+        f'w:line="{round(line_sp * 240)}" w:lineRule="auto"/>'
+        f'<w:jc w:val="{jc_map.get(body_align_str, "left")}"/></w:pPr>'
+        f'<w:r><w:rPr><w:rFonts w:ascii={xml_quoteattr(font_name)} w:hAnsi={xml_quoteattr(font_name)}/>'
+        f'<w:sz w:val="{round(font_sz * 2)}"/></w:rPr><w:t xml:space="preserve">'
+    )
+    body_p_close = '</w:t></w:r></w:p>'
+    pending_paras = []
 
-                if is_special:
-                    toc_para = doc.add_paragraph()
-                    toc_run = toc_para.add_run(ch_title)
-                    toc_run.bold = True
-                    toc_run.font.size = Pt(font_sz - 1)
-                    toc_run.font.name = font_name
-                else:
-                    ch_num = chapter.get("chapter_index", ch_idx + 1)
-                    toc_para = doc.add_paragraph()
-                    toc_run = toc_para.add_run(f"Capitolo {ch_num}: {ch_title}")
-                    toc_run.bold = True
-                    toc_run.font.size = Pt(font_sz - 1)
-                    toc_run.font.name = font_name
-
-                    sections = chapter.get("sections", [])
-                    for sec_idx, section_item in enumerate(sections):
-                        sec_num = section_item.get("index", sec_idx + 1)
-                        sec_title = section_item.get("title", f"Sezione {sec_num}")
-                        sec_para = doc.add_paragraph(
-                            f"    {ch_num}.{sec_num}: {sec_title}",
-                            style='List Bullet'
-                        )
-                        sec_para.paragraph_format.left_indent = Inches(toc_indent_val)
-                        for run in sec_para.runs:
-                            run.font.size = Pt(font_sz - 2)
-                            run.font.name = font_name
-
-            doc.add_page_break()
-
-        # ── Contenuto con body_alignment e footnotes ──
-        for line in content.split('\n'):
-            if line.startswith('# '):
-                h = doc.add_heading(line[2:], level=1)
-                h.paragraph_format.space_before = Pt(chapter_sp_before)
-                for run in h.runs:
-                    run.font.name = font_name
-            elif line.startswith('## '):
-                h = doc.add_heading(line[3:], level=2)
-                h.paragraph_format.space_before = Pt(section_sp_before)
-                for run in h.runs:
-                    run.font.name = font_name
-            elif line.strip():
-                footnotes_in_line = extract_footnotes_from_line(line)
-                if footnotes_in_line:
-                    para = doc.add_paragraph()
-                    para.alignment = body_alignment
-                    para.paragraph_format.space_after = Pt(para_sp_after)
-                    para.paragraph_format.line_spacing = line_sp
-
-                    last_end = 0
-                    for fn_start, fn_end, fn_text in footnotes_in_line:
-                        # Testo prima della nota
-                        before_text = line[last_end:fn_start]
-                        if before_text:
-                            run = para.add_run(before_text)
-                            run.font.name = font_name
-                            run.font.size = Pt(font_sz)
-                        # Aggiungi la footnote
-                        try:
-                            add_footnote(doc, para, fn_text, docx_footnote_id[0], font_name, font_sz - 2)
-                            docx_footnote_id[0] += 1
-                        except Exception as e:
-                            # Fallback: aggiungi come testo in apice
-                            sup_run = para.add_run(f"[{docx_footnote_id[0]}]")
-                            sup_run.font.name = font_name
-                            sup_run.font.size = Pt(font_sz - 2)
-                            sup_run.font.superscript = True
-                            docx_footnote_id[0] += 1
-                        last_end = fn_end
-
-                    # Testo dopo l'ultima nota
-                    remaining = line[last_end:]
-                    if remaining:
-                        run = para.add_run(remaining)
+    def flush_pending_paras():
+        if not pending_paras:
+            return
+        batch = parse_xml(f'<w:body {nsdecls("w")}>{"".join(pending_paras)}</w:body>')
+        for p_element in list(batch):
+            sentinel._p.addprevious(p_element)
+        pending_paras.clear()
+
+    for line in content.split('\n'):
+        if line.startswith('# '):
+            flush_pending_paras()
+            h = add_para(line[2:], style='Heading 1')
+            h.paragraph_format.space_before = Pt(chapter_sp_before)
+            for run in h.runs:
+                run.font.name = font_name
+        elif line.startswith('## '):
+            flush_pending_paras()
+            h = add_para(line[3:], style='Heading 2')
+            h.paragraph_format.space_before = Pt(section_sp_before)
+            for run in h.runs:
+                run.font.name = font_name
+        elif line.strip():
+            footnotes_in_line = extract_footnotes_from_line(line)
+            if footnotes_in_line:
+                flush_pending_paras()
+                para = add_para()
+                para.alignment = body_alignment
+                para.paragraph_format.space_after = Pt(para_sp_after)
+                para.paragraph_format.line_spacing = line_sp
+
+                last_end = 0
+                for fn_start, fn_end, fn_text in footnotes_in_line:
+                    # Testo prima della nota
+                    before_text = line[last_end:fn_start]
+                    if before_text:
+                        run = para.add_run(before_text)
                         run.font.name = font_name
                         run.font.size = Pt(font_sz)
+                    # Aggiungi la footnote
+                    try:
+                        add_footnote(doc, para, fn_text, docx_footnote_id[0], font_name, font_sz - 2)
+                        docx_footnote_id[0] += 1
+                    except Exception as e:
+                        # Fallback: aggiungi come testo in apice
+                        sup_run = para.add_run(f"[{docx_footnote_id[0]}]")
+                        sup_run.font.name = font_name
+                        sup_run.font.size = Pt(font_sz - 2)
+                        sup_run.font.superscript = True
+                        docx_footnote_id[0] += 1
+                    last_end = fn_end
+
+                # Testo dopo l'ultima nota
+                remaining = line[last_end:]
+                if remaining:
+                    run = para.add_run(remaining)
+                    run.font.name = font_name
+                    run.font.size = Pt(font_sz)
+            elif '\t' not in line and '\r' not in line:
+                pending_paras.append(body_p_open + xml_escape(line) + body_p_close)
+            else:
+                # Tabulazioni e \r diventano <w:tab/> e <w:br/>: li gestisce add_run
+                flush_pending_paras()
+                para = add_para(line)
+                para.alignment = body_alignment
+                para.paragraph_format.space_after = Pt(para_sp_after)
+                para.paragraph_format.line_spacing = line_sp
+                for run in para.runs:
+                    run.font.name = font_name
+                    run.font.size = Pt(font_sz)
+        # Righe vuote: non aggiungere nulla (spazio naturale)
+    flush_pending_paras()
+    sentinel._element.getparent().remove(sentinel._element)
+
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+# PyMuPDF non supporta l'uso da piu' thread insieme (contesto MuPDF globale):
+# gli export PDF, eseguiti in thread, vengono serializzati
+_pdf_export_lock = threading.Lock()
+
+
+def _export_pdf(
+    thesis: Thesis, content: str, cit_style: str, template: dict
+) -> bytes:
+    """Export PDF (default) con indice — usa template."""
+    with _pdf_export_lock:
+        return _render_pdf(thesis, content, cit_style, template)
+
+
+def _render_pdf(thesis: Thesis, content: str, cit_style: str, template: dict) -> bytes:
+    """Impagina la tesi in PDF con PyMuPDF (chiamare solo da _export_pdf)."""
+    ps = template.get("pdf", {})
+
+    page_width, page_height = get_page_dimensions(ps.get("page_size", "A4"))
+    margin_top = ps.get("margin_top", 50)
+    margin_bottom = ps.get("margin_bottom", 50)
+    margin_left = ps.get("margin_left", 50)
+    margin_right = ps.get("margin_right", 50)
+    font_body = ps.get("font_body", "helv")
+    font_size = ps.get("font_body_size", 11)
+    font_title_size = ps.get("font_title_size", 24)
+    font_chapter_size = ps.get("font_chapter_size", 18)
+    font_section_size = ps.get("font_section_size", 14)
+    line_height_mult = ps.get("line_height_multiplier", 1.5)
+    include_toc_pdf = ps.get("include_toc", True)
+    include_page_numbers = ps.get("include_page_numbers", True)
+    page_number_position = ps.get("page_number_position", "bottom_center")
+    include_header = ps.get("include_header", False)
+    header_text = ps.get("header_text", "")
+    include_footer = ps.get("include_footer", False)
+    footer_text = ps.get("footer_text", "")
+    title_align = ps.get("title_alignment", "center")
+    body_align = ps.get("body_alignment", "left")
+    chapter_spacing = ps.get("chapter_spacing_before", 20)
+    section_spacing = ps.get("section_spacing_before", 15)
+    paragraph_spacing = ps.get("paragraph_spacing", 0)
+    toc_separator_color = ps.get("toc_separator_color", [0.7, 0.7, 0.7])
+    bg_image_file = ps.get("background_image", "")
+    bg_image_mode = ps.get("background_image_mode", "all_pages")
+    bg_opacity = ps.get("background_opacity", 0.15)
+    bg_image_fit = ps.get("background_image_fit", "tile")
+
+    # Resolve background image path
+    bg_image_path = None
+    if bg_image_file:
+        candidate = config.UPLOAD_DIR / "template_backgrounds" / bg_image_file
+        if candidate.exists():
+            bg_image_path = str(candidate)
+
+    line_height = font_size * line_height_mult
+    content_width = page_width - margin_left - margin_right
+
+    # Calcolo posizione x per allineamenti
+    def calc_text_x(text, fontsize, fontname, alignment):
+        """Calcola la posizione x basata sull'allineamento."""
+        if alignment == "center":
+            text_width = fitz.get_text_length(text, fontname=fontname, fontsize=fontsize)
+            return margin_left + (content_width - text_width) / 2
+        elif alignment == "right":
+            text_width = fitz.get_text_length(text, fontname=fontname, fontsize=fontsize)
+            return page_width - margin_right - text_width
+        return margin_left  # left / justify (default)
+
+    # Larghezze delle parole nel font del corpo, misurate una volta per export:
+    # in una tesi le stesse parole ricorrono migliaia di volte
+    word_widths = {}
+
+    def word_width(word, fontsize):
+        """Larghezza di una parola (o di uno spazio) in font_body, dalla cache."""
+        key = (word, fontsize)
+        width = word_widths.get(key)
+        if width is None:
+            width = word_widths[key] = fitz.get_text_length(word, fontname=font_body, fontsize=fontsize)
+        return width
+
+    def wrap_words(text, fontsize, max_width):
+        """
+        Divide il testo in righe (liste di parole) larghe meno di max_width.
+
+        Ogni parola viene misurata una sola volta: con i font Base14 la
+        larghezza di una riga e' la somma di parole e spazi (senza kerning).
+        Una parola piu' larga di max_width occupa da sola una riga.
+        """
+        space_w = word_width(' ', fontsize)
+        lines = []
+        current_line = []
+        current_w = 0.0
+        for word in text.split():
+            word_w = word_width(word, fontsize)
+            extra_w = word_w + space_w if current_line else word_w
+            if current_w + extra_w < max_width:
+                current_line.append(word)
+                current_w += extra_w
+            else:
+                if current_line:
+                    lines.append(current_line)
+                current_line = [word]
+                current_w = word_w
+        if current_line:
+            lines.append(current_line)
+        return lines
+
+    def insert_justified_line(page, x_start, y_pos, words_list, fontsize, available_width, is_last_line=False):
+        """Inserisce una riga di testo giustificato distribuendo gli spazi tra le parole."""
+        if is_last_line or len(words_list) <= 1:
+            # Ultima riga o singola parola: allinea a sinistra
+            add_text(page, (x_start, y_pos), ' '.join(words_list), fontsize)
+            return
+        # Calcola lo spazio extra da distribuire (senza kerning la larghezza
+        # del testo e' la somma delle parole, gia' misurate da wrap_words)
+        widths = [word_width(word, fontsize) for word in words_list]
+        total_space = available_width - sum(widths)
+        space_between = total_space / (len(words_list) - 1)
+        # Inserisci parola per parola
+        cx = x_start
+        for word, word_w in zip(words_list, widths):
+            add_text(page, (cx, y_pos), word, fontsize)
+            cx += word_w + space_between
+
+
+    pdf_doc = fitz.open()
+    page_count = [0]  # Mutable per contare le pagine
+
+    # Il testo non viene inserito riga per riga: si accumula in un
+    # TextWriter per pagina e colore, scritto sulla pagina una volta sola
+    # prima del salvataggio (un solo font risolto per tutto il documento)
+    pdf_font = fitz.Font(font_body)
+    page_writers = {}  # (numero pagina, colore) -> TextWriter
+
+    def add_text(page, pos, text, fontsize, color=None):
+        """Accoda il testo (pos = linea di base, come insert_text) al TextWriter della pagina."""
+        writer = page_writers.get((page.number, color))
+        if writer is None:
+            writer = page_writers[(page.number, color)] = fitz.TextWriter(page.rect)
+        writer.append(pos, text, font=pdf_font, fontsize=fontsize)
+
+    def new_pdf_page():
+        """Crea una nuova pagina e incrementa il contatore."""
+        p = pdf_doc.new_page(width=page_width, height=page_height)
+        page_count[0] += 1
+        return p
+
+    # Footnote tracking for PDF
+    pdf_footnote_num = [1]  # Progressive footnote number
+    page_footnotes = []  # Footnotes for current page
+    fn_font_size = max(font_size - 3, 7)
+    fn_line_height = fn_font_size * 1.3
+    fn_separator_space = 15  # Space for separator line above footnotes
+
+    def get_footnotes_height():
+        """Calcola altezza necessaria per le note a piè di pagina correnti."""
+        if not page_footnotes:
+            return 0
+        return fn_separator_space + len(page_footnotes) * fn_line_height + 5
+
+    def render_page_footnotes():
+        """Renderizza le note raccolte in fondo alla pagina corrente."""
+        if not page_footnotes:
+            return
+        fn_y = page_height - margin_bottom - get_footnotes_height() + fn_separator_space
+        # Linea separatrice
+        current_page.draw_line(
+            fitz.Point(margin_left, fn_y - 8),
+            fitz.Point(margin_left + content_width * 0.3, fn_y - 8),
+            color=(0.5, 0.5, 0.5),
+            width=0.5
+        )
+        for fn_num, fn_text in page_footnotes:
+            fn_label = f"{fn_num} "
+            label_width = word_width(fn_label, fn_font_size)
+            add_text(current_page, (margin_left, fn_y), fn_label, fn_font_size, color=(0.3, 0.3, 0.3))
+            # Wrap footnote text (righe allineate dopo l'etichetta)
+            fn_x_start = margin_left + label_width
+            fn_content_width = content_width - label_width
+            for fn_line_idx, fn_line in enumerate(wrap_words(fn_text, fn_font_size, fn_content_width)):
+                if fn_line_idx:
+                    fn_y += fn_line_height
+                add_text(current_page, (fn_x_start, fn_y), ' '.join(fn_line), fn_font_size, color=(0.3, 0.3, 0.3))
+            fn_y += fn_line_height
+
+    def get_available_y():
+        """Altezza massima disponibile per il contenuto (sottraendo footnotes)."""
+        return page_height - margin_bottom - get_footnotes_height()
+
+    def check_new_page_needed(needed_height):
+        """
+        Verifica se serve nuova pagina. Se sì, renderizza footnotes e crea nuova pagina.
+
+        Unico punto di impaginazione per indice e contenuto (nell'indice non ci
+        sono note: lo spazio disponibile arriva al margine inferiore).
+        """
+        nonlocal current_page, y, page_footnotes
+        if y + needed_height > get_available_y():
+            render_page_footnotes()
+            page_footnotes = []
+            current_page = new_pdf_page()
+            y = margin_top
+
+    current_page = new_pdf_page()
+    y = margin_top
+
+    # Titolo principale (con word-wrap)
+    for title_line in wrap_words(thesis.title, font_title_size, content_width):
+        t_str = ' '.join(title_line)
+        t_x = calc_text_x(t_str, font_title_size, font_body, title_align)
+        add_text(current_page, (t_x, y + font_title_size), t_str, font_title_size)
+        y += font_title_size + 4
+    y += 16
+
+    # Separatore
+    y += 20
+
+    # Indice
+    chapters = thesis.chapters_structure.get("chapters", []) if thesis.chapters_structure else []
+    if chapters and include_toc_pdf:
+        toc_title_size = font_section_size
+        add_text(current_page, (margin_left, y), "INDICE", toc_title_size)
+        y += toc_title_size + 10
+
+        # Linea separatrice
+        sep_color = tuple(toc_separator_color) if isinstance(toc_separator_color, list) else (0.7, 0.7, 0.7)
+        current_page.draw_line(
+            fitz.Point(margin_left, y),
+            fitz.Point(page_width - margin_right, y),
+            color=sep_color,
+            width=1
+        )
+        y += 15
+
+        # Contenuto indice
+        for ch_title, is_special, ch_num, sections in _toc_entries(chapters):
+            check_new_page_needed(line_height * 2)
+
+            # Word-wrap chapter titles (capitoli speciali senza numero)
+            toc_text = ch_title if is_special else f"Capitolo {ch_num}: {ch_title}"
+            for toc_line in wrap_words(toc_text, font_size, content_width):
+                check_new_page_needed(line_height)
+                add_text(current_page, (margin_left, y), ' '.join(toc_line), font_size)
+                y += line_height
+
+            for sec_num, sec_title in sections:
+                check_new_page_needed(line_height)
+
+                # Word-wrap section titles (indented by 20)
+                sec_text = f"{ch_num}.{sec_num}: {sec_title}"
+                sec_available_width = content_width - 20
+                for sec_line in wrap_words(sec_text, font_size - 1, sec_available_width):
+                    check_new_page_needed(line_height)
+                    add_text(current_page, (margin_left + 20, y), ' '.join(sec_line), font_size - 1)
+                    y += line_height * 0.9
+
+            y += 5  # Spazio tra capitoli
+
+        # Separatore dopo indice
+        y += 15
+        current_page.draw_line(
+            fitz.Point(margin_left, y),
+            fitz.Point(page_width - margin_right, y),
+            color=sep_color,
+            width=1
+        )
+        y += 30
+
+    # Nuova pagina per il contenuto
+    current_page = new_pdf_page()
+    y = margin_top
+
+    # Contenuto con footnotes
+    for line in content.split('\n'):
+        check_new_page_needed(line_height)
+
+        # Gestisci titoli
+        if line.startswith('# '):
+            y += chapter_spacing
+            check_new_page_needed(font_chapter_size + 10)
+            # Word-wrap chapter title
+            for ch_line in wrap_words(line[2:], font_chapter_size, content_width):
+                check_new_page_needed(font_chapter_size + 4)
+                add_text(current_page, (margin_left, y), ' '.join(ch_line), font_chapter_size)
+                y += font_chapter_size + 4
+            y += 4
+        elif line.startswith('## '):
+            y += section_spacing
+            check_new_page_needed(font_section_size + 8)
+            # Word-wrap section title
+            for sec_line in wrap_words(line[3:], font_section_size, content_width):
+                check_new_page_needed(font_section_size + 3)
+                add_text(current_page, (margin_left, y), ' '.join(sec_line), font_section_size)
+                y += font_section_size + 3
+        elif line.strip():
+            # Check for footnotes in line
+            footnotes_in_line = extract_footnotes_from_line(line)
+
+            if footnotes_in_line:
+                # Process line: strip {{nota:...}} and replace with superscript numbers
+                processed_line = ""
+                last_end = 0
+                line_fn_nums = []
+                for fn_start, fn_end, fn_text in footnotes_in_line:
+                    processed_line += line[last_end:fn_start]
+                    fn_num = pdf_footnote_num[0]
+                    processed_line += f"[{fn_num}]"
+                    line_fn_nums.append((fn_num, fn_text))
+                    page_footnotes.append((fn_num, fn_text))
+                    pdf_footnote_num[0] += 1
+                    last_end = fn_end
+                processed_line += line[last_end:]
+                line = processed_line
+
+            # Wrap text
+            wrapped_lines = wrap_words(line, font_size, content_width)
+
+            for li, wline in enumerate(wrapped_lines):
+                check_new_page_needed(line_height)
+                is_last = (li == len(wrapped_lines) - 1)
+                if body_align == "justify" and not is_last and len(wline) > 1:
+                    insert_justified_line(current_page, margin_left, y, wline, font_size, content_width)
                 else:
-                    para = doc.add_paragraph(line)
-                    para.alignment = body_alignment
-                    para.paragraph_format.space_after = Pt(para_sp_after)
-                    para.paragraph_format.line_spacing = line_sp
-                    for run in para.runs:
-                        run.font.name = font_name
-                        run.font.size = Pt(font_sz)
-            # Righe vuote: non aggiungere nulla (spazio naturale)
+                    text_str = ' '.join(wline)
+                    text_x = calc_text_x(text_str, font_size, font_body, body_align)
+                    add_text(current_page, (text_x, y), text_str, font_size)
+                y += line_height
+
+            # Spazio extra tra paragrafi
+            if paragraph_spacing > 0:
+                y += paragraph_spacing
+        else:
+            y += line_height * 0.5
 
-        doc.save(str(file_path))
+    # Renderizza le ultime footnotes
+    render_page_footnotes()
 
-        return FileResponse(
-            path=file_path,
-            filename=f"tesi_{safe_title}.docx",
-            media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-        )
+    # Aggiungi sfondo/header/footer/numeri pagina a tutte le pagine
+    total_pages = len(pdf_doc)
+    for page_idx in range(total_pages):
+        page = pdf_doc[page_idx]
 
-    else:
-        # Export PDF (default) con indice — usa template
-        import fitz
-
-        template = get_template_by_id(template_id, db)
-        ps = template.get("pdf", {})
-
-        page_width, page_height = get_page_dimensions(ps.get("page_size", "A4"))
-        margin_top = ps.get("margin_top", 50)
-        margin_bottom = ps.get("margin_bottom", 50)
-        margin_left = ps.get("margin_left", 50)
-        margin_right = ps.get("margin_right", 50)
-        font_body = ps.get("font_body", "helv")
-        font_size = ps.get("font_body_size", 11)
-        font_title_size = ps.get("font_title_size", 24)
-        font_chapter_size = ps.get("font_chapter_size", 18)
-        font_section_size = ps.get("font_section_size", 14)
-        line_height_mult = ps.get("line_height_multiplier", 1.5)
-        include_toc_pdf = ps.get("include_toc", True)
-        include_page_numbers = ps.get("include_page_numbers", True)
-        page_number_position = ps.get("page_number_position", "bottom_center")
-        include_header = ps.get("include_header", False)
-        header_text = ps.get("header_text", "")
-        include_footer = ps.get("include_footer", False)
-        footer_text = ps.get("footer_text", "")
-        title_align = ps.get("title_alignment", "center")
-        body_align = ps.get("body_alignment", "left")
-        chapter_spacing = ps.get("chapter_spacing_before", 20)
-        section_spacing = ps.get("section_spacing_before", 15)
-        paragraph_spacing = ps.get("paragraph_spacing", 0)
-        toc_separator_color = ps.get("toc_separator_color", [0.7, 0.7, 0.7])
-        bg_image_file = ps.get("background_image", "")
-        bg_image_mode = ps.get("background_image_mode", "all_pages")
-        bg_opacity = ps.get("background_opacity", 0.15)
-        bg_image_fit = ps.get("background_image_fit", "tile")
-
-        # Resolve background image path
-        bg_image_path = None
-        if bg_image_file:
-            candidate = config.UPLOAD_DIR / "template_backgrounds" / bg_image_file
-            if candidate.exists():
-                bg_image_path = str(candidate)
-
-        line_height = font_size * line_height_mult
-        content_width = page_width - margin_left - margin_right
-
-        # Calcolo posizione x per allineamenti
-        def calc_text_x(text, fontsize, fontname, alignment):
-            """Calcola la posizione x basata sull'allineamento."""
-            if alignment == "center":
-                text_width = fitz.get_text_length(text, fontname=fontname, fontsize=fontsize)
-                return margin_left + (content_width - text_width) / 2
-            elif alignment == "right":
-                text_width = fitz.get_text_length(text, fontname=fontname, fontsize=fontsize)
-                return page_width - margin_right - text_width
-            return margin_left  # left / justify (default)
-
-        def insert_justified_line(page, x_start, y_pos, words_list, fontsize, fontname, available_width, is_last_line=False):
-            """Inserisce una riga di testo giustificato distribuendo gli spazi tra le parole."""
-            if is_last_line or len(words_list) <= 1:
-                # Ultima riga o singola parola: allinea a sinistra
-                page.insert_text((x_start, y_pos), ' '.join(words_list), fontsize=fontsize, fontname=fontname)
-                return
-            # Calcola lo spazio extra da distribuire
-            text_no_spaces = ''.join(words_list)
-            text_width = fitz.get_text_length(text_no_spaces, fontname=fontname, fontsize=fontsize)
-            total_space = available_width - text_width
-            space_between = total_space / (len(words_list) - 1)
-            # Inserisci parola per parola
-            cx = x_start
-            for i, word in enumerate(words_list):
-                page.insert_text((cx, y_pos), word, fontsize=fontsize, fontname=fontname)
-                word_w = fitz.get_text_length(word, fontname=fontname, fontsize=fontsize)
-                cx += word_w + space_between
-
-        file_path = config.RESULTS_DIR / f"thesis_{safe_title}_{timestamp}.pdf"
-
-        pdf_doc = fitz.open()
-        page_count = [0]  # Mutable per contare le pagine
-
-        def new_pdf_page():
-            """Crea una nuova pagina e incrementa il contatore."""
-            p = pdf_doc.new_page(width=page_width, height=page_height)
-            page_count[0] += 1
-            return p
-
-        current_page = new_pdf_page()
-        y = margin_top
-
-        # Titolo principale (con word-wrap)
-        title_words = thesis.title.split()
-        title_current_line = []
-        for t_word in title_words:
-            t_test = ' '.join(title_current_line + [t_word])
-            t_tw = fitz.get_text_length(t_test, fontname=font_body, fontsize=font_title_size)
-            if t_tw < content_width:
-                title_current_line.append(t_word)
-            else:
-                if title_current_line:
-                    t_str = ' '.join(title_current_line)
-                    t_x = calc_text_x(t_str, font_title_size, font_body, title_align)
-                    current_page.insert_text((t_x, y + font_title_size), t_str, fontsize=font_title_size, fontname=font_body)
-                    y += font_title_size + 4
-                title_current_line = [t_word]
-        if title_current_line:
-            t_str = ' '.join(title_current_line)
-            t_x = calc_text_x(t_str, font_title_size, font_body, title_align)
-            current_page.insert_text((t_x, y + font_title_size), t_str, fontsize=font_title_size, fontname=font_body)
-            y += font_title_size + 4
-        y += 16
-
-        # Separatore
-        y += 20
-
-        # Indice
-        if toc and include_toc_pdf:
-            toc_title_size = font_section_size
-            current_page.insert_text(
-                (margin_left, y),
-                "INDICE",
-                fontsize=toc_title_size,
-                fontname=font_body
-            )
-            y += toc_title_size + 10
-
-            # Linea separatrice
-            sep_color = tuple(toc_separator_color) if isinstance(toc_separator_color, list) else (0.7, 0.7, 0.7)
-            current_page.draw_line(
-                fitz.Point(margin_left, y),
-                fitz.Point(page_width - margin_right, y),
-                color=sep_color,
-                width=1
-            )
-            y += 15
-
-            # Contenuto indice
-            chapters = thesis.chapters_structure.get("chapters", []) if thesis.chapters_structure else []
-            for ch_idx, chapter in enumerate(chapters):
-                if y + line_height * 2 > page_height - margin_bottom:
-                    current_page = new_pdf_page()
-                    y = margin_top
-
-                ch_title = chapter.get("chapter_title") or chapter.get("title", f"Capitolo {ch_idx + 1}")
-                is_special = chapter.get("is_special", False)
-
-                if is_special:
-                    # Word-wrap special chapter titles
-                    toc_text = ch_title
-                    toc_words = toc_text.split()
-                    toc_current_line = []
-                    for toc_word in toc_words:
-                        toc_test_line = ' '.join(toc_current_line + [toc_word])
-                        toc_tw = fitz.get_text_length(toc_test_line, fontname=font_body, fontsize=font_size)
-                        if toc_tw < content_width:
-                            toc_current_line.append(toc_word)
-                        else:
-                            if toc_current_line:
-                                if y + line_height > page_height - margin_bottom:
-                                    current_page = new_pdf_page()
-                                    y = margin_top
-                                current_page.insert_text((margin_left, y), ' '.join(toc_current_line), fontsize=font_size, fontname=font_body)
-                                y += line_height
-                            toc_current_line = [toc_word]
-                    if toc_current_line:
-                        if y + line_height > page_height - margin_bottom:
-                            current_page = new_pdf_page()
-                            y = margin_top
-                        current_page.insert_text((margin_left, y), ' '.join(toc_current_line), fontsize=font_size, fontname=font_body)
-                        y += line_height
-                else:
-                    ch_num = chapter.get("chapter_index", ch_idx + 1)
-
-                    # Word-wrap chapter titles
-                    toc_text = f"Capitolo {ch_num}: {ch_title}"
-                    toc_words = toc_text.split()
-                    toc_current_line = []
-                    for toc_word in toc_words:
-                        toc_test_line = ' '.join(toc_current_line + [toc_word])
-                        toc_tw = fitz.get_text_length(toc_test_line, fontname=font_body, fontsize=font_size)
-                        if toc_tw < content_width:
-                            toc_current_line.append(toc_word)
-                        else:
-                            if toc_current_line:
-                                if y + line_height > page_height - margin_bottom:
-                                    current_page = new_pdf_page()
-                                    y = margin_top
-                                current_page.insert_text((margin_left, y), ' '.join(toc_current_line), fontsize=font_size, fontname=font_body)
-                                y += line_height
-                            toc_current_line = [toc_word]
-                    if toc_current_line:
-                        if y + line_height > page_height - margin_bottom:
-                            current_page = new_pdf_page()
-                            y = margin_top
-                        current_page.insert_text((margin_left, y), ' '.join(toc_current_line), fontsize=font_size, fontname=font_body)
-                        y += line_height
-
-                    sections = chapter.get("sections", [])
-                    for sec_idx, section in enumerate(sections):
-                        if y + line_height > page_height - margin_bottom:
-                            current_page = new_pdf_page()
-                            y = margin_top
-
-                        sec_num = section.get("index", sec_idx + 1)
-                        sec_title = section.get("title", f"Sezione {sec_num}")
-
-                        # Word-wrap section titles (indented by 20)
-                        sec_text = f"{ch_num}.{sec_num}: {sec_title}"
-                        sec_available_width = content_width - 20
-                        sec_words = sec_text.split()
-                        sec_current_line = []
-                        for sec_word in sec_words:
-                            sec_test_line = ' '.join(sec_current_line + [sec_word])
-                            sec_tw = fitz.get_text_length(sec_test_line, fontname=font_body, fontsize=font_size - 1)
-                            if sec_tw < sec_available_width:
-                                sec_current_line.append(sec_word)
-                            else:
-                                if sec_current_line:
-                                    if y + line_height > page_height - margin_bottom:
-                                        current_page = new_pdf_page()
-                                        y = margin_top
-                                    current_page.insert_text((margin_left + 20, y), ' '.join(sec_current_line), fontsize=font_size - 1, fontname=font_body)
-                                    y += line_height * 0.9
-                                sec_current_line = [sec_word]
-                        if sec_current_line:
-                            if y + line_height > page_height - margin_bottom:
-                                current_page = new_pdf_page()
-                                y = margin_top
-                            current_page.insert_text((margin_left + 20, y), ' '.join(sec_current_line), fontsize=font_size - 1, fontname=font_body)
-                            y += line_height * 0.9
-
-                y += 5  # Spazio tra capitoli
-
-            # Separatore dopo indice
-            y += 15
-            current_page.draw_line(
-                fitz.Point(margin_left, y),
-                fitz.Point(page_width - margin_right, y),
-                color=sep_color,
-                width=1
-            )
-            y += 30
-
-        # Nuova pagina per il contenuto
-        current_page = new_pdf_page()
-        y = margin_top
-
-        # Footnote tracking for PDF
-        pdf_footnote_num = [1]  # Progressive footnote number
-        page_footnotes = []  # Footnotes for current page
-        fn_font_size = max(font_size - 3, 7)
-        fn_line_height = fn_font_size * 1.3
-        fn_separator_space = 15  # Space for separator line above footnotes
-
-        def get_footnotes_height():
-            """Calcola altezza necessaria per le note a piè di pagina correnti."""
-            if not page_footnotes:
-                return 0
-            return fn_separator_space + len(page_footnotes) * fn_line_height + 5
-
-        def render_page_footnotes():
-            """Renderizza le note raccolte in fondo alla pagina corrente."""
-            if not page_footnotes:
-                return
-            fn_y = page_height - margin_bottom - get_footnotes_height() + fn_separator_space
-            # Linea separatrice
-            current_page.draw_line(
-                fitz.Point(margin_left, fn_y - 8),
-                fitz.Point(margin_left + content_width * 0.3, fn_y - 8),
-                color=(0.5, 0.5, 0.5),
+        # Background image (behind content)
+        if bg_image_path:
+            apply_bg = (bg_image_mode == "all_pages") or (bg_image_mode == "first_page_only" and page_idx == 0)
+            if apply_bg:
+                try:
+                    from PIL import Image
+
+                    img = Image.open(bg_image_path).convert("RGBA")
+                    if bg_opacity < 1.0:
+                        white_bg = Image.new("RGBA", img.size, (255, 255, 255, 255))
+                        img = Image.blend(white_bg, img, bg_opacity)
+
+                    pw, ph = int(page_width), int(page_height)
+
+                    if bg_image_fit == "tile":
+                        # Tile: repeat image across the page
+                        canvas = Image.new("RGB", (pw, ph), (255, 255, 255))
+                        iw, ih = img.size
+                        for ty in range(0, ph, ih):
+                            for tx in range(0, pw, iw):
+                                canvas.paste(img, (tx, ty), img if img.mode == "RGBA" else None)
+                        final_img = canvas
+                    elif bg_image_fit == "original":
+                        # Original size from top-left corner
+                        canvas = Image.new("RGB", (pw, ph), (255, 255, 255))
+                        canvas.paste(img, (0, 0), img if img.mode == "RGBA" else None)
+                        final_img = canvas
+                    elif bg_image_fit == "center":
+                        # Original size centered
+                        canvas = Image.new("RGB", (pw, ph), (255, 255, 255))
+                        iw, ih = img.size
+                        x = (pw - iw) // 2
+                        y = (ph - ih) // 2
+                        canvas.paste(img, (x, y), img if img.mode == "RGBA" else None)
+                        final_img = canvas
+                    else:
+                        # Stretch: fill entire page
+                        final_img = img.convert("RGB").resize((pw, ph), Image.LANCZOS)
+
+                    buf = io.BytesIO()
+                    final_img.save(buf, format="PNG")
+                    buf.seek(0)
+                    bg_rect = fitz.Rect(0, 0, page_width, page_height)
+                    page.insert_image(bg_rect, stream=buf.read(), overlay=False)
+                except Exception as e:
+                    logger.warning(f"Errore inserimento sfondo PDF: {e}")
+
+        # Header
+        if include_header and header_text:
+            header_x = calc_text_x(header_text, 8, font_body, "center")
+            add_text(page, (header_x, margin_top - 15), header_text, 8, color=(0.5, 0.5, 0.5))
+            # Linea sotto header
+            page.draw_line(
+                fitz.Point(margin_left, margin_top - 8),
+                fitz.Point(page_width - margin_right, margin_top - 8),
+                color=(0.85, 0.85, 0.85),
                 width=0.5
             )
-            for fn_num, fn_text in page_footnotes:
-                fn_label = f"{fn_num} "
-                label_width = fitz.get_text_length(fn_label, fontname=font_body, fontsize=fn_font_size)
-                current_page.insert_text(
-                    (margin_left, fn_y),
-                    fn_label,
-                    fontsize=fn_font_size,
-                    fontname=font_body,
-                    color=(0.3, 0.3, 0.3)
-                )
-                # Wrap footnote text
-                fn_words = fn_text.split()
-                fn_current_line = []
-                fn_x_start = margin_left + label_width
-                fn_content_width = content_width - label_width
-                first_line = True
-                for fw in fn_words:
-                    test = ' '.join(fn_current_line + [fw])
-                    tw = fitz.get_text_length(test, fontname=font_body, fontsize=fn_font_size)
-                    if tw < fn_content_width:
-                        fn_current_line.append(fw)
-                    else:
-                        if fn_current_line:
-                            x_pos = fn_x_start if first_line else margin_left + label_width
-                            if not first_line:
-                                fn_y += fn_line_height
-                            current_page.insert_text(
-                                (x_pos, fn_y if first_line else fn_y),
-                                ' '.join(fn_current_line),
-                                fontsize=fn_font_size,
-                                fontname=font_body,
-                                color=(0.3, 0.3, 0.3)
-                            )
-                            first_line = False
-                        fn_current_line = [fw]
-                if fn_current_line:
-                    x_pos = fn_x_start if first_line else margin_left + label_width
-                    if not first_line:
-                        fn_y += fn_line_height
-                    current_page.insert_text(
-                        (x_pos, fn_y),
-                        ' '.join(fn_current_line),
-                        fontsize=fn_font_size,
-                        fontname=font_body,
-                        color=(0.3, 0.3, 0.3)
-                    )
-                fn_y += fn_line_height
-
-        def get_available_y():
-            """Altezza massima disponibile per il contenuto (sottraendo footnotes)."""
-            return page_height - margin_bottom - get_footnotes_height()
-
-        def check_new_page_needed(needed_height):
-            """Verifica se serve nuova pagina. Se sì, renderizza footnotes e crea nuova pagina."""
-            nonlocal current_page, y, page_footnotes
-            if y + needed_height > get_available_y():
-                render_page_footnotes()
-                page_footnotes = []
-                current_page = new_pdf_page()
-                y = margin_top
-
-        # Contenuto con footnotes
-        for line in content.split('\n'):
-            check_new_page_needed(line_height)
-
-            # Gestisci titoli
-            if line.startswith('# '):
-                y += chapter_spacing
-                check_new_page_needed(font_chapter_size + 10)
-                # Word-wrap chapter title
-                ch_title_text = line[2:]
-                ch_words = ch_title_text.split()
-                ch_current_line = []
-                for ch_word in ch_words:
-                    ch_test_line = ' '.join(ch_current_line + [ch_word])
-                    ch_tw = fitz.get_text_length(ch_test_line, fontname=font_body, fontsize=font_chapter_size)
-                    if ch_tw < content_width:
-                        ch_current_line.append(ch_word)
-                    else:
-                        if ch_current_line:
-                            check_new_page_needed(font_chapter_size + 4)
-                            current_page.insert_text((margin_left, y), ' '.join(ch_current_line), fontsize=font_chapter_size, fontname=font_body)
-                            y += font_chapter_size + 4
-                        ch_current_line = [ch_word]
-                if ch_current_line:
-                    check_new_page_needed(font_chapter_size + 4)
-                    current_page.insert_text((margin_left, y), ' '.join(ch_current_line), fontsize=font_chapter_size, fontname=font_body)
-                    y += font_chapter_size + 4
-                y += 4
-            elif line.startswith('## '):
-                y += section_spacing
-                check_new_page_needed(font_section_size + 8)
-                # Word-wrap section title
-                sec_title_text = line[3:]
-                sec_words = sec_title_text.split()
-                sec_current_line = []
-                for sec_word in sec_words:
-                    sec_test_line = ' '.join(sec_current_line + [sec_word])
-                    sec_tw = fitz.get_text_length(sec_test_line, fontname=font_body, fontsize=font_section_size)
-                    if sec_tw < content_width:
-                        sec_current_line.append(sec_word)
-                    else:
-                        if sec_current_line:
-                            check_new_page_needed(font_section_size + 3)
-                            current_page.insert_text((margin_left, y), ' '.join(sec_current_line), fontsize=font_section_size, fontname=font_body)
-                            y += font_section_size + 3
-                        sec_current_line = [sec_word]
-                if sec_current_line:
-                    check_new_page_needed(font_section_size + 3)
-                    current_page.insert_text((margin_left, y), ' '.join(sec_current_line), fontsize=font_section_size, fontname=font_body)
-                    y += font_section_size + 3
-            elif line.strip():
-                # Check for footnotes in line
-                footnotes_in_line = extract_footnotes_from_line(line)
-
-                if footnotes_in_line:
-                    # Process line: strip {{nota:...}} and replace with superscript numbers
-                    processed_line = ""
-                    last_end = 0
-                    line_fn_nums = []
-                    for fn_start, fn_end, fn_text in footnotes_in_line:
-                        processed_line += line[last_end:fn_start]
-                        fn_num = pdf_footnote_num[0]
-                        processed_line += f"[{fn_num}]"
-                        line_fn_nums.append((fn_num, fn_text))
-                        page_footnotes.append((fn_num, fn_text))
-                        pdf_footnote_num[0] += 1
-                        last_end = fn_end
-                    processed_line += line[last_end:]
-                    line = processed_line
-
-                # Wrap text
-                words = line.split()
-                current_line = []
-                wrapped_lines = []
-                for word in words:
-                    test_line = ' '.join(current_line + [word])
-                    text_width = fitz.get_text_length(test_line, fontname=font_body, fontsize=font_size)
-                    if text_width < content_width:
-                        current_line.append(word)
-                    else:
-                        if current_line:
-                            wrapped_lines.append(current_line)
-                        current_line = [word]
-                if current_line:
-                    wrapped_lines.append(current_line)
 
-                for li, wline in enumerate(wrapped_lines):
-                    check_new_page_needed(line_height)
-                    is_last = (li == len(wrapped_lines) - 1)
-                    if body_align == "justify" and not is_last and len(wline) > 1:
-                        insert_justified_line(current_page, margin_left, y, wline, font_size, font_body, content_width)
-                    else:
-                        text_str = ' '.join(wline)
-                        text_x = calc_text_x(text_str, font_size, font_body, body_align)
-                        current_page.insert_text((text_x, y), text_str, fontsize=font_size, fontname=font_body)
-                    y += line_height
-
-                # Spazio extra tra paragrafi
-                if paragraph_spacing > 0:
-                    y += paragraph_spacing
+        # Footer text
+        if include_footer and footer_text:
+            footer_y = page_height - margin_bottom + 20
+            footer_x = calc_text_x(footer_text, 8, font_body, "center")
+            add_text(page, (footer_x, footer_y), footer_text, 8, color=(0.5, 0.5, 0.5))
+
+        # Numeri di pagina
+        if include_page_numbers:
+            page_num_text = str(page_idx + 1)
+            pn_fontsize = 9
+
+            if page_number_position == "bottom_center":
+                pn_x = calc_text_x(page_num_text, pn_fontsize, font_body, "center")
+                pn_y = page_height - margin_bottom + 10 + (15 if include_footer and footer_text else 0)
+            elif page_number_position == "bottom_right":
+                pn_x = page_width - margin_right - fitz.get_text_length(page_num_text, fontname=font_body, fontsize=pn_fontsize)
+                pn_y = page_height - margin_bottom + 10 + (15 if include_footer and footer_text else 0)
+            elif page_number_position == "top_center":
+                pn_x = calc_text_x(page_num_text, pn_fontsize, font_body, "center")
+                pn_y = margin_top - 25
+            elif page_number_position == "top_right":
+                pn_x = page_width - margin_right - fitz.get_text_length(page_num_text, fontname=font_body, fontsize=pn_fontsize)
+                pn_y = margin_top - 25
             else:
-                y += line_height * 0.5
+                pn_x = calc_text_x(page_num_text, pn_fontsize, font_body, "center")
+                pn_y = page_height - margin_bottom + 10
 
-        # Renderizza le ultime footnotes
-        render_page_footnotes()
+            add_text(page, (pn_x, pn_y), page_num_text, pn_fontsize, color=(0.5, 0.5, 0.5))
 
-        # Aggiungi sfondo/header/footer/numeri pagina a tutte le pagine
-        total_pages = len(pdf_doc)
-        for page_idx in range(total_pages):
-            page = pdf_doc[page_idx]
+    for (page_number, color), writer in page_writers.items():
+        writer.write_text(pdf_doc[page_number], color=color)
 
-            # Background image (behind content)
-            if bg_image_path:
-                apply_bg = (bg_image_mode == "all_pages") or (bg_image_mode == "first_page_only" and page_idx == 0)
-                if apply_bg:
-                    try:
-                        from PIL import Image
-                        import io as _io
-
-                        img = Image.open(bg_image_path).convert("RGBA")
-                        if bg_opacity < 1.0:
-                            white_bg = Image.new("RGBA", img.size, (255, 255, 255, 255))
-                            img = Image.blend(white_bg, img, bg_opacity)
-
-                        pw, ph = int(page_width), int(page_height)
-
-                        if bg_image_fit == "tile":
-                            # Tile: repeat image across the page
-                            canvas = Image.new("RGB", (pw, ph), (255, 255, 255))
-                            iw, ih = img.size
-                            for ty in range(0, ph, ih):
-                                for tx in range(0, pw, iw):
-                                    canvas.paste(img, (tx, ty), img if img.mode == "RGBA" else None)
-                            final_img = canvas
-                        elif bg_image_fit == "original":
-                            # Original size from top-left corner
-                            canvas = Image.new("RGB", (pw, ph), (255, 255, 255))
-                            canvas.paste(img, (0, 0), img if img.mode == "RGBA" else None)
-                            final_img = canvas
-                        elif bg_image_fit == "center":
-                            # Original size centered
-                            canvas = Image.new("RGB", (pw, ph), (255, 255, 255))
-                            iw, ih = img.size
-                            x = (pw - iw) // 2
-                            y = (ph - ih) // 2
-                            canvas.paste(img, (x, y), img if img.mode == "RGBA" else None)
-                            final_img = canvas
-                        else:
-                            # Stretch: fill entire page
-                            final_img = img.convert("RGB").resize((pw, ph), Image.LANCZOS)
-
-                        buf = _io.BytesIO()
-                        final_img.save(buf, format="PNG")
-                        buf.seek(0)
-                        bg_rect = fitz.Rect(0, 0, page_width, page_height)
-                        page.insert_image(bg_rect, stream=buf.read(), overlay=False)
-                    except Exception as e:
-                        logger.warning(f"Errore inserimento sfondo PDF: {e}")
-
-            # Header
-            if include_header and header_text:
-                header_x = calc_text_x(header_text, 8, font_body, "center")
-                page.insert_text(
-                    (header_x, margin_top - 15),
-                    header_text,
-                    fontsize=8,
-                    fontname=font_body,
-                    color=(0.5, 0.5, 0.5)
-                )
-                # Linea sotto header
-                page.draw_line(
-                    fitz.Point(margin_left, margin_top - 8),
-                    fitz.Point(page_width - margin_right, margin_top - 8),
-                    color=(0.85, 0.85, 0.85),
-                    width=0.5
-                )
+    # Il font dei TextWriter e' incorporato per intero: si tengono solo i glifi
+    # usati e si comprimono gli stream, altrimenti il PDF cresce di molto
+    pdf_doc.subset_fonts()
+    data = pdf_doc.tobytes(garbage=3, deflate=True)
+    pdf_doc.close()
 
-            # Footer text
-            if include_footer and footer_text:
-                footer_y = page_height - margin_bottom + 20
-                footer_x = calc_text_x(footer_text, 8, font_body, "center")
-                page.insert_text(
-                    (footer_x, footer_y),
-                    footer_text,
-                    fontsize=8,
-                    fontname=font_body,
-                    color=(0.5, 0.5, 0.5)
-                )
+    return data
+
+
+# Caratteri esclusi dal titolo nei nomi dei file di export: tutto tranne
+# alfanumerici (come str.isalnum, \w), spazio, "_" e "-"
+_UNSAFE_TITLE_CHARS = re.compile(r"[^\w \-]")
+
+# Handler di export per formato: (funzione -> bytes, media type). I formati
+# non riconosciuti producono un PDF
+_EXPORT_FORMATS = {
+    "txt": (_export_txt, "text/plain"),
+    "md": (_export_md, "text/markdown"),
+    "docx": (_export_docx, "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+    "pdf": (_export_pdf, "application/pdf"),
+}
+
+# Formati gia' compressi (zip/flate): nell'archivio multiplo vengono solo copiati
+_EXPORT_COMPRESSED_FORMATS = {"docx", "pdf"}
 
-            # Numeri di pagina
-            if include_page_numbers:
-                page_num_text = str(page_idx + 1)
-                pn_fontsize = 9
-
-                if page_number_position == "bottom_center":
-                    pn_x = calc_text_x(page_num_text, pn_fontsize, font_body, "center")
-                    pn_y = page_height - margin_bottom + 10 + (15 if include_footer and footer_text else 0)
-                elif page_number_position == "bottom_right":
-                    pn_x = page_width - margin_right - fitz.get_text_length(page_num_text, fontname=font_body, fontsize=pn_fontsize)
-                    pn_y = page_height - margin_bottom + 10 + (15 if include_footer and footer_text else 0)
-                elif page_number_position == "top_center":
-                    pn_x = calc_text_x(page_num_text, pn_fontsize, font_body, "center")
-                    pn_y = margin_top - 25
-                elif page_number_position == "top_right":
-                    pn_x = page_width - margin_right - fitz.get_text_length(page_num_text, fontname=font_body, fontsize=pn_fontsize)
-                    pn_y = margin_top - 25
-                else:
-                    pn_x = calc_text_x(page_num_text, pn_fontsize, font_body, "center")
-                    pn_y = page_height - margin_bottom + 10
-
-                page.insert_text(
-                    (pn_x, pn_y),
-                    page_num_text,
-                    fontsize=pn_fontsize,
-                    fontname=font_body,
-                    color=(0.5, 0.5, 0.5)
-                )
 
-        pdf_doc.save(file_path)
-        pdf_doc.close()
+def _get_exportable_thesis(db: DBSession, thesis_id: str, user_id: str) -> Thesis:
+    """Recupera una tesi verificando che sia completata e abbia contenuto."""
+    thesis = get_thesis_by_id(db, thesis_id, user_id)
 
-        return FileResponse(
-            path=file_path,
-            filename=f"tesi_{safe_title}.pdf",
-            media_type="application/pdf"
+    if thesis.status != 'completed':
+        raise HTTPException(
+            status_code=400,
+            detail=f"La tesi non è ancora completata. Stato: '{thesis.status}'"
         )
+
+    if not thesis.generated_content:
+        raise HTTPException(status_code=404, detail="Nessun contenuto generato")
+
+    return thesis
+
+
+def _export_template(formats, template_id: Optional[str], db: DBSession) -> dict:
+    """Template di esportazione, letto dal DB solo se serve (DOCX/PDF)."""
+    if any(fmt in ("docx", "pdf") for fmt in formats):
+        return get_template_by_id(template_id, db)
+    return {}
+
+
+@router.get("/{thesis_id}/export")
+async def export_thesis(
+    thesis_id: str,
+    format: str = "pdf",
+    template_id: str = None,
+    current_user: AuthedUser = Depends(get_current_authed_user),
+    db: DBSession = Depends(get_db)
+):
+    """
+    Esporta la tesi completata nel formato richiesto.
+
+    Formati supportati: pdf, txt, md, docx
+    Include automaticamente l'indice all'inizio del documento.
+    """
+    thesis = _get_exportable_thesis(db, thesis_id, str(current_user.id))
+
+    fmt = format if format in _EXPORT_FORMATS else "pdf"
+    handler, media_type = _EXPORT_FORMATS[fmt]
+    template = _export_template((fmt,), template_id, db)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    safe_title = _UNSAFE_TITLE_CHARS.sub("", thesis.title[:50]).strip()
+    cit_style = getattr(thesis, 'citation_style', 'footnotes') or 'footnotes'
+
+    # Costruzione e scrittura del file (secondi per PDF/DOCX lunghi) in un
+    # thread: l'event loop continua a servire le altre richieste
+    def build():
+        data = handler(thesis, thesis.generated_content, cit_style, template)
+        return _export_response(data, safe_title, timestamp, fmt, media_type)
+
+    return await asyncio.to_thread(build)
+
+
+@router.post("/{thesis_id}/export-bulk")
+async def export_thesis_bulk(
+    thesis_id: str,
+    formats: List[str] = Query(...),
+    template_id: str = None,
+    current_user: AuthedUser = Depends(get_current_authed_user),
+    db: DBSession = Depends(get_db)
+):
+    """
+    Esporta la tesi completata in piu' formati, in un unico archivio ZIP.
+
+    La tesi e il template vengono letti una volta sola e i formati sono
+    generati in parallelo, ciascuno in un thread (lxml lavora in C rilasciando
+    il GIL; il PDF resta serializzato da _pdf_export_lock).
+    """
+    formats = list(dict.fromkeys(formats))
+    unknown = [fmt for fmt in formats if fmt not in _EXPORT_FORMATS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Formati non supportati: {', '.join(unknown)}. Validi: {', '.join(_EXPORT_FORMATS)}"
+        )
+
+    thesis = _get_exportable_thesis(db, thesis_id, str(current_user.id))
+
+    template = _export_template(formats, template_id, db)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    safe_title = _UNSAFE_TITLE_CHARS.sub("", thesis.title[:50]).strip()
+    cit_style = getattr(thesis, 'citation_style', 'footnotes') or 'footnotes'
+    content = thesis.generated_content
+
+    results = await asyncio.gather(*(
+        asyncio.to_thread(_EXPORT_FORMATS[fmt][0], thesis, content, cit_style, template)
+        for fmt in formats
+    ))
+
+    def build_zip():
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            for fmt, data in zip(formats, results):
+                compression = zipfile.ZIP_STORED if fmt in _EXPORT_COMPRESSED_FORMATS else zipfile.ZIP_DEFLATED
+                archive.writestr(f"tesi_{safe_title}.{fmt}", data, compress_type=compression)
+        return _export_response(buffer.getvalue(), safe_title, timestamp, "zip", "application/zip")
+
+    return await asyncio.to_thread(build_zip)
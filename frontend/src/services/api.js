@@ -566,6 +566,29 @@ export const exportThesis = async (thesisId, format = 'pdf', templateId = null)
   return response.data;
 };
 
+// Export in piu' formati in un unico archivio ZIP
+export const exportThesisBulk = async (thesisId, formats = ['pdf', 'docx'], templateId = null) => {
+  const params = { formats };
+  if (templateId) params.template_id = templateId;
+
+  const response = await api.post(`/api/thesis/${thesisId}/export-bulk`, null, {
+    params,
+    paramsSerializer: { indexes: null },  // formats=pdf&formats=docx
+    responseType: 'blob'
+  });
+
+  const url = window.URL.createObjectURL(new Blob([response.data], { type: 'application/zip' }));
+  const link = document.createElement('a');
+  link.href = url;
+  link.setAttribute('download', `tesi_${thesisId}.zip`);
+  document.body.appendChild(link);
+  link.click();
+  link.remove();
+  window.URL.revokeObjectURL(url);
+
+  return response.data;
+};
+
 // Polling per lo stato della generazione tesi
 export const pollThesisGenerationStatus = async (thesisId, onUpdate, interval = 3000, timeout = 1800000) => {
   const startTime = Date.now();